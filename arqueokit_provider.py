@@ -110,6 +110,13 @@ class ArqueokitProvider(QgsProcessingProvider):
         """
         return self.tr('Arqueokit')
 
+    def supportedOutputRasterLayerExtensions(self):
+        """
+        Raster outputs of the algorithms are always written as GeoTIFF (COG),
+        so only GeoTIFF extensions are offered for raster destinations.
+        """
+        return ['tif', 'tiff']
+
     def icon(self):
         return QIcon(os.path.join(os.path.dirname(__file__), 'icon.png'))
 
@@ -19,20 +19,31 @@ from qgis.core import (
     QgsProcessingParameterField, QgsProcessingParameterString,
     QgsProcessingParameterNumber, QgsProcessingParameterFileDestination,
     QgsProcessingParameterFile, QgsProcessingParameterRasterDestination,
-    QgsProcessingParameterBoolean,
+    QgsProcessingParameterBoolean, QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterFolderDestination, QgsProcessingParameterEnum,
     QgsProcessingException, QgsCoordinateReferenceSystem,
     QgsCoordinateTransform, QgsProject, QgsPointXY, QgsGeometry
 )
 
-import os, json, numpy as np, rasterio, traceback
+import os, sys, csv, copy, json, time, shutil, hashlib, numpy as np, rasterio, traceback, threading
+from contextlib import nullcontext, contextmanager
+from collections import OrderedDict
 from rasterio.transform import rowcol
+from rasterio.windows import Window, from_bounds
 from joblib import dump, load
 
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import RandomForestClassifier, HistGradientBoostingClassifier
 from sklearn.neighbors import KNeighborsClassifier
+from sklearn.utils.class_weight import compute_sample_weight
 from sklearn.metrics import confusion_matrix, classification_report, accuracy_score, cohen_kappa_score
 
-from scipy import ndimage as ndi
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .raster_io import (check_geotiff_path, cog_profile, cog_writer, finalize_cog, open_update, refresh_overviews,
+                        block_for, iter_windows, check_canceled, resolve_workers, run_pipeline, thread_readers)
+from .raster_index_engine import (INDEX_FORMULAS, ND_INDICES, IndexPlan, available_index_names,
+                                  parse_custom_indices)
 
 # -------------------- scikit-image: imports compatíveis -------------------- #
 # view_as_windows é estável
@@ -50,6 +61,28 @@ try:
 except Exception:
     _HAS_SKIMAGE_RANK = False
 
+# threadpoolctl (dependência do scikit-learn): limita o OpenMP do HistGB durante a predição em blocos
+try:
+    from threadpoolctl import threadpool_limits
+except Exception:
+    threadpool_limits = None
+
+# Pico de memória por etapa: resource (Unix) ou psutil (Windows)
+try:
+    import resource
+except Exception:
+    resource = None
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+# GDAL (mosaico VRT do modo em lote); presente em qualquer instalação do QGIS
+try:
+    from osgeo import gdal
+except Exception:
+    gdal = None
+
 # -------------------- Utilidades -------------------- #
 
 def tr(s): return QCoreApplication.translate('Processing', s)
@@ -62,89 +95,14 @@ def parse_band_mapping(text):
         m[k.strip().upper()] = int(v.strip()) - 1  # 1-based -> 0-based
     return m
 
-def safe_div(num, den):
-    with np.errstate(divide='ignore', invalid='ignore'):
-        out = num / den
-        out[~np.isfinite(out)] = 0
-    return out
-
-def available_indices(keys):
-    """Índices (gerados se houver bandas suficientes)."""
-    defs = []
-    has = {k: (k in keys) for k in ['R','G','B','NIR','SWIR1','SWIR2']}
-
-    if has['NIR'] and has['R']:
-        defs += [
-            ('NDVI',   lambda B: safe_div(B['NIR'] - B['R'], B['NIR'] + B['R'])),
-            ('EVI2',   lambda B: 2.5 * safe_div(B['NIR'] - B['R'], B['NIR'] + 2.4*B['R'] + 1)),
-            ('SAVI',   lambda B: 1.7 * safe_div(B['NIR'] - B['R'], B['NIR'] + B['R'] + 0.7)),
-            ('MSAVI2', lambda B: (2*B['NIR'] + 1 - np.sqrt((2*B['NIR'] + 1)**2 - 8*(B['NIR'] - B['R'])))/2),
-            ('OSAVI',  lambda B: 1.16 * safe_div(B['NIR'] - B['R'], B['NIR'] + B['R'] + 0.16)),
-        ]
-    if has['SWIR2'] and has['SWIR1']:
-        defs += [
-            ('CAI',  lambda B: safe_div(B['SWIR2'], B['SWIR1'])),
-            ('NBR2', lambda B: safe_div(B['SWIR1'] - B['SWIR2'], B['SWIR1'] + B['SWIR2'])),
-        ]
-    if has['NIR'] and has['SWIR1']:
-        defs += [
-            ('NDWI', lambda B: safe_div(B['NIR'] - B['SWIR1'], B['NIR'] + B['SWIR1'])),
-            ('NDMI', lambda B: safe_div(B['NIR'] - B['SWIR1'], B['NIR'] + B['SWIR1'])),
-            ('BSCI', lambda B: safe_div(B['SWIR1'] - B['NIR'], B['SWIR1'] + B['NIR'])),
-        ]
-    if has['NIR'] and has['G']:
-        defs += [
-            ('GCVI',  lambda B: safe_div(B['NIR'], B['G']) - 1),
-            ('GNDVI', lambda B: safe_div(B['NIR'] - B['G'], B['NIR'] + B['G'])),
-        ]
-    if has['R'] and has['NIR'] and has['SWIR2']:
-        defs.append(('HallCover', lambda B: (-0.017*B['R']) + (-0.007*B['NIR']) + (-0.079*B['SWIR2']) + 5.22))
-    if has['B'] and has['G']:
-        defs.append(('PRI',  lambda B: safe_div(B['B'] - B['G'], B['B'] + B['G'])))
-    if has['G'] and has['R'] and has['B']:
-        defs += [
-            ('VARI', lambda B: safe_div(B['G'] - B['R'], B['G'] + B['R'] - B['B'])),
-            ('EXG',  lambda B: 2*B['G'] - B['R'] - B['B']),
-        ]
-    if has['G'] and has['R']:
-        defs += [
-            ('GRVI', lambda B: safe_div(B['G'] - B['R'], B['G'] + B['R'])),
-            ('NDTI', lambda B: safe_div(B['R'] - B['G'], B['R'] + B['G'])),
-        ]
-    # Não-colineares adicionais
-    if all(k in keys for k in ('SWIR1','R','NIR','B')):
-        defs.append(('BSI', lambda B: safe_div((B['SWIR1'] + B['R']) - (B['NIR'] + B['B']),
-                                               (B['SWIR1'] + B['R']) + (B['NIR'] + B['B']))))
-    if all(k in keys for k in ('NIR','R','B')):
-        defs.append(('ARVI', lambda B: safe_div(B['NIR'] - (2*B['R'] - B['B']),
-                                               B['NIR'] + (2*B['R'] - B['B']))))
-    if all(k in keys for k in ('NIR','B','R')):
-        defs.append(('SIPI', lambda B: safe_div(B['NIR'] - B['B'],
-                                               B['NIR'] + B['R'])))
-    if all(k in keys for k in ('NIR','SWIR2')):
-        defs.append(('GVMI', lambda B: safe_div((B['NIR'] + 0.1) - (B['SWIR2'] + 0.02),
-                                               (B['NIR'] + 0.1) + (B['SWIR2'] + 0.02))))
-    if all(k in keys for k in ('NIR','SWIR1','SWIR2')):
-        defs.append(('NMDI', lambda B: safe_div(B['NIR'] - (B['SWIR1'] - B['SWIR2']),
-                                               B['NIR'] + (B['SWIR1'] - B['SWIR2']))))
-    if has['G'] and has['NIR']:
-        defs.append(('NDWI_McFeeters', lambda B: safe_div(B['G'] - B['NIR'], B['G'] + B['NIR'])))
-    if has['NIR'] and has['SWIR2']:
-        defs.append(('NBR', lambda B: safe_div(B['NIR'] - B['SWIR2'], B['NIR'] + B['SWIR2'])))
-    if has['G'] and has['SWIR1']:
-        defs.append(('NDSI', lambda B: safe_div(B['G'] - B['SWIR1'], B['G'] + B['SWIR1'])))
-    if has['NIR'] and has['R'] and has['B']:
-        defs.append(('EVI', lambda B: 2.5*((B['NIR'] - B['R'])/(B['NIR'] + 6*B['R'] - 7.5*B['B'] + 1))))
-    return defs
-
-def read_bands(ds, bandmap, feedback=None):
+def read_bands(ds, bandmap, feedback=None, window=None, out_shape=None):
     arr, masks = {}, []
     for name, bidx in bandmap.items():
         if 0 <= bidx < ds.count:
             if feedback: feedback.pushInfo(f"[Abertura] Band {name} ← raster banda {bidx+1}")
-            band = ds.read(bidx + 1).astype(np.float32)
+            band = ds.read(bidx + 1, window=window, out_shape=out_shape).astype(np.float32)
             arr[name] = band
-            m = ds.read_masks(bidx + 1) > 0
+            m = ds.read_masks(bidx + 1, window=window, out_shape=out_shape) > 0
             if ds.nodatavals and ds.nodatavals[bidx] is not None:
                 nod = ds.nodatavals[bidx]
                 m &= band != nod
@@ -154,37 +112,179 @@ def read_bands(ds, bandmap, feedback=None):
     valid = np.logical_and.reduce(masks) if masks else None
     return arr, valid
 
-def stack_features(arr_bands, feedback=None):
-    feats, names = [], []
+# Diferenças normalizadas (divisão segura → 0) ficam em [-1, 1]: guardadas em int16 com escala 1e-4
+ND_SCALE = 1e-4
+
+class FeatureStack:
+    """Cubo (linhas, colunas, features) guardado plano a plano no menor tipo que preserva a informação:
+    bandas em float32 (os próprios arrays lidos, sem cópia), diferenças normalizadas em int16 (×1e-4),
+    demais índices em float32 e entropia em float16 (vem de u8, ≤ 8 bits).
+    Indexar com fatias/listas de linhas e colunas (stack[r0:r1, c0:c1, :], stack[rows, cols, :])
+    devolve float32 decodificado — com mediana/IQR aplicados se `stats` estiver definido."""
+
+    def __init__(self, hw, planes=None, names=None, stats=None):
+        self.hw = tuple(hw)
+        self.planes = list(planes or [])   # [(array 2D, escala ou None)]
+        self.names = list(names or [])
+        self.stats = stats
+
+    ndim = 3
+    @property
+    def shape(self): return self.hw + (len(self.planes),)
+    @property
+    def nbytes(self): return sum(a.nbytes for a, _ in self.planes)
+
+    @classmethod
+    def from_dense(cls, arr, names):
+        """Visões por plano de um cubo float32 (ex.: memmap do cache), sem cópia."""
+        return cls(arr.shape[:2], [(arr[..., j], None) for j in range(arr.shape[-1])], names)
+
+    def add(self, name, arr, kind='f32'):
+        """kind: 'f32' (guarda o array como está), 'nd' (int16 ×1e-4) ou 'f16'. `arr` pode ser sobrescrito.
+        'nd' com valores fora de ±3.2767 (bandas fora de [0,1] ou negativas) fica em float32 em vez de ser
+        cortado pelo int16. Devolve o tipo efetivamente usado."""
+        if kind == 'nd':
+            arr = np.asarray(arr, dtype=np.float32)
+            if arr.size and max(-float(arr.min()), float(arr.max())) > 32767 * ND_SCALE:
+                kind = 'f32'
+        if kind == 'nd':
+            np.multiply(arr, 1.0 / ND_SCALE, out=arr)
+            np.rint(arr, out=arr)
+            np.clip(arr, -32767, 32767, out=arr)
+            self.planes.append((arr.astype(np.int16), np.float32(ND_SCALE)))
+        elif kind == 'f16':
+            self.planes.append((arr.astype(np.float16), None))
+        else:
+            self.planes.append((np.asarray(arr, dtype=np.float32), None))
+        self.names.append(name)
+        return kind
+
+    def plane(self, j):
+        """Plano j inteiro decodificado (float32, sem stats)."""
+        a, scale = self.planes[j]
+        return a * scale if scale is not None else a.astype(np.float32, copy=False)
+
+    def select(self, names):
+        have = {n: j for j, n in enumerate(self.names)}
+        return FeatureStack(self.hw, [self.planes[have[n]] for n in names], names, self.stats)
+
+    def scaled(self, stats):
+        return FeatureStack(self.hw, self.planes, self.names, stats)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) == 3 and key[2] != slice(None):
+            raise IndexError("FeatureStack: só a seleção completa de features é suportada.")
+        spatial = key[:2]
+        n = len(self.planes)
+        first = self.planes[0][0][spatial]
+        out = np.empty(first.shape + (n,), dtype=np.float32)
+        for j, (a, scale) in enumerate(self.planes):
+            v = out[..., j]
+            v[...] = a[spatial]
+            if scale is not None: v *= scale
+            if self.stats is not None:
+                med, iqr = self.stats[j]
+                v -= med; v /= iqr
+        return out
+
+def stack_features(arr_bands, feedback=None, custom=None):
+    """Bandas + índices em um FeatureStack (cada índice vai direto para o seu plano, sem np.stack).
+    custom: {nome: expressão} de índices do usuário, avaliados no mesmo DAG após os do catálogo."""
+    first = next(iter(arr_bands.values()))
+    fs = FeatureStack(first.shape)
     # Bandas cruas
     for k in ['R','G','B','NIR','SWIR1','SWIR2']:
         if k in arr_bands:
-            feats.append(arr_bands[k]); names.append(k)
-    # Índices
-    idx_defs = available_indices(arr_bands.keys())
-    total = len(idx_defs)
-    for i, (nm, fn) in enumerate(idx_defs, start=1):
-        try:
-            if feedback:
-                feedback.setProgressText(f"Índice {nm} ({i}/{total})")
-                feedback.pushInfo(f"[Índice] Computando {nm}…")
-            feats.append(fn(arr_bands).astype(np.float32)); names.append(nm)
-        except Exception as e:
-            if feedback: feedback.pushInfo(f"[Índice] Falha em {nm}: {e}")
-    X = np.stack(feats, axis=-1).astype(np.float32)
-    if feedback: feedback.pushInfo(f"Bandas + Índices: {len(names)}")
-    return X, names
-
-def robust_fit_stats(X):
-    stats = []
-    r = X.reshape(-1, X.shape[-1])
-    for j in range(r.shape[1]):
-        col = r[:, j]; col = col[np.isfinite(col)]
-        if col.size == 0: stats.append((0.0, 1.0)); continue
-        q25, med, q75 = np.percentile(col, [25, 50, 75])
-        iqr = max(q75 - q25, 1e-6)
-        stats.append((float(med), float(iqr)))
-    return stats
+            fs.add(k, arr_bands[k])
+    # Índices: um só DAG (subtermos comuns avaliados uma vez); divisão por zero → 0
+    idx_names = available_index_names(arr_bands.keys())
+    formulas = {nm: INDEX_FORMULAS[nm] for nm in idx_names}
+    formulas.update(custom or {})
+    try:
+        plan = IndexPlan(formulas, division='zero')
+    except ValueError as e:
+        raise QgsProcessingException(str(e))
+    total = len(formulas)
+    if feedback: feedback.pushInfo(f"[Índice] {total} índices: {plan.n_ops} operações "
+                                   f"(sem reaproveitamento: {plan.n_ops_naive})")
+    for i, (nm, arr) in enumerate(plan.run(arr_bands), start=1):
+        check_canceled(feedback)
+        if feedback:
+            feedback.setProgressText(f"Índice {nm} ({i}/{total})")
+            feedback.pushInfo(f"[Índice] Computando {nm}…")
+        if nm in ND_INDICES and fs.add(nm, arr, 'nd') != 'nd' and feedback:
+            feedback.pushInfo(f"[Aviso] {nm} fora de ±3.2767 (bandas fora de [0,1]?): guardado em float32.")
+        elif nm not in ND_INDICES:
+            fs.add(nm, arr, 'f32')
+    if feedback: feedback.pushInfo(f"Bandas + Índices: {len(fs.names)}")
+    return fs, list(fs.names)
+
+class RobustStatsSketch:
+    """Estimador de quantis em fluxo (mediana/IQR por feature) por subamostra aleatória reprodutível.
+    Cada bloco mantém cada pixel com taxa fixa `target/total` (semente = (seed, id do bloco)), então
+    o resultado não depende da ordem dos blocos e sketches parciais se combinam por merge().
+    Erro de posto (DKW, 95%): |F̂ - F| ≤ sqrt(ln(2/0.05) / 2n); 0 quando todos os pixels entram."""
+
+    def __init__(self, n_features, total, target=1_000_000, seed=42):
+        self.n_features, self.total, self.seed = int(n_features), int(total), int(seed)
+        self.rate = min(1.0, float(target) / max(1, self.total))
+        self.parts = [[] for _ in range(self.n_features)]
+
+    def update(self, X, block_id):
+        flat = X.reshape(-1, X.shape[-1])
+        if self.rate < 1.0:
+            keep = np.random.default_rng((self.seed, int(block_id))).random(flat.shape[0]) < self.rate
+            flat = flat[keep]
+        for j in range(self.n_features):
+            col = flat[:, j]
+            self.parts[j].append(col[np.isfinite(col)].astype(np.float32, copy=False))
+        return self
+
+    def merge(self, other):
+        for j in range(self.n_features):
+            self.parts[j] += other.parts[j]
+        return self
+
+    def stats(self):
+        stats = []
+        for parts in self.parts:
+            col = np.concatenate(parts) if parts else np.empty(0, dtype=np.float32)
+            if col.size == 0: stats.append((0.0, 1.0)); continue
+            q25, med, q75 = np.percentile(col, [25, 50, 75])
+            iqr = max(q75 - q25, 1e-6)
+            stats.append((float(med), float(iqr)))
+        return stats
+
+    def error_meta(self, extra=None, partial=False):
+        """partial=True: os blocos vistos são só parte da cena (cota DKW nominal, pixels tratados como independentes)."""
+        n = min((sum(p.size for p in parts) for parts in self.parts), default=0)
+        exact = self.rate >= 1.0 and not partial
+        meta = {
+            "method": "exact" if exact else ("tile_subset" if partial else "subsample"),
+            "sample_rate": self.rate,
+            "n_min": int(n),
+            "rank_error": 0.0 if exact else float(np.sqrt(np.log(2 / 0.05) / (2 * max(n, 1)))),
+            "confidence": 0.95,
+        }
+        if extra: meta.update(extra)
+        return meta
+
+def robust_fit_stats(X, valid=None, rows_per_block=256, target=1_000_000, feedback=None):
+    """Mediana/IQR por feature percorrendo o cubo em faixas de linhas (sem cópia do cubo inteiro).
+    valid: máscara (linhas, colunas) dos pixels válidos — só eles entram, como no modo em blocos
+    (fit_stats_tiled), para que os dois modos ajustem o escalonamento sobre o mesmo conjunto de pixels.
+    Retorna (stats, info de erro para o _meta.json)."""
+    sk = RobustStatsSketch(X.shape[-1], int(np.prod(X.shape[:-1])), target=target)
+    if X.ndim == 2:
+        sk.update(X if valid is None else X[valid], 0)
+    else:
+        for k, r0 in enumerate(range(0, X.shape[0], rows_per_block)):
+            check_canceled(feedback)
+            blk = X[r0:r0 + rows_per_block]
+            sk.update(blk if valid is None else blk[valid[r0:r0 + rows_per_block]], k)
+            if feedback: feedback.setProgress(100.0 * min(r0 + rows_per_block, X.shape[0]) / X.shape[0])
+    return sk.stats(), sk.error_meta({"pixels": "all" if valid is None else "valid"})
 
 def robust_transform_inplace(X, stats):
     for j, (med, iqr) in enumerate(stats):
@@ -193,9 +293,41 @@ def robust_transform_inplace(X, stats):
 
 # ---------- Amostragem estratificada (PyQGIS puro) ----------
 
+def geom_triangles(geom: QgsGeometry):
+    """Triangulação Delaunay restrita do polígono (respeita buracos) → array (T, 3, 2); None se indisponível."""
+    try:
+        tri = geom.constrainedDelaunayTriangulation()
+    except Exception:
+        return None
+    if (tri is None) or tri.isEmpty():
+        return None
+    out = []
+    for part in tri.constParts():
+        v = [(p.x(), p.y()) for p in part.vertices()]
+        if len(v) >= 3: out.append(v[:3])
+    return np.asarray(out, dtype=np.float64) if out else None
+
+def random_points_in_triangles(tris: np.ndarray, n_points: int, rng):
+    """Amostragem uniforme exata: triângulo sorteado por área + coordenadas baricêntricas (vetorizado)."""
+    a, b, c = tris[:, 0], tris[:, 1], tris[:, 2]
+    area = 0.5 * np.abs((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1]))
+    if not np.isfinite(area).all() or area.sum() <= 0:
+        return []
+    k = rng.choice(len(tris), size=int(n_points), p=area / area.sum())
+    u, v = rng.random(int(n_points)), rng.random(int(n_points))
+    flip = (u + v) > 1.0
+    u[flip], v[flip] = 1.0 - u[flip], 1.0 - v[flip]
+    pts = a[k] + u[:, None] * (b[k] - a[k]) + v[:, None] * (c[k] - a[k])
+    return [(float(x), float(y)) for x, y in pts]
+
 def random_points_in_geom_qgs(union_geom: QgsGeometry, n_points: int, rng, max_tries=10000):
     if (union_geom is None) or union_geom.isEmpty():
         return []
+    tris = geom_triangles(union_geom)
+    if tris is not None:
+        pts = random_points_in_triangles(tris, n_points, rng)
+        if pts: return pts
+    # Fallback: rejeição no retângulo envolvente (sem triangulação disponível)
     bbox = union_geom.boundingBox()
     xmin, xmax = bbox.xMinimum(), bbox.xMaximum()
     ymin, ymax = bbox.yMinimum(), bbox.yMaximum()
@@ -260,9 +392,10 @@ def encode_labels(y):
 
 # ---------- Modelo e classificação ----------
 
-def train_rf(X, y, n_trees=300, max_feats='sqrt'):
+def train_rf(X, y, n_trees=300, max_feats='sqrt', min_leaf=None, n_jobs=-1, oob=True):
+    """min_leaf=None: 2 (até 2000 amostras) ou fração 0.0025."""
     n = X.shape[0]
-    min_leaf = 2 if n < 2000 else 0.0025
+    if min_leaf is None: min_leaf = 2 if n < 2000 else 0.0025
     clf = RandomForestClassifier(
         n_estimators=int(n_trees),
         criterion='gini',
@@ -271,54 +404,509 @@ def train_rf(X, y, n_trees=300, max_feats='sqrt'):
         min_impurity_decrease=1e-7,
         bootstrap=True,
         max_samples=0.6,
-        oob_score=True,
+        oob_score=oob,
         class_weight='balanced_subsample',
-        n_jobs=-1,
+        n_jobs=n_jobs,
+        random_state=42
+    )
+    clf.fit(X, y)
+    return clf
+
+# Tipos de modelo: (chave do enum, rótulo, model.kind no _meta.json)
+MODEL_KINDS = [('rf', 'Random Forest', 'rf_single'),
+               ('histgb', 'HistGradientBoosting', 'histgb'),
+               ('knn', 'kNN (subamostra)', 'knn')]
+KNN_MAX_SAMPLES = 20000
+
+def train_histgb(X, y, n_iter=300):
+    """Boosting por histogramas (features discretizadas em 255 bins): treino rápido com muitas amostras.
+    Pesos 'balanced' por amostra, como o class_weight do RF."""
+    clf = HistGradientBoostingClassifier(
+        max_iter=int(n_iter),
+        learning_rate=0.1,
+        max_leaf_nodes=31,
+        l2_regularization=1e-3,
+        early_stopping='auto',
         random_state=42
     )
+    clf.fit(X, y, sample_weight=compute_sample_weight('balanced', y))
+    return clf
+
+def train_knn(X, y, k=15, max_samples=KNN_MAX_SAMPLES):
+    """kNN (ponderado pela distância) sobre no máximo max_samples amostras sorteadas: o custo da
+    predição cresce com o tamanho da base de referência."""
+    if X.shape[0] > max_samples:
+        keep = np.sort(np.random.default_rng(42).choice(X.shape[0], max_samples, replace=False))
+        X, y = X[keep], y[keep]
+    clf = KNeighborsClassifier(n_neighbors=min(int(k), X.shape[0]), weights='distance', n_jobs=-1)
     clf.fit(X, y)
     return clf
 
-def classify_blockwise(stack, model, valid_mask, block=1024):
-    """0 = NoData; classes começam em 1 (offset aplicado aqui)."""
+def train_model(X, y, kind='rf', n_trees=300):
+    """n_trees = árvores (RF) ou iterações de boosting (HistGB); ignorado no kNN."""
+    if kind == 'histgb': return train_histgb(X, y, n_iter=n_trees)
+    if kind == 'knn': return train_knn(X, y)
+    return train_rf(X, y, n_trees=n_trees)
+
+def model_kind(model):
+    if isinstance(model, HistGradientBoostingClassifier): return 'histgb'
+    if isinstance(model, KNeighborsClassifier): return 'knn'
+    return 'rf_single'
+
+# ---------- Validação cruzada espacial / busca de hiperparâmetros ----------
+
+GRID_KEYS = {'trees': 'n_trees', 'n_trees': 'n_trees', 'max_features': 'max_features',
+             'mtry': 'max_features', 'min_samples_leaf': 'min_leaf', 'min_leaf': 'min_leaf'}
+
+def _grid_value(tok):
+    tok = tok.strip()
+    if tok.lower() == 'none': return None
+    for cast in (int, float):
+        try:
+            return cast(tok)
+        except ValueError:
+            pass
+    return tok
+
+def parse_grid(text):
+    """'trees=100,300; max_features=sqrt,0.33; min_samples_leaf=1,0.0025' → lista de combinações
+    {n_trees, max_feats, min_leaf}; parâmetros ausentes usam o padrão de train_rf."""
+    grid = {'n_trees': [300], 'max_features': ['sqrt'], 'min_leaf': [None]}
+    for part in (text or '').split(';'):
+        if not part.strip(): continue
+        k, _, vals = part.partition('=')
+        key = GRID_KEYS.get(k.strip().lower())
+        if key is None:
+            raise QgsProcessingException(f"Grade: parâmetro desconhecido '{k.strip()}' (use trees, max_features, min_samples_leaf).")
+        grid[key] = [_grid_value(v) for v in vals.split(',') if v.strip()]
+    return [{'n_trees': int(t), 'max_feats': m, 'min_leaf': l}
+            for t in grid['n_trees'] for m in grid['max_features'] for l in grid['min_leaf']]
+
+def sample_rowcol(ds, samples):
+    """Linha/coluna dos pontos dentro do raster, na mesma ordem das linhas de X dos amostradores."""
+    rc = [rowcol(ds.transform, x, yc, op=lambda z: int(np.floor(z))) for x, yc, _ in samples]
+    rc = [(r, c) for r, c in rc if 0 <= r < ds.height and 0 <= c < ds.width]
+    return np.array(rc, dtype=np.int64).reshape(-1, 2)
+
+def spatial_folds(rc, k, block=512, seed=42):
+    """k dobras por blocos espaciais de `block` px: amostras do mesmo bloco ficam na mesma dobra
+    (evita vazamento por autocorrelação). Blocos embaralhados e distribuídos, do maior para o menor,
+    na dobra com menos amostras."""
+    cells = rc // int(block)
+    _, cell_id, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cell_id = cell_id.reshape(-1)
+    if counts.size < k:
+        raise QgsProcessingException(f"Validação cruzada: só {counts.size} blocos espaciais para {k} dobras; reduza o bloco.")
+    perm = np.random.default_rng(seed).permutation(counts.size)
+    order = perm[np.argsort(-counts[perm], kind='stable')]
+    fold_of_cell, load = np.empty(counts.size, dtype=np.int32), np.zeros(k, dtype=np.int64)
+    for c in order:
+        f = int(np.argmin(load)); fold_of_cell[c] = f; load[f] += counts[c]
+    return fold_of_cell[cell_id]
+
+def cv_search(X, y, folds, combos, workers=1, feedback=None):
+    """Avalia cada combinação em cada dobra (tarefas independentes no pool de threads; RF com n_jobs=1).
+    Retorna os resultados ordenados por kappa médio (desempate: acurácia)."""
+    k = int(folds.max()) + 1
+    tasks = [(i, f) for i in range(len(combos)) for f in range(k)]
+    scores = {i: [] for i in range(len(combos))}
+
+    def work(t):
+        i, f = t
+        tr, te = folds != f, folds == f
+        t0 = time.perf_counter()
+        clf = train_rf(X[tr], y[tr], n_jobs=1, oob=False, **combos[i])
+        yhat = clf.predict(X[te])
+        return accuracy_score(y[te], yhat), cohen_kappa_score(y[te], yhat), time.perf_counter() - t0
+
+    done = [0]
+    def sink(t, res):
+        scores[t[0]].append(res)
+        done[0] += 1
+        if feedback: feedback.setProgressText(f"Validação cruzada {done[0]}/{len(tasks)}")
+
+    run_pipeline(tasks, work, sink, workers, feedback)
+    results = []
+    for i, c in enumerate(combos):
+        acc, kap, sec = (np.array(v, dtype=np.float64) for v in zip(*scores[i]))
+        results.append({"n_trees": c['n_trees'], "max_features": c['max_feats'], "min_samples_leaf": c['min_leaf'],
+                        "kappa_mean": float(np.nanmean(kap)), "kappa_std": float(np.nanstd(kap)),
+                        "acc_mean": float(acc.mean()), "acc_std": float(acc.std()), "fit_s": float(sec.sum())})
+    results.sort(key=lambda r: (-r["kappa_mean"], -r["acc_mean"]))
+    for rank, r in enumerate(results, start=1): r["rank"] = rank
+    return results
+
+def save_cv_table(base, results, feedback=None):
+    path = os.path.splitext(base)[0] + "_cv.csv"
+    cols = ["rank", "n_trees", "max_features", "min_samples_leaf", "kappa_mean", "kappa_std",
+            "acc_mean", "acc_std", "fit_s"]
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=cols, extrasaction='ignore')
+        w.writeheader(); w.writerows(results)
+    if feedback: feedback.pushInfo(f"[CV] Tabela salva em: {path}")
+    return path
+
+# ---------- Etapas: tempo, memória e cancelamento ----------
+
+def peak_rss_mb():
+    """Pico de memória residente do processo até agora (MB); None se indisponível."""
+    if resource is not None:
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return kb / 2**20 if sys.platform == 'darwin' else kb / 1024.0  # macOS: bytes
+    if psutil is not None:
+        mi = psutil.Process().memory_info()
+        return getattr(mi, 'peak_wset', mi.rss) / 2**20  # Windows: peak working set
+    return None
+
+class StageFeedback:
+    """Feedback do Processing com o progresso 0–100 da etapa mapeado para [p0, p1] da barra geral."""
+    def __init__(self, feedback, p0, p1):
+        self.feedback, self.p0, self.p1 = feedback, float(p0), float(p1)
+    def setProgress(self, x):
+        self.feedback.setProgress(self.p0 + (self.p1 - self.p0) * min(max(float(x), 0.0), 100.0) / 100.0)
+    def __getattr__(self, name):
+        return getattr(self.feedback, name)
+
+class StageTimer:
+    """Tempo de parede, pico de RSS e px/s por etapa do pipeline, informados no log ao fim de cada
+    etapa e acumulados em `stages` (gravados no _report.json). stage() checa o cancelamento na
+    entrada e devolve um StageFeedback para as funções da etapa."""
+    def __init__(self, feedback):
+        self.feedback, self.stages = feedback, []
+
+    @contextmanager
+    def stage(self, name, p0, p1, pixels=None):
+        check_canceled(self.feedback)
+        self.feedback.setProgressText(f"{name}…")
+        self.feedback.setProgress(int(p0))
+        t0 = time.perf_counter()
+        yield StageFeedback(self.feedback, p0, p1)
+        dt = time.perf_counter() - t0
+        rec = {"stage": name, "seconds": round(dt, 3)}
+        rss = peak_rss_mb()
+        if rss is not None: rec["peak_rss_mb"] = round(rss, 1)
+        if pixels: rec.update(pixels=int(pixels), px_per_s=round(pixels / max(dt, 1e-9), 1))
+        self.stages.append(rec)
+        msg = f"[Etapa] {name}: {dt:.1f}s"
+        if rss is not None: msg += f"; pico RSS {rss:.0f} MB"
+        if pixels: msg += f"; {rec['px_per_s'] / 1e6:.2f} Mpx/s"
+        self.feedback.pushInfo(msg)
+        self.feedback.setProgress(int(p1))
+
+class single_threaded_model:
+    """Estimador com n_jobs=1 enquanto o paralelismo é feito por blocos (evita oversubscription), devolvido
+    no `with ... as model`: cópia rasa (árvores/arrays compartilhados), o original nunca é alterado — o
+    mesmo modelo pode estar em uso por outras threads ou execuções (ModelRegistry).
+    Estimadores sem n_jobs (HistGB, OpenMP) ficam limitados a 1 thread via threadpoolctl; como o limite é
+    do processo, só o primeiro contexto aberto o aplica e só o último a fechar o restaura (lotes aninham
+    contextos em várias threads)."""
+    _lock = threading.Lock()
+    _depth, _limits = 0, None
+
+    def __init__(self, model, active=True):
+        self.model, self.active = model, active
+        self.omp = active and not hasattr(model, 'n_jobs') and threadpool_limits is not None
+    def __enter__(self):
+        if self.omp:
+            cls = single_threaded_model
+            with cls._lock:
+                if cls._depth == 0:
+                    cls._limits = threadpool_limits(limits=1, user_api='openmp')
+                cls._depth += 1
+        if self.active and getattr(self.model, 'n_jobs', 1) != 1:
+            model = copy.copy(self.model); model.n_jobs = 1
+            return model
+        return self.model
+    def __exit__(self, *exc):
+        if self.omp:
+            cls = single_threaded_model
+            with cls._lock:
+                cls._depth -= 1
+                if cls._depth == 0:
+                    cls._limits.restore_original_limits(); cls._limits = None
+        return False
+
+PROBA_NODATA = 255
+PROBA_BANDS = ('prob_max', 'margem_top1_top2', 'entropia_norm')
+
+def uncertainty_u8(P):
+    """P (n, K) → (3, n) uint8 em 0..254 (×1/254): prob. máxima, margem top1−top2, entropia de Shannon / log K."""
+    n, K = P.shape
+    if K > 1:
+        top2 = np.partition(P, K - 2, axis=1)[:, K - 2:]
+        pmax, margin = top2[:, 1], top2[:, 1] - top2[:, 0]
+        ent = -(P * np.log(np.where(P > 0, P, 1.0))).sum(axis=1) / np.log(K)
+    else:
+        pmax, margin, ent = P[:, 0], np.ones(n), np.zeros(n)
+    q = np.clip(np.stack([pmax, margin, ent]), 0.0, 1.0)
+    return np.rint(q * (PROBA_NODATA - 1)).astype(np.uint8)
+
+def proba_profile(profile):
+    prof = profile.copy()
+    prof.update(count=3, dtype='uint8', nodata=PROBA_NODATA)
+    return prof
+
+@contextmanager
+def open_proba(path, profile):
+    """Raster de probabilidade/incerteza (3 bandas uint8, COG com overviews average); None se não solicitado."""
+    if not path:
+        yield None
+        return
+    with cog_writer(path, proba_profile(profile), 'average', block=profile['blockxsize']) as dst:
+        dst.descriptions = PROBA_BANDS
+        dst.scales = (1.0 / (PROBA_NODATA - 1),) * 3
+        yield dst
+
+def _predict_block(model, blk, vm, proba=False):
+    """Rótulos uint16 (0 = NoData, classes 1..K). proba=True: também (3, h, w) uint8 de uncertainty_u8,
+    com a classe tirada do argmax das mesmas probabilidades (uma só passada pelo modelo)."""
+    h, w = blk.shape[0], blk.shape[1]
+    flat  = blk.reshape(-1, blk.shape[-1])
+    vflat = vm.reshape(-1)
+    preds = np.zeros(flat.shape[0], dtype=np.uint16)
+    q = np.full((3, flat.shape[0]), PROBA_NODATA, dtype=np.uint8) if proba else None
+    if vflat.any():
+        if proba:
+            P = model.predict_proba(flat[vflat])
+            yhat = np.asarray(model.classes_).take(np.argmax(P, axis=1)).astype(np.uint16)
+            q[:, vflat] = uncertainty_u8(P)
+        else:
+            yhat = model.predict(flat[vflat]).astype(np.uint16)  # 0..K-1
+        yhat += 1
+        preds[vflat] = yhat
+    preds = preds.reshape(h, w)
+    return (preds, q.reshape(3, h, w)) if proba else preds
+
+def classify_blockwise(stack, model, valid_mask, block=1024, workers=1, proba_ds=None, feedback=None):
+    """0 = NoData; classes começam em 1 (offset aplicado aqui).
+    proba_ds: dataset aberto (open_proba) que recebe as bandas de incerteza bloco a bloco."""
     nrows, ncols, nfeat = stack.shape
     out = np.zeros((nrows, ncols), dtype=np.uint16)
-    for r0 in range(0, nrows, block):
-        for c0 in range(0, ncols, block):
-            r1, c1 = min(r0 + block, nrows), min(c0 + block, ncols)
-            blk = stack[r0:r1, c0:c1, :]
-            vm  = valid_mask[r0:r1, c0:c1]
-            flat  = blk.reshape(-1, nfeat)
-            vflat = vm.reshape(-1)
-            preds = np.zeros(flat.shape[0], dtype=np.uint16)
-            if vflat.any():
-                yhat = model.predict(flat[vflat]).astype(np.uint16)  # 0..K-1
-                yhat += 1
-                preds[vflat] = yhat
-            out[r0:r1, c0:c1] = preds.reshape(blk.shape[0], blk.shape[1])
+    blocks = [(r0, c0) for r0 in range(0, nrows, block) for c0 in range(0, ncols, block)]
+    want_proba = proba_ds is not None
+    def work(rc):
+        r0, c0 = rc
+        r1, c1 = min(r0 + block, nrows), min(c0 + block, ncols)
+        return _predict_block(model, stack[r0:r1, c0:c1, :], valid_mask[r0:r1, c0:c1], want_proba)
+    def sink(rc, res):
+        r0, c0 = rc
+        preds, q = res if want_proba else (res, None)
+        out[r0:r0 + preds.shape[0], c0:c0 + preds.shape[1]] = preds
+        if q is not None:
+            proba_ds.write(q, window=Window(c0, r0, preds.shape[1], preds.shape[0]))
+    workers = min(workers, len(blocks))
+    with single_threaded_model(model, workers > 1) as model:
+        run_pipeline(blocks, work, sink, workers, feedback)
     return out
 
-def save_model_bundle(model, label_mapping, feat_names, stats, path_joblib, n_trees):
+class FlatForest:
+    """Random Forest achatado: os nós de todas as árvores em arrays NumPy contíguos
+    (feature, threshold, filhos, votos por folha). Carrega sem unpickling e ocupa menos disco que o
+    joblib; a predição percorre cada árvore nível a nível sobre o bloco inteiro de pixels, só com os
+    pares (pixel, nó) ainda não terminados. Mesmas regras do sklearn: X em float32, `x <= thr` vai à
+    esquerda, NaN segue missing_go_to_left, probabilidade = média das frações por folha."""
+
+    def __init__(self, feature, threshold, children, leaf_slot, leaf_value, nan_left, roots, classes, n_features):
+        self.feature, self.threshold, self.children = feature, threshold, children
+        self.leaf_slot, self.leaf_value, self.nan_left = leaf_slot, leaf_value, nan_left
+        self.roots, self.classes_ = roots, classes
+        self.n_features_in_ = int(n_features)
+
+    @classmethod
+    def from_sklearn(cls, rf):
+        feat, thr, ch, slot, vals, nanl, roots = [], [], [], [], [], [], []
+        off = n_leaves = 0
+        for est in rf.estimators_:
+            t = est.tree_
+            leaf = t.children_left == -1
+            ids = np.arange(t.node_count)
+            roots.append(off)
+            feat.append(np.where(leaf, 0, t.feature).astype(np.int32))
+            thr.append(t.threshold.astype(np.float64))
+            # filhos locais intercalados [esq, dir]; folha aponta para si mesma
+            ch.append(np.stack([np.where(leaf, ids, t.children_left),
+                                np.where(leaf, ids, t.children_right)], axis=1).astype(np.int32))
+            s = np.full(t.node_count, -1, dtype=np.int32)
+            s[leaf] = np.arange(n_leaves, n_leaves + leaf.sum())
+            slot.append(s); n_leaves += int(leaf.sum())
+            v = t.value[leaf, 0, :].astype(np.float64)
+            norm = v.sum(axis=1, keepdims=True); norm[norm == 0] = 1.0
+            vals.append(v / norm)
+            mgl = getattr(t, 'missing_go_to_left', None)
+            nanl.append(np.asarray(mgl, dtype=bool) if mgl is not None else np.zeros(t.node_count, dtype=bool))
+            off += t.node_count
+        c = np.concatenate
+        return cls(c(feat), c(thr), c(ch), c(slot), c(vals), c(nanl),
+                   np.array(roots + [off], dtype=np.int64), np.asarray(rf.classes_), rf.n_features_in_)
+
+    def save(self, path):
+        np.savez(path, feature=self.feature, threshold=self.threshold, children=self.children,
+                 leaf_slot=self.leaf_slot, leaf_value=self.leaf_value, nan_left=self.nan_left,
+                 roots=self.roots, classes=self.classes_, n_features=np.int64(self.n_features_in_))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as z:
+            return cls(z['feature'], z['threshold'], z['children'], z['leaf_slot'], z['leaf_value'],
+                       z['nan_left'], z['roots'], z['classes'], z['n_features'])
+
+    def predict_proba(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n, nf = X.shape
+        if nf != self.n_features_in_:
+            raise ValueError(f"X tem {nf} features; o modelo espera {self.n_features_in_}.")
+        Xf = X.ravel()
+        base = np.arange(n, dtype=np.int64) * nf
+        out = np.zeros((n, self.leaf_value.shape[1]), dtype=np.float64)
+        n_trees = self.roots.size - 1
+        for k in range(n_trees):
+            a, b = int(self.roots[k]), int(self.roots[k + 1])
+            feat, thr = self.feature[a:b], self.threshold[a:b]
+            ch, nanl, slot = self.children[a:b].ravel(), self.nan_left[a:b], self.leaf_slot[a:b]
+            node = np.zeros(n, dtype=np.int32)
+            act = np.arange(n)
+            while act.size:
+                nd = node[act]
+                xv = np.take(Xf, base[act] + np.take(feat, nd))
+                right = xv > np.take(thr, nd)
+                nan = np.isnan(xv)
+                if nan.any(): right[nan] = ~np.take(nanl, nd[nan])
+                nd = np.take(ch, 2 * nd + right)
+                node[act] = nd
+                act = act[np.take(slot, nd) < 0]
+            out += np.take(self.leaf_value, np.take(slot, node), axis=0)
+        return out / max(n_trees, 1)
+
+    def predict(self, X):
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+def save_model_bundle(model, label_mapping, feat_names, stats, path_joblib, n_trees, stats_info=None, custom=None,
+                      flat=False):
+    """flat=True: exporta também o RF achatado (_flat.npz). É opcional: a inferência padrão é a do sklearn,
+    mais rápida; o _flat.npz serve para carga sem unpickling (menor, sem depender da versão do sklearn)."""
     dump(model, path_joblib)
+    base = os.path.splitext(path_joblib)[0]
+    model_meta = {"kind": model_kind(model), "n_estimators": int(n_trees), "oob_score": getattr(model, "oob_score_", None)}
+    if isinstance(model, HistGradientBoostingClassifier): model_meta["n_iter"] = int(model.n_iter_)
+    if isinstance(model, KNeighborsClassifier):
+        model_meta.update(n_estimators=None, n_neighbors=int(model.n_neighbors), n_reference=int(model.n_samples_fit_))
+    if flat and isinstance(model, RandomForestClassifier):
+        flat_path = FlatForest.from_sklearn(model).save(base + "_flat.npz")
+        model_meta["flat"] = os.path.basename(flat_path)
     meta = {
         "label_mapping": label_mapping,  # {label->code0}
         "feature_names": feat_names,
-        "scaler": {"type": "robust", "stats": stats},
-        "model": {"kind": "rf_single", "n_estimators": int(n_trees), "oob_score": getattr(model, "oob_score_", None)},
+        "custom_indices": dict(custom or {}),  # {nome: expressão}; recalculados na inferência
+        "scaler": {"type": "robust", "stats": stats, "estimator": stats_info},
+        "model": model_meta,
         "raster_output_codes": {"nodata": 0, "classes_start_at": 1}
     }
-    meta_path = os.path.splitext(path_joblib)[0] + "_meta.json"
+    meta_path = base + "_meta.json"
     with open(meta_path, 'w', encoding='utf-8') as f:
         json.dump(meta, f, ensure_ascii=False, indent=2)
     return meta_path
 
-def load_model_bundle(path_joblib):
-    model = load(path_joblib)
+def bundle_files(path_joblib):
+    """Arquivos que compõem o bundle: joblib, _meta.json e, se houver, _flat.npz."""
+    base = os.path.splitext(path_joblib)[0]
+    files = [path_joblib, base + "_meta.json"]
+    if os.path.exists(base + "_flat.npz"): files.append(base + "_flat.npz")
+    return files
+
+def load_model_bundle(path_joblib, flat=False, mmap=False):
+    """flat=True: usa o FlatForest (_flat.npz) quando o bundle o tiver, sem carregar o joblib.
+    mmap=True: joblib com mmap_mode='r' (arrays lidos sob demanda do arquivo, sem cópia na carga)."""
     meta_path = os.path.splitext(path_joblib)[0] + "_meta.json"
     if not os.path.exists(meta_path):
         raise QgsProcessingException("Meta JSON do modelo não encontrado.")
     with open(meta_path, 'r', encoding='utf-8') as f:
         meta = json.load(f)
+    flat_name = meta.get("model", {}).get("flat")
+    flat_path = os.path.join(os.path.dirname(path_joblib), flat_name) if flat_name else None
+    if flat and flat_path and os.path.exists(flat_path):
+        return FlatForest.load(flat_path), meta
+    model = load(path_joblib, mmap_mode='r' if mmap else None)
+    return model, meta
+
+class ModelRegistry:
+    """Cache LRU, no processo, de bundles já carregados, indexados pelo hash do conteúdo dos arquivos
+    (joblib + _meta.json + _flat.npz): o mesmo modelo copiado/renomeado reaproveita a entrada e um
+    arquivo regravado no mesmo caminho gera outra. O hash é memorizado por (caminho, mtime, tamanho),
+    então uma reexecução só faz stat() dos arquivos. O tamanho em memória é estimado pelo tamanho dos
+    arquivos; entradas menos recentes saem até caber em max_bytes (a última carregada sempre fica).
+    Execuções concorrentes podem pedir o mesmo modelo: cada chamada recebe uma cópia rasa do estimador
+    (árvores/arrays compartilhados, somente leitura) e do meta, então mudar atributos de um não afeta os outros."""
+
+    def __init__(self, max_bytes=2 * 1024**3):
+        self.max_bytes = int(max_bytes)
+        self._items = OrderedDict()   # chave -> (modelo, meta, bytes)
+        self._digests = {}            # (caminho, mtime, tamanho) -> hash
+        self._lock = threading.Lock()
+
+    def file_hash(self, path, chunk=1 << 20):
+        st = os.stat(path)
+        ident = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+        with self._lock:
+            digest = self._digests.get(ident)
+        if digest is None:
+            h = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for buf in iter(lambda: f.read(chunk), b''):
+                    h.update(buf)
+            digest = h.hexdigest()
+            with self._lock:
+                self._digests[ident] = digest
+        return digest
+
+    def bundle_hash(self, path_joblib):
+        h = hashlib.blake2b(digest_size=16)
+        for f in bundle_files(path_joblib):
+            if os.path.exists(f): h.update(self.file_hash(f).encode('ascii'))
+        return h.hexdigest()
+
+    def get(self, path_joblib, flat=False, mmap=False, max_bytes=None):
+        """(modelo, meta, hash, reaproveitado?); modelo e meta são cópias próprias de quem chamou.
+        max_bytes: limite só desta chamada (None = self.max_bytes; 0 = não usa o cache), aplicado na hora,
+        sem alterar o limite do registro visto pelas outras execuções."""
+        limit = self.max_bytes if max_bytes is None else int(max_bytes)
+        digest = self.bundle_hash(path_joblib)
+        key = (digest, bool(flat), bool(mmap))
+        if limit > 0:
+            with self._lock:
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    model, meta, _ = self._items[key]
+                    self._trim(limit)
+                    return copy.copy(model), copy.deepcopy(meta), digest, True
+        model, meta = load_model_bundle(path_joblib, flat=flat, mmap=mmap)
+        size = sum(os.path.getsize(f) for f in bundle_files(path_joblib) if os.path.exists(f))
+        if limit > 0:
+            with self._lock:
+                self._items[key] = (model, meta, size)
+                self._items.move_to_end(key)
+                self._trim(limit)
+        return copy.copy(model), copy.deepcopy(meta), digest, False
+
+    def _trim(self, limit):
+        """Remove as entradas menos recentes até caber em `limit` (a mais recente sempre fica). Sob _lock."""
+        while len(self._items) > 1 and sum(v[2] for v in self._items.values()) > limit:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+# Registro compartilhado pela sessão do QGIS (todas as execuções do algoritmo)
+MODEL_REGISTRY = ModelRegistry()
+
+def cached_model_bundle(path_joblib, flat=False, mmap=False, max_bytes=None, feedback=None):
+    """load_model_bundle via MODEL_REGISTRY; max_bytes (se dado) é o limite desta execução."""
+    t0 = time.perf_counter()
+    model, meta, digest, hit = MODEL_REGISTRY.get(path_joblib, flat=flat, mmap=mmap, max_bytes=max_bytes)
+    if feedback:
+        how = "reaproveitado do cache" if hit else "carregado do disco"
+        feedback.pushInfo(f"[Modelo] {how} em {time.perf_counter() - t0:.2f}s (hash {digest[:12]})")
     return model, meta
 
 # ---------- Pós-processamento (remoção de manchas pequenas) ----------
@@ -336,37 +924,130 @@ def _parse_int_list_csv(s, name):
     except Exception:
         raise QgsProcessingException(f"{name} deve ser CSV de inteiros.")
 
+def mode_at(arr, radius, where, ignore_zero=True, strip=512, feedback=None):
+    """Moda em janela (2r+1)² (borda 'nearest') avaliada só nos pixels de `where`.
+    Contagens por classe via imagem integral de cada plano de classe; argmax com empate → menor classe.
+    Processa faixas de linhas que contêm pixels de `where` (memória ∝ faixa, não cena)."""
+    r = int(radius); size = 2*r + 1
+    rows, cols = np.nonzero(where)
+    res = np.zeros(rows.size, dtype=arr.dtype)
+    if rows.size == 0: return res
+    pad = np.pad(arr, r, mode='edge')
+    for s0 in range(int(rows.min()), int(rows.max()) + 1, strip):
+        check_canceled(feedback)
+        sel = np.flatnonzero((rows >= s0) & (rows < s0 + strip))
+        if sel.size == 0: continue
+        s1 = min(s0 + strip, arr.shape[0])
+        sub = pad[s0:s1 + 2*r]  # linhas s0-r .. s1+r do original
+        ri, ci = rows[sel] - s0, cols[sel]
+        best_cnt = np.zeros(sel.size, dtype=np.int32)
+        best_cls = np.zeros(sel.size, dtype=arr.dtype)
+        ii = np.zeros((sub.shape[0] + 1, sub.shape[1] + 1), dtype=np.int32)
+        for k in np.unique(sub):
+            if ignore_zero and k == 0: continue
+            ii[1:, 1:] = (sub == k)
+            np.cumsum(ii, axis=0, out=ii)
+            np.cumsum(ii, axis=1, out=ii)
+            cnt = ii[ri + size, ci + size] - ii[ri, ci + size] - ii[ri + size, ci] + ii[ri, ci]
+            upd = cnt > best_cnt
+            best_cnt[upd] = cnt[upd]; best_cls[upd] = k
+        res[sel] = best_cls
+    return res
+
 def mode_filter(arr, radius, ignore_zero=True):
-    size = 2*int(radius) + 1
-    footprint = np.ones((size, size), dtype=bool)
-    def _mode(win):
-        win = win.astype(np.int32)
-        if ignore_zero: win = win[win != 0]
-        if win.size == 0: return 0
-        return np.bincount(win).argmax()
-    return ndi.generic_filter(arr, _mode, footprint=footprint, mode='nearest')
-
-def remove_small_patches(ymap, min_size, exclude, mode_radius, ignore_zero=True, connectivity=2):
+    return mode_at(arr, radius, np.ones(arr.shape, dtype=bool), ignore_zero=ignore_zero).reshape(arr.shape)
+
+class RunLabeler:
+    """Componentes conexos de todas as classes numa única passada, sobre runs (RLE) de cada linha.
+    Runs vizinhos (linhas adjacentes, mesma classe ≠ 0) viram arestas de um grafo de runs resolvido
+    por connected_components. Faixas de linhas são adicionadas em sequência com add(); a costura
+    entre faixas é ligada como qualquer outro par de linhas. Memória ∝ nº de runs."""
+
+    def __init__(self, width, connectivity=2):
+        self.width = int(width)
+        self.diag = 0 if connectivity == 1 else 1
+        self.nrows = 0
+        self._row, self._col, self._len, self._val, self._src, self._dst = [], [], [], [], [], []
+        self._n = 0
+        self._last = None  # runs da última linha já adicionada (para a costura)
+
+    def add(self, block):
+        h, w = block.shape
+        change = np.ones((h, w), dtype=bool)
+        change[:, 1:] = block[:, 1:] != block[:, :-1]
+        starts = np.flatnonzero(change)
+        row = (starts // w).astype(np.int32); col = (starts % w).astype(np.int32)
+        length = (np.append(starts[1:], h * w) - starts).astype(np.int32)
+        val = block.ravel()[starts]
+        ids = np.arange(self._n, self._n + starts.size, dtype=np.int64)
+
+        # Ligações entre linhas adjacentes (inclui a costura com a faixa anterior, linha -1)
+        if self._last is not None:
+            lid, lcol, llen, lval = self._last
+            l_row = np.concatenate([np.full(lid.size, -1, dtype=np.int32), row])
+            l_col = np.concatenate([lcol, col]); l_len = np.concatenate([llen, length])
+            l_val = np.concatenate([lval, val]); l_ids = np.concatenate([lid, ids])
+        else:
+            l_row, l_col, l_len, l_val, l_ids = row, col, length, val, ids
+        key = (l_row.astype(np.int64) + 1) * w + l_col
+        last_row = l_row.max()
+        i = np.flatnonzero((l_row < last_row) & (l_val != 0))
+        x0 = np.maximum(l_col[i] - self.diag, 0)
+        x1 = np.minimum(l_col[i] + l_len[i] - 1 + self.diag, w - 1)
+        nxt = (l_row[i].astype(np.int64) + 2) * w
+        j0 = np.searchsorted(key, nxt + x0, side='right') - 1
+        j1 = np.searchsorted(key, nxt + x1, side='right') - 1
+        cnt = j1 - j0 + 1
+        ii = np.repeat(i, cnt)
+        jj = np.repeat(j0, cnt) + (np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt))
+        same = l_val[ii] == l_val[jj]
+        self._src.append(l_ids[ii[same]]); self._dst.append(l_ids[jj[same]])
+
+        self._row.append(row + self.nrows); self._col.append(col)
+        self._len.append(length); self._val.append(val)
+        tail = row == h - 1
+        self._last = (ids[tail], col[tail], length[tail], val[tail])
+        self._n += starts.size
+        self.nrows += h
+
+    def finish(self):
+        """Resolve o grafo; define run_row/run_col/run_len/run_val, comp (por run) e sizes (por componente)."""
+        self.run_row = np.concatenate(self._row); self.run_col = np.concatenate(self._col)
+        self.run_len = np.concatenate(self._len); self.run_val = np.concatenate(self._val)
+        src = np.concatenate(self._src); dst = np.concatenate(self._dst)
+        g = coo_matrix((np.ones(src.size, dtype=np.int8), (src, dst)), shape=(self._n, self._n))
+        _, self.comp = connected_components(g, directed=False)
+        self.sizes = np.bincount(self.comp, weights=self.run_len).astype(np.int64)
+        self._row = self._col = self._len = self._val = self._src = self._dst = None
+        return self
+
+    def small_runs(self, min_size, exclude):
+        """Máscara por run: componente < min_size, classe ≠ 0 e fora de `exclude`."""
+        small = self.sizes[self.comp] < int(min_size)
+        small &= self.run_val != 0
+        if exclude: small &= ~np.isin(self.run_val, list(exclude))
+        return small
+
+    def rows_mask(self, run_mask, r0, r1):
+        """Expande uma máscara por run para as linhas [r0, r1) (largura inteira)."""
+        a, b = np.searchsorted(self.run_row, [r0, r1], side='left')
+        return np.repeat(run_mask[a:b], self.run_len[a:b]).reshape(r1 - r0, self.width)
+
+def remove_small_patches(ymap, min_size, exclude, mode_radius, ignore_zero=True, connectivity=2, feedback=None):
     if min_size <= 0: return ymap
-    mode_map = mode_filter(ymap, mode_radius, ignore_zero=ignore_zero)
+    lab = RunLabeler(ymap.shape[1], connectivity)
+    lab.add(ymap)
+    lab.finish()
+    small_all = lab.rows_mask(lab.small_runs(min_size, exclude), 0, ymap.shape[0])
     out = ymap.copy()
-    structure = np.ones((3,3), dtype=np.uint8) if connectivity != 1 else np.array([[0,1,0],[1,1,1],[0,1,0]], dtype=np.uint8)
-    classes = np.unique(ymap); classes = classes[(classes != 0)]
-    for k in classes:
-        if k in exclude: continue
-        mask = (ymap == k)
-        if not mask.any(): continue
-        labels, nlab = ndi.label(mask, structure=structure)
-        if nlab == 0: continue
-        sizes = np.bincount(labels.ravel())
-        small = sizes < int(min_size); small[0] = False
-        small_mask = small[labels]
-        out[small_mask] = mode_map[small_mask]
+    if small_all.any():
+        out[small_all] = mode_at(ymap, mode_radius, small_all, ignore_zero=ignore_zero, feedback=feedback)
     return out
 
 # ---------- Entropia ----------
 
-def _to_u8_band_auto(a: np.ndarray) -> np.ndarray:
+def _u8_scaling(a: np.ndarray):
+    """(offset, ganho) da conversão banda → u8; mesma regra de _to_u8_band_auto."""
     a = a.astype(np.float32)
     finite = np.isfinite(a)
     if finite.any():
@@ -374,62 +1055,512 @@ def _to_u8_band_auto(a: np.ndarray) -> np.ndarray:
     else:
         amin, amax = 0.0, 1.0
     if amin >= -0.2 and amax <= 1.2:
-        u = a * 255.0
-    else:
-        p2, p98 = np.nanpercentile(a[finite], [2, 98]) if finite.any() else (0.0, 1.0)
-        if not np.isfinite(p2) or not np.isfinite(p98) or p98 <= p2:
-            p2, p98 = amin, max(amin + 1.0, amax)
-        u = (a - p2) * (255.0 / max(p98 - p2, 1e-6))
+        return 0.0, 255.0
+    p2, p98 = np.nanpercentile(a[finite], [2, 98]) if finite.any() else (0.0, 1.0)
+    if not np.isfinite(p2) or not np.isfinite(p98) or p98 <= p2:
+        p2, p98 = amin, max(amin + 1.0, amax)
+    return float(p2), float(255.0 / max(p98 - p2, 1e-6))
+
+def _to_u8_band_auto(a: np.ndarray, scaling=None) -> np.ndarray:
+    off, gain = scaling if scaling is not None else _u8_scaling(a)
+    u = (a.astype(np.float32) - off) * gain
     return np.clip(u, 0, 255).astype(np.uint8)
 
 def _to_u8_index(a: np.ndarray) -> np.ndarray:
     u = (a + 1.0) * 127.5
     return np.clip(u, 0, 255).astype(np.uint8)
 
+def _box_sum(mask: np.ndarray, r: int) -> np.ndarray:
+    """Soma em janela (2r+1)² via imagem integral; fora da imagem conta 0 (janela truncada)."""
+    h, w = mask.shape
+    size = 2*r + 1
+    dt = np.int32 if (h + size) * (w + size) < 2**31 else np.int64
+    ii = np.zeros((h + size, w + size), dtype=dt)
+    ii[r + 1:r + 1 + h, r + 1:r + 1 + w] = mask
+    np.cumsum(ii, axis=0, out=ii)
+    np.cumsum(ii, axis=1, out=ii)
+    return ii[size:, size:] - ii[:-size, size:] - ii[size:, :-size] + ii[:-size, :-size]
+
+def entropy_u8_numpy(u8: np.ndarray, radius: int) -> np.ndarray:
+    """Entropia local (bits) em janela quadrada, equivalente a skimage.filters.rank.entropy.
+    H = log2(n) - Σ c·log2(c) / n, com contagens c por valor obtidas por somas em janela;
+    custo O(pixels × valores distintos), sem callback Python por pixel."""
+    r = int(radius)
+    u8 = np.asarray(u8, dtype=np.uint8)
+    n = _box_sum(np.ones(u8.shape, dtype=bool), r).astype(np.float64)
+    area = (2*r + 1) ** 2
+    c = np.arange(area + 1, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        clogc = np.where(c > 0, c * np.log2(c), 0.0)
+    acc = np.zeros(u8.shape, dtype=np.float64)
+    for v in np.flatnonzero(np.bincount(u8.ravel(), minlength=256)):
+        acc += clogc[_box_sum(u8 == v, r)]
+    return (np.log2(n) - acc / n).astype(np.float32)
+
 def _entropy_u8(u8: np.ndarray, radius: int) -> np.ndarray:
     r = int(radius)
     if _HAS_SKIMAGE_RANK:
         return sk_entropy(u8, sk_square(2*r + 1)).astype(np.float32)
-    size = 2*r + 1
-    footprint = np.ones((size, size), dtype=bool)
-    def _ent(win):
-        m = np.isfinite(win)
-        if not m.any(): return 0.0
-        w = np.rint(win[m]).astype(np.int64, copy=False)
-        w = np.clip(w, 0, 255)
-        cnt = np.bincount(w, minlength=256).astype(np.float32)
-        s = float(cnt.sum())
-        if s <= 0.0: return 0.0
-        p = cnt / s
-        p = p[p > 0]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            return float(-(p * np.log2(p)).sum())
-    return ndi.generic_filter(u8, _ent, footprint=footprint, mode='nearest').astype(np.float32)
-
-def append_entropy_features_from_stack(stack: np.ndarray, names: list, radius: int,
-                                       on_bands: bool, on_indices: bool, feedback=None):
+    return entropy_u8_numpy(u8, r)
+
+def append_entropy_features_from_stack(stack: FeatureStack, names: list, radius: int,
+                                       on_bands: bool, on_indices: bool, feedback=None,
+                                       u8_scaling=None):
+    """Acrescenta ENT_* (float16) ao próprio FeatureStack.
+    u8_scaling: {banda: (offset, ganho)} fixo (modo em blocos); None = calculado no próprio array."""
     base = {'R','G','B','NIR','SWIR1','SWIR2'}
     idxs = [j for j,nm in enumerate(names)
             if ((nm in base and on_bands) or (nm not in base and on_indices))]
-    ent_feats, ent_names = [], []
     total = len(idxs)
     for k, j in enumerate(idxs, start=1):
+        check_canceled(feedback)
         nm = names[j]
-        arr = stack[..., j]
-        u8 = _to_u8_band_auto(arr) if nm in base else _to_u8_index(arr)
+        arr = stack.plane(j)
+        if nm in base:
+            u8 = _to_u8_band_auto(arr, (u8_scaling or {}).get(nm))
+        else:
+            u8 = _to_u8_index(arr)
         if feedback:
             feedback.setProgressText(f"Entropia {nm} ({k}/{total})")
             feedback.pushInfo(f"[Entropia] {nm}…")
-        ent = _entropy_u8(u8, radius)
-        ent_feats.append(ent); ent_names.append(f'ENT_{nm}')
-    if ent_feats:
-        ent_stack = np.stack(ent_feats, axis=-1).astype(np.float32)
-        stack = np.concatenate([stack, ent_stack], axis=-1)
-        names = names + ent_names
-        feedback.pushInfo(f"Bandas + Índices + Entropia: {len(names)}")
-    return stack, names
+        stack.add(f'ENT_{nm}', _entropy_u8(u8, radius), 'f16')
+    if total and feedback: feedback.pushInfo(f"Bandas + Índices + Entropia: {len(stack.names)}")
+    return stack, list(stack.names)
+
+# ---------- Modo em blocos (janelas rasterio) ----------
+
+def aligned_tile_size(ds, tile):
+    """Arredonda o tamanho do bloco para múltiplo do bloco nativo (quando o raster é tiled)."""
+    tile = int(tile)
+    bh, bw = ds.block_shapes[0] if ds.block_shapes else (1, ds.width)
+    if bh == bw and 1 < bh < ds.width:
+        tile = max(bh, (tile // bh) * bh)
+    return tile
+
+def tiled_profile(ds, tile=None):
+    """Perfil do raster de classes (uint16, 0 = NoData, GeoTIFF tiled com blocos alinhados ao passo `tile`)."""
+    return cog_profile(ds.profile, block=block_for(tile), count=1, dtype='uint16', nodata=0)
+
+def feature_order(names, want):
+    """Posições das features exigidas pelo modelo (`want`) entre as calculadas (`names`)."""
+    have = {n: i for i, n in enumerate(names)}
+    missing = [n for n in want if n not in have]
+    if missing:
+        raise QgsProcessingException(f"Features exigidas pelo modelo ausentes: {missing}")
+    return [have[n] for n in want]
+
+# ---------- Cache de features em disco ----------
+
+class FeatureCacheEntry:
+    """Cubo (linhas, colunas, features) float32 + máscara válida em .npy mapeados em memória."""
+    def __init__(self, path, names, mode):
+        self.path, self.names = path, list(names)
+        self.features = np.load(os.path.join(path, 'features.npy'), mmap_mode=mode)
+        self.valid = np.load(os.path.join(path, 'valid.npy'), mmap_mode=mode)
+        self.complete = mode == 'r'
+
+    def read(self, window):
+        rs = slice(window.row_off, window.row_off + window.height)
+        cs = slice(window.col_off, window.col_off + window.width)
+        return np.array(self.features[rs, cs]), np.array(self.valid[rs, cs])
+
+    def write(self, window, stack, valid):
+        rs = slice(window.row_off, window.row_off + window.height)
+        cs = slice(window.col_off, window.col_off + window.width)
+        self.features[rs, cs] = stack; self.valid[rs, cs] = valid
+
+    def mark_complete(self):
+        self.features.flush(); self.valid.flush()
+        with open(os.path.join(self.path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        meta['complete'] = True
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        self.complete = True
+
+class FeatureCache:
+    """Cache LRU de features por raster: chave = caminho + mtime + tamanho do arquivo, BANDMAP,
+    configuração de entropia e modo (memória/blocos). O uso é registrado no mtime do meta.json;
+    ao criar uma entrada, as menos recentes são removidas até caber em max_bytes."""
+    VERSION = 1
+
+    def __init__(self, root, max_bytes):
+        self.root, self.max_bytes = root, int(max_bytes)
+        os.makedirs(root, exist_ok=True)
+
+    @classmethod
+    def key(cls, src_path, bandmap, ent_cfg, mode, custom=None):
+        st = os.stat(src_path)
+        ident = {"v": cls.VERSION, "path": os.path.abspath(src_path), "mtime": st.st_mtime_ns,
+                 "size": st.st_size, "bandmap": sorted(bandmap.items()), "ent": list(ent_cfg), "mode": mode}
+        if custom: ident["custom"] = sorted(custom.items())
+        return hashlib.sha1(json.dumps(ident, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entries(self):
+        out = []
+        for k in os.listdir(self.root):
+            meta = os.path.join(self.root, k, 'meta.json')
+            if os.path.exists(meta):
+                size = sum(os.path.getsize(os.path.join(self.root, k, f)) for f in os.listdir(os.path.join(self.root, k)))
+                out.append((os.path.getmtime(meta), k, size))
+        return sorted(out)
+
+    def lookup(self, key):
+        """Entrada completa (somente leitura) ou None; marca como usada."""
+        meta_path = os.path.join(self.root, key, 'meta.json')
+        if not os.path.exists(meta_path): return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if not meta.get('complete'): return None
+        os.utime(meta_path, None)
+        return FeatureCacheEntry(os.path.join(self.root, key), meta['names'], 'r')
+
+    def create(self, key, shape, names):
+        """Nova entrada gravável (r+); despeja entradas antigas para caber no limite."""
+        need = int(np.prod(shape)) * 4 + int(np.prod(shape[:2]))
+        if need > self.max_bytes: return None
+        used = 0
+        for _, k, size in self._entries():
+            if k != key: used += size
+        for _, k, size in self._entries():
+            if used + need <= self.max_bytes: break
+            if k == key: continue
+            shutil.rmtree(os.path.join(self.root, k), ignore_errors=True); used -= size
+        path = os.path.join(self.root, key)
+        shutil.rmtree(path, ignore_errors=True); os.makedirs(path)
+        np.lib.format.open_memmap(os.path.join(path, 'features.npy'), mode='w+', dtype=np.float32, shape=tuple(shape)).flush()
+        np.lib.format.open_memmap(os.path.join(path, 'valid.npy'), mode='w+', dtype=bool, shape=tuple(shape[:2])).flush()
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({"names": list(names), "shape": list(shape), "complete": False,
+                       "created": time.strftime('%Y-%m-%d %H:%M:%S')}, f, ensure_ascii=False, indent=2)
+        return FeatureCacheEntry(path, names, 'r+')
+
+def band_u8_scaling(ds, bandmap, max_side=2048):
+    """Escala u8 global por banda a partir de leitura decimada (entropia consistente entre blocos).
+    Exata só até max_side px de lado; acima, mínimo/máximo vêm da leitura decimada (aproximação)."""
+    f = min(1.0, float(max_side) / max(ds.width, ds.height))
+    shape = (max(1, int(round(ds.height * f))), max(1, int(round(ds.width * f))))
+    B, _ = read_bands(ds, bandmap, out_shape=shape)
+    return {k: _u8_scaling(v) for k, v in B.items()}
+
+def window_features(ds, bandmap, window, ent_cfg, u8_scaling, out_shape=None, custom=None):
+    """Bandas + índices (+ entropia) de uma janela. ent_cfg = (raio, em_bandas, em_indices)."""
+    B, valid = read_bands(ds, bandmap, window=window, out_shape=out_shape)
+    if not B: raise QgsProcessingException("BANDMAP não corresponde a bandas existentes.")
+    stack, names = stack_features(B, custom=custom)
+    ent_radius, ent_on_bands, ent_on_indices = ent_cfg
+    if ent_radius and (ent_on_bands or ent_on_indices):
+        stack, names = append_entropy_features_from_stack(
+            stack, names, ent_radius, ent_on_bands, ent_on_indices, u8_scaling=u8_scaling
+        )
+    return stack[:, :, :], names, valid
+
+def fit_stats_tiled(ds, bandmap, ent_cfg, u8_scaling, tile, max_tiles=16, target=1_000_000, workers=1,
+                    cache=None, feedback=None, custom=None):
+    """Escalonamento robusto no modo em blocos: features em resolução total de até `max_tiles` blocos
+    sorteados (semente fixa) alimentam um RobustStatsSketch. Retorna (stats, info de erro).
+    Só pixels válidos entram, como em robust_fit_stats(stack, valid). Igual ao modo em memória só quando
+    todos os blocos entram (≤ max_tiles) e o sketch guarda todos os pixels (cena ≤ target); fora disso é
+    uma estimativa, com o erro de posto registrado em "estimator"."""
+    halo = int(ent_cfg[0]) if (ent_cfg[1] or ent_cfg[2]) else 0
+    windows = list(enumerate(iter_windows(ds.height, ds.width, tile, halo)))
+    if len(windows) > max_tiles:
+        pick = np.sort(np.random.default_rng(42).choice(len(windows), max_tiles, replace=False))
+        windows = [windows[i] for i in pick]
+    npix = sum(int(w[1][0].width) * int(w[1][0].height) for w in windows)
+    sk = None
+
+    with thread_readers(ds, workers) as reader:
+        def work(item):
+            _, (core, outer, inner) = item
+            if cache is not None and cache.complete:
+                stack, valid = cache.read(core)
+                return stack[valid]
+            stack, _, valid = window_features(reader(), bandmap, outer, ent_cfg, u8_scaling, custom=custom)
+            return stack[inner][valid[inner]]
+
+        def sink(item, X):
+            nonlocal sk
+            if sk is None: sk = RobustStatsSketch(X.shape[-1], npix, target=target)
+            sk.update(X, item[0])
+
+        run_pipeline(windows, work, sink, workers, feedback)
+    n_tiles = ((ds.height + tile - 1) // tile) * ((ds.width + tile - 1) // tile)
+    return sk.stats(), sk.error_meta({"pixels": "valid", "tiles_used": len(windows), "tiles_total": n_tiles},
+                                     partial=len(windows) < n_tiles)
+
+def sample_features_windowed(ds, bandmap, samples, ent_cfg, u8_scaling, cell=256, feedback=None, cache=None,
+                             custom=None):
+    """Extrai features nos pontos lendo só a vizinhança das amostras: os pontos são agrupados em
+    células de `cell` px e, por célula, lê-se o retângulo envolvente dos pontos + halo da entropia."""
+    by_cell, y = {}, []
+    for x, yc, cls in samples:
+        r, c = rowcol(ds.transform, x, yc, op=lambda z: int(np.floor(z)))
+        if 0 <= r < ds.height and 0 <= c < ds.width:
+            by_cell.setdefault((r // cell, c // cell), []).append((len(y), r, c))
+            y.append(cls)
+    if not y:
+        raise QgsProcessingException("Amostragem vazia: pontos fora do raster.")
+    if cache is not None and cache.complete:
+        idx = [i for pts in by_cell.values() for i, _, _ in pts]
+        rows = [r for pts in by_cell.values() for _, r, _ in pts]
+        cols = [c for pts in by_cell.values() for _, _, c in pts]
+        X = np.empty((len(y), len(cache.names)), dtype=np.float32)
+        X[idx] = cache.features[rows, cols]
+        return X, np.array(y), list(cache.names)
+    halo = int(ent_cfg[0]) if (ent_cfg[1] or ent_cfg[2]) else 0
+    X, names = None, None
+    for k, pts in enumerate(by_cell.values(), start=1):
+        check_canceled(feedback)
+        if feedback and k % 50 == 0:
+            feedback.setProgressText(f"Amostras: célula {k}/{len(by_cell)}")
+            feedback.setProgress(100.0 * k / len(by_cell))
+        idx = [i for i, _, _ in pts]
+        rows = np.array([r for _, r, _ in pts]); cols = np.array([c for _, _, c in pts])
+        hr0, hc0 = max(0, int(rows.min()) - halo), max(0, int(cols.min()) - halo)
+        hr1 = min(ds.height, int(rows.max()) + 1 + halo); hc1 = min(ds.width, int(cols.max()) + 1 + halo)
+        stack, names, _ = window_features(ds, bandmap, Window(hc0, hr0, hc1 - hc0, hr1 - hr0),
+                                          ent_cfg, u8_scaling, custom=custom)
+        if X is None: X = np.empty((len(y), stack.shape[-1]), dtype=np.float32)
+        X[idx] = stack[rows - hr0, cols - hc0, :]
+    return X, np.array(y), names
+
+def classify_tiled(ds, bandmap, model, order, stats, out_path, profile, tile, ent_cfg, u8_scaling,
+                   feedback=None, workers=1, cache=None, proba_path=None, region=None, custom=None):
+    """Features → escalonamento → predição por bloco, gravando direto no GeoTIFF de saída.
+    Cada thread lê com seu próprio handle rasterio; a gravação fica na thread principal.
+    cache: entrada completa é lida no lugar do cálculo; entrada nova é preenchida bloco a bloco.
+    proba_path: grava também as bandas de incerteza (uncertainty_u8) na mesma passada.
+    region: lista de janelas; só os blocos que as tocam são recalculados e gravados no lugar (r+)."""
+    halo = int(ent_cfg[0]) if (ent_cfg[1] or ent_cfg[2]) else 0
+    windows = list(iter_windows(ds.height, ds.width, tile, halo))
+    if region is not None:
+        windows = [w for w in windows if any(windows_overlap(w[0], r) for r in region)]
+    from_cache = cache is not None and cache.complete
+
+    with thread_readers(ds, workers) as reader:
+        def work(win):
+            core, outer, inner = win
+            if from_cache:
+                stack, valid = cache.read(core)
+            else:
+                stack, _, valid = window_features(reader(), bandmap, outer, ent_cfg, u8_scaling, custom=custom)
+                stack, valid = stack[inner], valid[inner]
+                if cache is not None: cache.write(core, stack, valid)
+            if order is not None: stack = stack[..., order]
+            robust_transform_inplace(stack, stats)
+            return _predict_block(model, stack, valid, proba_path is not None)
+
+        done = [0]
+        out = open_update(out_path) if region is not None else rasterio.open(out_path, 'w', **profile)
+        with out as outds, open_proba(proba_path, profile) as pds, \
+                single_threaded_model(model, workers > 1) as model:
+            def sink(win, res):
+                preds, q = res if pds is not None else (res, None)
+                outds.write(preds, 1, window=win[0])
+                if q is not None: pds.write(q, window=win[0])
+                done[0] += 1
+                if feedback: feedback.setProgressText(f"Classificando bloco {done[0]}/{len(windows)}")
+            run_pipeline(windows, work, sink, workers, feedback)
+    if cache is not None and not from_cache and region is None:
+        cache.mark_complete()
+    return out_path
+
+def remove_small_patches_tiled(src_path, dst_path, profile, min_size, exclude, mode_radius, tile,
+                               ignore_zero=True, connectivity=2, feedback=None):
+    """remove_small_patches em faixas de `tile` linhas, em duas passadas:
+    1) RunLabeler acumula os runs faixa a faixa e une as costuras (tamanho real das manchas);
+    2) cada faixa é relida com halo = raio do modo e a moda é aplicada só nas manchas pequenas."""
+    r = int(mode_radius)
+    with rasterio.open(src_path) as src, rasterio.open(dst_path, 'w', **profile) as dst:
+        h, w = src.height, src.width
+        lab = RunLabeler(w, connectivity)
+        for r0 in range(0, h, tile):
+            check_canceled(feedback)
+            lab.add(src.read(1, window=Window(0, r0, w, min(tile, h - r0))))
+            if feedback: feedback.setProgress(50.0 * min(r0 + tile, h) / h)
+        lab.finish()
+        small = lab.small_runs(min_size, exclude)
+        for r0 in range(0, h, tile):
+            check_canceled(feedback)
+            r1 = min(r0 + tile, h)
+            hr0, hr1 = max(0, r0 - r), min(h, r1 + r)
+            ymap = src.read(1, window=Window(0, hr0, w, hr1 - hr0))
+            where = np.zeros(ymap.shape, dtype=bool)
+            where[r0 - hr0:r1 - hr0] = lab.rows_mask(small, r0, r1)
+            core = ymap[r0 - hr0:r1 - hr0].copy()
+            if where.any():
+                core[where[r0 - hr0:r1 - hr0]] = mode_at(ymap, r, where, ignore_zero=ignore_zero)
+            dst.write(core, 1, window=Window(0, r0, w, r1 - r0))
+            if feedback: feedback.setProgress(50.0 + 50.0 * r1 / h)
+    return dst_path
+
+# ---------- Atualização incremental (AOI) ----------
+
+def windows_overlap(a, b):
+    return (a.row_off < b.row_off + b.height and b.row_off < a.row_off + a.height and
+            a.col_off < b.col_off + b.width and b.col_off < a.col_off + a.width)
+
+def windows_union(a, b):
+    r0, c0 = min(a.row_off, b.row_off), min(a.col_off, b.col_off)
+    r1 = max(a.row_off + a.height, b.row_off + b.height)
+    c1 = max(a.col_off + a.width, b.col_off + b.width)
+    return Window(c0, r0, c1 - c0, r1 - r0)
+
+def aoi_windows(ds, source, raster_crs, tile):
+    """Retângulos alinhados à grade de blocos que cobrem o bbox de cada feição da AOI (no SRC do
+    raster); retângulos sobrepostos são unidos. Feições fora do raster são ignoradas."""
+    ct = QgsCoordinateTransform(source.sourceCrs(), raster_crs, QgsProject.instance().transformContext())
+    rects = []
+    for f in source.getFeatures():
+        g = f.geometry()
+        if (g is None) or g.isEmpty(): continue
+        bb = ct.transformBoundingBox(g.boundingBox())
+        w = from_bounds(bb.xMinimum(), bb.yMinimum(), bb.xMaximum(), bb.yMaximum(), transform=ds.transform)
+        if w.row_off >= ds.height or w.col_off >= ds.width or w.row_off + w.height < 0 or w.col_off + w.width < 0:
+            continue
+        pr0, pc0 = max(0, int(np.floor(w.row_off))), max(0, int(np.floor(w.col_off)))
+        pr1 = min(ds.height - 1, int(np.floor(w.row_off + w.height)))
+        pc1 = min(ds.width - 1, int(np.floor(w.col_off + w.width)))
+        r0, c0 = (pr0 // tile) * tile, (pc0 // tile) * tile
+        r1, c1 = min(ds.height, (pr1 // tile + 1) * tile), min(ds.width, (pc1 // tile + 1) * tile)
+        rects.append(Window(c0, r0, c1 - c0, r1 - r0))
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            j = next((j for j in range(i + 1, len(rects)) if windows_overlap(rects[i], rects[j])), None)
+            if j is not None:
+                rects[i] = windows_union(rects[i], rects.pop(j))
+                merged = True
+                break
+    return rects
+
+def remove_small_patches_region(path, region, min_size, exclude, mode_radius, ignore_zero=True,
+                                connectivity=2, feedback=None):
+    """remove_small_patches no lugar (r+), só dentro das janelas de `region`. Cada janela é lida com
+    halo = max(min_size, raio do modo): toda mancha < min_size que toca a janela cabe inteira no halo,
+    então tamanhos e modas dentro da janela são os mesmos da cena inteira (com o entorno já gravado)."""
+    halo = max(int(min_size), int(mode_radius))
+    with open_update(path) as ds:
+        for k, win in enumerate(region, start=1):
+            check_canceled(feedback)
+            r0, c0, h, w = int(win.row_off), int(win.col_off), int(win.height), int(win.width)
+            hr0, hc0 = max(0, r0 - halo), max(0, c0 - halo)
+            hr1, hc1 = min(ds.height, r0 + h + halo), min(ds.width, c0 + w + halo)
+            ymap = ds.read(1, window=Window(hc0, hr0, hc1 - hc0, hr1 - hr0))
+            out = remove_small_patches(ymap, min_size, exclude, mode_radius, ignore_zero=ignore_zero,
+                                       connectivity=connectivity, feedback=feedback)
+            ds.write(out[r0 - hr0:r0 - hr0 + h, c0 - hc0:c0 - hc0 + w], 1, window=win)
+            if feedback: feedback.setProgress(100.0 * k / len(region))
+    return path
+
+# ---------- Lote (várias cenas, um modelo) ----------
+
+RASTER_EXTS = ('.tif', '.tiff', '.vrt', '.img', '.jp2')
+
+def list_batch_rasters(paths, folder=None):
+    """Caminhos explícitos + rasters da pasta (ordem alfabética), sem repetição."""
+    out = [p for p in paths if p]
+    if folder and os.path.isdir(folder):
+        out += sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(RASTER_EXTS))
+    seen = set()
+    return [p for p in out if not (os.path.abspath(p) in seen or seen.add(os.path.abspath(p)))]
+
+def batch_output_paths(scenes, out_dir, suffix='_class.tif'):
+    """<cena>_class.tif em out_dir; nomes repetidos (pastas diferentes) recebem _2, _3…"""
+    used, out = {}, []
+    for src in scenes:
+        base = os.path.splitext(os.path.basename(src))[0]
+        k = used[base] = used.get(base, 0) + 1
+        out.append(os.path.join(out_dir, f"{base}{'' if k == 1 else f'_{k}'}{suffix}"))
+    return out
 
+def classify_scene(src_path, dst_path, bandmap, model, want, stats, tile_size, ent_cfg,
+                   min_patch, exclude, mode_radius, ignore_zero=True, workers=1, feedback=None, custom=None):
+    """Uma cena do lote no modo em blocos (escala da entropia própria da cena). Retorna o registro de tempo."""
+    t0 = time.perf_counter()
+    with rasterio.open(src_path) as ds:
+        tile = aligned_tile_size(ds, tile_size)
+        u8_scaling = band_u8_scaling(ds, bandmap)
+        _, names, _ = window_features(ds, bandmap, Window(0, 0, 1, 1), ent_cfg, u8_scaling, custom=custom)
+        order = feature_order(names, want)
+        prof = tiled_profile(ds, tile)
+        raw = os.path.splitext(dst_path)[0] + "_raw.tif" if min_patch > 0 else dst_path
+        t1 = time.perf_counter()
+        classify_tiled(ds, bandmap, model, order, stats, raw, prof, tile, ent_cfg, u8_scaling,
+                       feedback, workers=workers, custom=custom)
+        npix = ds.width * ds.height
+        rec = {"raster": src_path, "output": dst_path, "width": ds.width, "height": ds.height}
+    t2 = time.perf_counter()
+    if min_patch > 0:
+        remove_small_patches_tiled(raw, dst_path, prof, min_patch, exclude, mode_radius, tile,
+                                   ignore_zero=ignore_zero, connectivity=2, feedback=feedback)
+        try:
+            os.remove(raw)
+        except OSError:
+            pass
+    finalize_cog(dst_path)
+    t3 = time.perf_counter()
+    rec.update(status="ok", seconds=round(t3 - t0, 3), setup_s=round(t1 - t0, 3),
+               classify_s=round(t2 - t1, 3), postprocess_s=round(t3 - t2, 3),
+               px_per_s=round(npix / max(t3 - t0, 1e-9), 1))
+    return rec
+
+def build_vrt(vrt_path, paths):
+    """Mosaico VRT das saídas do lote (cenas devem compartilhar SRC e resolução)."""
+    if gdal is None:
+        raise QgsProcessingException("GDAL (osgeo) indisponível para gerar o VRT.")
+    opts = gdal.BuildVRTOptions(srcNodata=0, VRTNodata=0)
+    vrt = gdal.BuildVRT(vrt_path, list(paths), options=opts)
+    if vrt is None:
+        raise QgsProcessingException(f"Falha ao gerar o VRT: {gdal.GetLastErrorMsg()}")
+    vrt = None  # fecha e grava
+    return vrt_path
+
+class CancelOnlyFeedback:
+    """Repassa só o cancelamento a funções que rodam fora da thread principal (log/progresso mudos)."""
+    def __init__(self, feedback):
+        self.feedback = feedback
+    def isCanceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+    def setProgress(self, x): pass
+    def setProgressText(self, txt): pass
+    def pushInfo(self, txt): pass
+
+def run_batch(scenes, out_paths, model, want, stats, bandmap, tile_size, ent_cfg,
+              min_patch, exclude, mode_radius, ignore_zero=True, workers=1, feedback=None, custom=None):
+    """Distribui as cenas num pool de threads; com poucas cenas as threads restantes vão para os blocos
+    de cada cena. O modelo é compartilhado (uma cópia rasa com n_jobs=1 para todo o lote). Falha numa cena não
+    interrompe as demais: fica registrada com status "erro"."""
+    scene_workers = max(1, min(workers, len(scenes)))
+    inner = max(1, workers // scene_workers)
+    records, done = [], [0]
+    cancel = CancelOnlyFeedback(feedback)
+
+    def work(i):
+        try:
+            return classify_scene(scenes[i], out_paths[i], bandmap, model, want, stats, tile_size, ent_cfg,
+                                  min_patch, exclude, mode_radius, ignore_zero=ignore_zero, workers=inner,
+                                  feedback=cancel, custom=custom)
+        except Exception as e:
+            if cancel.isCanceled(): raise
+            return {"raster": scenes[i], "output": out_paths[i], "status": "erro", "error": str(e)}
+
+    def sink(i, rec):
+        records.append(rec)
+        done[0] += 1
+        if feedback:
+            if rec["status"] == "ok":
+                feedback.pushInfo(f"[Lote] {done[0]}/{len(scenes)} {os.path.basename(scenes[i])}: "
+                                  f"{rec['seconds']:.1f}s ({rec['px_per_s'] / 1e6:.2f} Mpx/s)")
+            else:
+                feedback.pushInfo(f"[Lote] {done[0]}/{len(scenes)} {os.path.basename(scenes[i])}: ERRO {rec['error']}")
 
+    with single_threaded_model(model, True) as model:
+        run_pipeline(range(len(scenes)), work, sink, scene_workers, feedback)
+    order = {p: k for k, p in enumerate(scenes)}
+    return sorted(records, key=lambda r: order[r["raster"]])
 
 # ---------- Métricas / Relatórios ----------
 
@@ -492,13 +1623,16 @@ def save_json_report(base_out_tif, payload, feedback=None):
 class RF_Ensemble_Classify(QgsProcessingAlgorithm):
     RASTER = 'RASTER'
     BANDMAP = 'BANDMAP'
+    CUSTOM_INDICES = 'CUSTOM_INDICES'
     SAMPLES = 'SAMPLES'
     CLASS_FIELD = 'CLASS_FIELD'
     N_PER_CLASS = 'N_PER_CLASS'
     N_TREES = 'N_TREES'
+    MODEL_KIND = 'MODEL_KIND'
     MODEL_IN = 'MODEL_IN'     # inferência direta (opcional)
     MODEL_OUT = 'MODEL_OUT'   # salvo se treinar (opcional)
     RASTER_OUT = 'RASTER_OUT' # RasterDestination
+    PROBA_OUT = 'PROBA_OUT'   # probabilidade/incerteza (opcional)
 
     # Pós-processamento
     MIN_PATCH = 'MIN_PATCH'
@@ -516,6 +1650,36 @@ class RF_Ensemble_Classify(QgsProcessingAlgorithm):
     VALID_CLASS_FIELD = 'VALID_CLASS_FIELD'
     VALID_N_PER_CLASS = 'VALID_N_PER_CLASS'
 
+    # Modo em blocos (baixa memória)
+    TILED = 'TILED'
+    TILE_SIZE = 'TILE_SIZE'
+    N_WORKERS = 'N_WORKERS'
+    TRAIN_ONLY = 'TRAIN_ONLY'
+    FLAT_PREDICTOR = 'FLAT_PREDICTOR'
+    FLAT_EXPORT = 'FLAT_EXPORT'
+    MODEL_MMAP = 'MODEL_MMAP'
+
+    # Ajuste de hiperparâmetros (CV espacial)
+    TUNE = 'TUNE'
+    CV_FOLDS = 'CV_FOLDS'
+    CV_BLOCK = 'CV_BLOCK'
+    CV_GRID = 'CV_GRID'
+    MODEL_CACHE_GB = 'MODEL_CACHE_GB'
+
+    # Lote (várias cenas com o mesmo modelo)
+    RASTER_BATCH = 'RASTER_BATCH'
+    BATCH_DIR = 'BATCH_DIR'
+    BATCH_OUT_DIR = 'BATCH_OUT_DIR'
+    BATCH_VRT = 'BATCH_VRT'
+
+    # Cache de features
+    CACHE_DIR = 'CACHE_DIR'
+    CACHE_MAX_GB = 'CACHE_MAX_GB'
+
+    # Atualização incremental
+    UPDATE_RASTER = 'UPDATE_RASTER'
+    UPDATE_AOI = 'UPDATE_AOI'
+
     def tr(self, s): return tr(s)
     def name(self): return 'rf_classify'
     def displayName(self): return self.tr('Classificação Supervisionada RF')
@@ -526,14 +1690,17 @@ class RF_Ensemble_Classify(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr("""
 Classificação de raster multibanda usando Random Forest (RF) com bandas, índices espectrais e entropia local. O resultado usa a convenção 0=NoData e classes iniciando em 1.
+O cubo de features é guardado de forma compacta (diferenças normalizadas em int16 ×1e-4, entropia em float16, bandas em float32) e decodificado em float32 bloco a bloco na predição.
 
 O que configurar:
 - Raster multibanda: imagem de entrada que será classificada.
-- Mapeamento de bandas: informa quais bandas do raster correspondem a R, G, B, NIR, SWIR1 e SWIR2. Exemplo: R=3,G=2,B=1,NIR=4.
-- Polígonos de amostra (treino): camada poligonal com as áreas de treinamento.
-- Campo de classe (treino): atributo que identifica a classe de cada polígono de treino.
+- Mapeamento de bandas: informa quais bandas do raster correspondem a R, G, B, NIR, SWIR1 e SWIR2. Exemplo: R=3,G=2,B=1,NIR=4. Outras bandas (ex.: RE=5) podem ser mapeadas para uso nos índices personalizados.
+- Índices personalizados (opcional): "NOME = expressão" separados por ";" — bandas do BANDMAP, números, + - * / **, sqrt, abs, log, exp (ex.: CM = (NIR-RE)/(NIR+RE)). Entram como features após os índices do catálogo, no mesmo plano de cálculo (subtermos comuns avaliados uma vez; divisão por zero → 0). Ficam gravados no _meta.json do modelo: com modelo pré-treinado (e no lote) valem os do modelo e o parâmetro é ignorado.
+- Polígonos de amostra (treino): camada poligonal com as áreas de treinamento. Obrigatória para treinar; dispensável com "Modelo pré-treinado" e no lote.
+- Campo de classe (treino): atributo que identifica a classe de cada polígono de treino (obrigatório junto com as amostras).
 - N amostras por classe (treino): quantidade de pontos amostrados aleatoriamente em cada classe para treinar o modelo.
 - Número de árvores (RF): quantidade de árvores do Random Forest; valores maiores tendem a aumentar o custo de processamento.
+- Tipo de modelo: Random Forest (padrão); HistGradientBoosting — boosting sobre features discretizadas em histogramas, treino bem mais rápido com muitas amostras (o número de árvores vira o máximo de iterações; sem métricas OOB); ou kNN (15 vizinhos ponderados pela distância) sobre até 20 000 amostras sorteadas. O tipo fica gravado no _meta.json e a inferência (em memória, em blocos ou em lote) é a mesma para todos; o RF achatado e o ajuste de hiperparâmetros valem só para o RF.
 
 Pós-processamento:
 - Tamanho mínimo do patch (px): remove manchas muito pequenas no raster classificado.
@@ -551,10 +1718,52 @@ Validação opcional:
 - Campo de classe (validação): atributo de classe dos polígonos de validação.
 - N amostras por classe (validação): quantidade de pontos por classe usados na avaliação.
 
+Ajuste de hiperparâmetros (opcional):
+- Ajustar hiperparâmetros: em vez do RF com parâmetros fixos, avalia cada combinação da grade por validação cruzada espacial em k dobras, reaproveitando a matriz de amostras já extraída (sem nova leitura do raster), e retreina a melhor com todas as amostras.
+- Dobras / bloco espacial (px): as amostras são agrupadas em blocos de N×N px e cada bloco inteiro vai para uma dobra, evitando que pontos vizinhos (autocorrelacionados) fiquem no treino e no teste.
+- Grade: "trees=100,300; max_features=sqrt,0.33; min_samples_leaf=1,0.0025" (parâmetro omitido = padrão). O ranking (kappa e acurácia médios ± desvio) é gravado em <saída>_cv.csv e resumido no _report.json; o número de árvores informado acima é ignorado.
+- As combinações × dobras rodam em paralelo nas threads de inferência.
+
+Modo em blocos (rasters grandes):
+- Processar em blocos: lê o raster por janelas, calcula features, classifica e grava cada bloco direto no GeoTIFF; a memória passa a depender do tamanho do bloco, não da cena.
+- Tamanho do bloco (px): lado da janela de processamento; um halo com o raio da entropia/filtro de modo é lido em volta de cada bloco.
+- Neste modo o escalonamento robusto (mediana/IQR) é estimado em resolução total sobre até 16 blocos sorteados; o erro estimado fica registrado no _meta.json do modelo.
+- Equivalência com o modo em memória: nos dois modos a mediana/IQR usa só os pixels válidos (NoData fica de fora). Features, escalonamento e mapa são os mesmos enquanto a cena tiver até 2048 px de lado, até 16 blocos e até 1 milhão de pixels. Acima disso a escala u8 da entropia vem de uma leitura decimada e a mediana/IQR de amostras (sorteadas de forma diferente em cada modo), ou seja, são aproximações: diferenças pequenas nos valores escalonados e, raramente, na classe de pixels na fronteira de decisão.
+- Threads de inferência: blocos são lidos, processados e classificados em paralelo (0 = todos os núcleos); a gravação é feita por uma única thread. O tamanho do bloco também define os blocos de predição no modo em memória.
+- Neste modo as amostras são extraídas lendo apenas janelas em volta dos pontos.
+- Apenas treinar: extrai amostras por janelas, treina e salva o modelo (obrigatório informar "Salvar modelo") sem classificar a cena; a classificação pode ser feita depois, em blocos, com o modelo salvo.
+
+Lote (várias cenas, um modelo):
+- Rasters do lote / Pasta de rasters do lote: lista de camadas e/ou pasta (.tif, .tiff, .vrt, .img, .jp2); um VRT mosaico também pode ser informado como cena única. Requer "Modelo pré-treinado"; o raster multibanda e as amostras são ignorados.
+- O modelo e o _meta.json são carregados uma única vez; as cenas são distribuídas entre as threads de inferência e cada uma é classificada em blocos, com o mesmo pós-processamento, em <cena>_class.tif na pasta de saída do lote.
+- Gerar mosaico VRT: junta as saídas em batch_mosaic.vrt (as cenas devem ter o mesmo SRC e resolução).
+- O tempo de cada cena (preparação, classificação, pós-processamento, px/s) e eventuais erros ficam em batch_report.json.
+
+Atualização incremental (AOI):
+- Raster classificado a atualizar: GeoTIFF gerado antes por este algoritmo (mesma grade do raster multibanda). Com ele, o algoritmo roda em blocos e grava no lugar só os blocos que tocam a área informada; o restante do arquivo não é alterado.
+- Área a atualizar: polígonos da AOI ou as amostras editadas (use "Somente feições selecionadas"); vale o retângulo envolvente de cada feição, arredondado para a grade de blocos.
+- O modelo pode ser treinado na mesma execução (amostras editadas) ou vir de "Modelo pré-treinado". O pós-processamento é refeito na área com halo = max(tamanho mínimo do patch, raio do modo), usando o mapa já gravado como entorno.
+- A atualização é feita no próprio arquivo: só os blocos da área e os blocos correspondentes das overviews são regravados (sem copiar a cena; funciona com a camada aberta). Depois disso o arquivo continua GeoTIFF tiled com overviews, mas deixa de ser um COG estrito (blocos regravados vão para o fim do arquivo); rode sem atualização para gerar de novo o COG completo.
+- Os retângulos atualizados e os tempos ficam em <raster>_update_report.json. Recarregue a camada no QGIS para ver a alteração.
+
+Cache de features (opcional):
+- Pasta do cache: guarda em disco (memmap) o cubo de bandas + índices + entropia de cada raster. Reexecuções com o mesmo raster (caminho, data e tamanho do arquivo), BANDMAP e entropia pulam direto para amostragem e predição — útil ao ajustar N de árvores, MIN_PATCH ou as amostras.
+- Tamanho máximo do cache (GB): entradas menos usadas recentemente são removidas para respeitar o limite.
+
 Modelo e saídas:
 - Modelo pré-treinado (.joblib): use quando quiser classificar diretamente sem treinar um novo modelo.
 - Salvar modelo (.joblib): grava o modelo treinado para reutilização futura.
-- Raster classificado: saída final do mapa de classes.
+- Exportar também o RF achatado: grava ainda um _flat.npz (desligado por padrão), menor e carregado sem unpickling nem dependência da versão do sklearn.
+- Usar RF achatado na inferência: com modelo pré-treinado, carrega o _flat.npz em vez do .joblib (mesmo resultado). A predição do sklearn é mais rápida; use só quando a carga do .joblib for o gargalo ou o sklearn não for o mesmo do treino.
+- Modelos pré-treinados ficam em cache na sessão do QGIS, identificados pelo hash do conteúdo dos arquivos do bundle: reexecuções (ou o modo em lote) com o mesmo modelo começam sem recarregar do disco. O cache respeita o limite de memória informado (0 desliga); os menos usados recentemente saem primeiro.
+- Carregar o .joblib mapeado em memória: lê os arrays do modelo sob demanda a partir do arquivo (mmap_mode='r').
+- Raster classificado: saída final do mapa de classes, gravada como COG (Cloud Optimized GeoTIFF: blocos de 512 px, deflate e overviews NEAREST), rápido de abrir em qualquer escala. O raster de probabilidade/incerteza usa overviews AVERAGE.
+- Probabilidade/incerteza (opcional): raster uint8 de 3 bandas gravado na mesma passada da classificação — 1) probabilidade da classe vencedora, 2) margem entre as duas classes mais prováveis, 3) entropia de Shannon das probabilidades normalizada por log(K). Valores 0..254 correspondem a 0..1 (fator de escala 1/254 gravado no arquivo); 255 = NoData. Reflete a predição bruta, antes do pós-processamento.
+
+Progresso e cancelamento:
+- Cada etapa (leitura + features, amostragem, escalonamento, treino, classificação, pós-processamento, lote) ocupa uma faixa própria da barra de progresso e é registrada no log com tempo, pico de memória (RSS) e px/s.
+- O botão Cancelar é verificado a cada bloco, célula de amostragem, índice ou faixa do filtro; o algoritmo para em segundos, sem gravar relatório ou modelo parciais.
+- Os tempos por etapa ficam em "stages" no _report.json (e no batch_report.json do lote).
 
 Fluxo de uso:
 - Se você fornecer amostras de treino, o algoritmo treina o modelo e classifica o raster.
@@ -562,16 +1771,21 @@ Fluxo de uso:
 """)
 
     def initAlgorithm(self, config=None):
-        self.addParameter(QgsProcessingParameterRasterLayer(self.RASTER, self.tr('Raster multibanda')))
+        self.addParameter(QgsProcessingParameterRasterLayer(self.RASTER, self.tr('Raster multibanda'), optional=True))
         self.addParameter(QgsProcessingParameterString(
             self.BANDMAP, self.tr('Mapeamento de bandas (ex.: R=3,G=2,B=1,NIR=4,SWIR1=5,SWIR2=6)'),
             defaultValue='R=3,G=2,B=1,NIR=4,SWIR1=5,SWIR2=6'
         ))
+        self.addParameter(QgsProcessingParameterString(
+            self.CUSTOM_INDICES, self.tr('Índices personalizados (ex.: CM = (NIR-RE)/(NIR+RE); separe com ;)'),
+            defaultValue='', optional=True
+        ))
         self.addParameter(QgsProcessingParameterFeatureSource(
-            self.SAMPLES, self.tr('Polígonos de amostra (treino)'), [QgsProcessing.TypeVectorPolygon]
+            self.SAMPLES, self.tr('Polígonos de amostra (treino) [opcional com modelo pré-treinado]'),
+            [QgsProcessing.TypeVectorPolygon], optional=True
         ))
         self.addParameter(QgsProcessingParameterField(
-            self.CLASS_FIELD, self.tr('Campo de classe (treino)'), parentLayerParameterName=self.SAMPLES
+            self.CLASS_FIELD, self.tr('Campo de classe (treino)'), parentLayerParameterName=self.SAMPLES, optional=True
         ))
         self.addParameter(QgsProcessingParameterNumber(
             self.N_PER_CLASS, self.tr('N amostras por classe (treino)'),
@@ -581,6 +1795,9 @@ Fluxo de uso:
             self.N_TREES, self.tr('Número de árvores (RF)'),
             QgsProcessingParameterNumber.Integer, defaultValue=100, minValue=10, maxValue=2000
         ))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.MODEL_KIND, self.tr('Tipo de modelo'), options=[k[1] for k in MODEL_KINDS], defaultValue=0
+        ))
         
         # Pós-processamento
         self.addParameter(QgsProcessingParameterNumber(
@@ -623,18 +1840,102 @@ Fluxo de uso:
             self.VALID_N_PER_CLASS, self.tr('N amostras por classe (validação) [opcional]'),
             QgsProcessingParameterNumber.Integer, defaultValue=150, minValue=10
         ))
+
+        # Ajuste de hiperparâmetros
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.TUNE, self.tr('Ajustar hiperparâmetros (validação cruzada espacial)'), defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.CV_FOLDS, self.tr('Dobras da validação cruzada'),
+            QgsProcessingParameterNumber.Integer, defaultValue=5, minValue=2, maxValue=20
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.CV_BLOCK, self.tr('Tamanho do bloco espacial da CV (px)'),
+            QgsProcessingParameterNumber.Integer, defaultValue=512, minValue=16
+        ))
+        self.addParameter(QgsProcessingParameterString(
+            self.CV_GRID, self.tr('Grade de hiperparâmetros'),
+            defaultValue='trees=100,300; max_features=sqrt,0.33; min_samples_leaf=1,0.0025'
+        ))
+
+        # Modo em blocos
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.TILED, self.tr('Processar em blocos (baixa memória)'), defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TILE_SIZE, self.tr('Tamanho do bloco (px)'),
+            QgsProcessingParameterNumber.Integer, defaultValue=1024, minValue=256, maxValue=8192
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.N_WORKERS, self.tr('Threads de inferência (0 = todos os núcleos)'),
+            QgsProcessingParameterNumber.Integer, defaultValue=0, minValue=0, maxValue=256
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.TRAIN_ONLY, self.tr('Apenas treinar (sem classificar o raster)'), defaultValue=False
+        ))
         
+        # Lote
+        self.addParameter(QgsProcessingParameterMultipleLayers(
+            self.RASTER_BATCH, self.tr('Rasters do lote [opcional]'), QgsProcessing.TypeRaster, optional=True
+        ))
+        self.addParameter(QgsProcessingParameterFile(
+            self.BATCH_DIR, self.tr('Pasta de rasters do lote [opcional]'),
+            behavior=QgsProcessingParameterFile.Folder, optional=True
+        ))
+        self.addParameter(QgsProcessingParameterFolderDestination(
+            self.BATCH_OUT_DIR, self.tr('Pasta de saída do lote [opcional]'), optional=True, createByDefault=False
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.BATCH_VRT, self.tr('Gerar mosaico VRT das saídas do lote'), defaultValue=False
+        ))
+
+        # Cache de features
+        self.addParameter(QgsProcessingParameterFile(
+            self.CACHE_DIR, self.tr('Pasta do cache de features [opcional]'),
+            behavior=QgsProcessingParameterFile.Folder, optional=True
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.CACHE_MAX_GB, self.tr('Tamanho máximo do cache (GB)'),
+            QgsProcessingParameterNumber.Double, defaultValue=20.0, minValue=0.1
+        ))
+
+        # Atualização incremental
+        self.addParameter(QgsProcessingParameterRasterLayer(
+            self.UPDATE_RASTER, self.tr('Raster classificado a atualizar (no lugar) [opcional]'), optional=True
+        ))
+        self.addParameter(QgsProcessingParameterFeatureSource(
+            self.UPDATE_AOI, self.tr('Área a atualizar (AOI ou amostras alteradas)'),
+            [QgsProcessing.TypeVectorAnyGeometry], optional=True
+        ))
+
         # Modelo + saída
         self.addParameter(QgsProcessingParameterFile(
             self.MODEL_IN, self.tr('Modelo pré-treinado (.joblib) [opcional]'),
             behavior=QgsProcessingParameterFile.File, optional=True, fileFilter='Joblib (*.joblib)'
         ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.FLAT_PREDICTOR, self.tr('Usar RF achatado (_flat.npz) na inferência'), defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.FLAT_EXPORT, self.tr('Exportar também o RF achatado (_flat.npz) ao salvar o modelo'), defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.MODEL_MMAP, self.tr('Carregar o .joblib mapeado em memória (mmap)'), defaultValue=False
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.MODEL_CACHE_GB, self.tr('Memória para modelos em cache na sessão (GB; 0 = sem cache)'),
+            QgsProcessingParameterNumber.Double, defaultValue=2.0, minValue=0.0
+        ))
         self.addParameter(QgsProcessingParameterFileDestination(
             self.MODEL_OUT, self.tr('Salvar modelo (.joblib) [opcional]'),
             fileFilter='Joblib (*.joblib)', optional=True
         ))
         self.addParameter(QgsProcessingParameterRasterDestination(
-            self.RASTER_OUT, self.tr('Raster classificado')
+            self.RASTER_OUT, self.tr('Raster classificado'), optional=True
+        ))
+        self.addParameter(QgsProcessingParameterRasterDestination(
+            self.PROBA_OUT, self.tr('Probabilidade/incerteza (3 bandas uint8) [opcional]'),
+            optional=True, createByDefault=False
         ))
         
 
@@ -642,6 +1943,12 @@ Fluxo de uso:
         def prog(x, txt=None):
             if txt: feedback.setProgressText(txt)
             feedback.setProgress(int(min(100, x)))
+        timer = StageTimer(feedback)
+
+        batch = [lyr.source().split('|')[0] for lyr in (self.parameterAsLayerList(p, self.RASTER_BATCH, context) or [])]
+        batch_dir = self.parameterAsFile(p, self.BATCH_DIR, context)
+        if batch or batch_dir:
+            return self._process_batch(p, context, feedback, prog, timer, list_batch_rasters(batch, batch_dir))
 
         rlyr = self.parameterAsRasterLayer(p, self.RASTER, context)
         if rlyr is None: raise QgsProcessingException("Raster inválido.")
@@ -663,8 +1970,15 @@ Fluxo de uso:
         ignore_nodata = self.parameterAsBool(p, self.MODE_IGNORE_NODATA, context)
 
         model_in = self.parameterAsFile(p, self.MODEL_IN, context)
+        use_flat = self.parameterAsBool(p, self.FLAT_PREDICTOR, context)
+        load_model = lambda path: cached_model_bundle(
+            path, flat=use_flat, mmap=self.parameterAsBool(p, self.MODEL_MMAP, context),
+            max_bytes=self.parameterAsDouble(p, self.MODEL_CACHE_GB, context) * 1024**3, feedback=feedback)
         model_out = self.parameterAsFileOutput(p, self.MODEL_OUT, context)
+        export_flat = self.parameterAsBool(p, self.FLAT_EXPORT, context)
+        save_model = lambda *a: save_model_bundle(*a, flat=export_flat)
         out_tif = self.parameterAsOutputLayer(p, self.RASTER_OUT, context)
+        proba_tif = self.parameterAsOutputLayer(p, self.PROBA_OUT, context)
 
         # Entropia
         ent_radius = self.parameterAsInt(p, self.ENT_RADIUS, context)
@@ -676,105 +1990,185 @@ Fluxo de uso:
         v_class_field = self.parameterAsString(p, self.VALID_CLASS_FIELD, context) if v_src else None
         v_n = self.parameterAsInt(p, self.VALID_N_PER_CLASS, context) if v_src else None
 
+        tiled = self.parameterAsBool(p, self.TILED, context)
+        tile_size = self.parameterAsInt(p, self.TILE_SIZE, context)
+        workers = resolve_workers(self.parameterAsInt(p, self.N_WORKERS, context))
+        train_only = self.parameterAsBool(p, self.TRAIN_ONLY, context)
+        cache_dir = self.parameterAsFile(p, self.CACHE_DIR, context)
+        cache = FeatureCache(cache_dir, self.parameterAsDouble(p, self.CACHE_MAX_GB, context) * 1024**3) if cache_dir else None
+        ent_cfg = (ent_radius, ent_on_bands, ent_on_indices)
+        kind = MODEL_KINDS[self.parameterAsEnum(p, self.MODEL_KIND, context)][0]
+        tune = None
+        if self.parameterAsBool(p, self.TUNE, context):
+            tune = (self.parameterAsInt(p, self.CV_FOLDS, context), self.parameterAsInt(p, self.CV_BLOCK, context),
+                    self.parameterAsString(p, self.CV_GRID, context))
+            parse_grid(tune[2])  # valida a grade antes de ler o raster
+        update_lyr = self.parameterAsRasterLayer(p, self.UPDATE_RASTER, context)
+        update_aoi = None
+        if update_lyr is not None:
+            update_aoi = self.parameterAsSource(p, self.UPDATE_AOI, context)
+            if update_aoi is None:
+                raise QgsProcessingException("O modo atualização requer a área a atualizar (AOI ou amostras alteradas).")
+            if train_only:
+                raise QgsProcessingException("'Apenas treinar' e o modo atualização são excludentes.")
+            out_tif = update_lyr.source().split('|')[0]
+            feedback.pushInfo(f"[Atualização] Raster atualizado no lugar: {out_tif}")
+            if proba_tif:
+                feedback.pushInfo("[Aviso] O modo atualização não gera o raster de probabilidade/incerteza.")
+                proba_tif = None
+        if train_only and not model_out:
+            raise QgsProcessingException("'Apenas treinar' requer o caminho de saída do modelo (.joblib).")
+        if not train_only and not out_tif:
+            raise QgsProcessingException("Informe o raster classificado de saída.")
+        if (train_only or not (model_in and os.path.exists(model_in))) and (samples is None or not class_field):
+            raise QgsProcessingException("Treino requer polígonos de amostra e campo de classe "
+                                         "(ou informe um modelo pré-treinado).")
+        if not train_only: check_geotiff_path(out_tif)
+        if proba_tif: check_geotiff_path(proba_tif)
+        if train_only and proba_tif:
+            feedback.pushInfo("[Aviso] 'Apenas treinar' não gera o raster de probabilidade/incerteza.")
+            proba_tif = None
+        custom = self._custom_indices(p, context, bandmap, None if train_only else model_in, feedback)
+        outputs = {self.RASTER_OUT: out_tif}
+        if proba_tif: outputs[self.PROBA_OUT] = proba_tif
+
         with rasterio.open(src_path) as ds:
             raster_crs = QgsCoordinateReferenceSystem.fromWkt(ds.crs.to_wkt()) if ds.crs else rlyr.crs()
             feedback.pushInfo(f"[Abertura] Dimensões: {ds.width}×{ds.height} px; bandas: {ds.count}")
             feedback.pushInfo(f"[Abertura] BANDMAP: {bandmap}")
-            prog(8, "Lendo bandas…")
-
-            # Leitura + máscara
-            B, valid_mask = read_bands(ds, bandmap, feedback)
-            if not B: raise QgsProcessingException("BANDMAP não corresponde a bandas existentes.")
-            stack, feat_names = stack_features(B, feedback)
-
-            # Entropia (opcional)
-            if ent_radius and (ent_on_bands or ent_on_indices):
-                feedback.pushInfo(f"[Entropia] Raio={ent_radius}px; bandas={ent_on_bands}; índices={ent_on_indices}")
-                stack, feat_names = append_entropy_features_from_stack(
-                    stack, feat_names, ent_radius, ent_on_bands, ent_on_indices, feedback
+
+            if tiled or train_only or update_aoi is not None:
+                return self._process_tiled(
+                    ds, bandmap, raster_crs, samples, class_field, n_per, n_trees,
+                    min_patch, mode_radius, exclude, ignore_nodata, model_in, model_out, out_tif,
+                    ent_cfg, v_src, v_class_field, v_n,
+                    tile_size, workers, feedback, prog, timer, train_only=train_only, load_model=load_model, cache=cache,
+                    save_model=save_model, proba_tif=proba_tif, tune=tune, kind=kind, update_aoi=update_aoi, custom=custom
                 )
 
+            prof = tiled_profile(ds, tile_size)
+            npix = ds.width * ds.height
+            report = {}
+
+            with timer.stage("Leitura + features", 8, 45, npix) as fb:
+                entry, ckey = None, None
+                if cache is not None:
+                    ckey = FeatureCache.key(src_path, bandmap, ent_cfg, 'full', custom)
+                    entry = cache.lookup(ckey)
+                if entry is not None:
+                    fb.pushInfo(f"[Cache] Features reaproveitadas: {entry.path}")
+                    feat_names, valid_mask = list(entry.names), np.array(entry.valid)
+                    stack = FeatureStack.from_dense(entry.features, feat_names)
+                    entry = None
+                else:
+                    # Leitura + máscara
+                    B, valid_mask = read_bands(ds, bandmap, fb)
+                    if not B: raise QgsProcessingException("BANDMAP não corresponde a bandas existentes.")
+                    stack, feat_names = stack_features(B, fb, custom)
+
+                    # Entropia (opcional)
+                    if ent_radius and (ent_on_bands or ent_on_indices):
+                        fb.pushInfo(f"[Entropia] Raio={ent_radius}px; bandas={ent_on_bands}; índices={ent_on_indices}")
+                        stack, feat_names = append_entropy_features_from_stack(
+                            stack, feat_names, ent_radius, ent_on_bands, ent_on_indices, fb
+                        )
+                    fb.pushInfo(f"[Memória] Cubo de features: {stack.nbytes / 2**20:.0f} MB "
+                                f"(float32: {np.prod(stack.shape) * 4 / 2**20:.0f} MB)")
+                    if cache is not None:
+                        entry = cache.create(ckey, stack.shape, feat_names)
+                        if entry is not None:
+                            for r0 in range(0, stack.shape[0], 256):
+                                check_canceled(fb)
+                                entry.features[r0:r0 + 256] = stack[r0:r0 + 256]
+                            entry.valid[:] = valid_mask
+                            entry.mark_complete()
+                            fb.pushInfo(f"[Cache] Features gravadas: {entry.path}")
+                        else:
+                            fb.pushInfo("[Cache] Cubo maior que o limite do cache; não gravado.")
+                        entry = None
+
             #  Inferência com modelo carregado
             if model_in and os.path.exists(model_in):
                 feedback.pushInfo("[Modelo] Carregando modelo pré-treinado…")
-                model, meta = load_model_bundle(model_in)
-                want = meta['feature_names']; have = {n: i for i, n in enumerate(feat_names)}
-                missing = [n for n in want if n not in have]
-                if missing:
-                    raise QgsProcessingException(f"Features exigidas pelo modelo ausentes: {missing}")
-                stack = stack[..., [have[n] for n in want]]
+                model, meta = load_model(model_in)
+                want = meta['feature_names']
+                feature_order(feat_names, want)
                 stats = meta['scaler']['stats']
-                robust_transform_inplace(stack, stats)
-                prog(55, "Normalizando…")
-
-                feedback.pushInfo("[Inferência] Classificando…")
-                ymap = classify_blockwise(stack, model, valid_mask)
-                prog(80, "Pós-processando…")
-                ymap = remove_small_patches(ymap, min_patch, exclude, mode_radius,
-                                            ignore_zero=ignore_nodata, connectivity=2)
-
-                # Salvar
-                prof = ds.profile.copy()
-                prof.update(count=1, dtype=str(ymap.dtype), nodata=0, compress='deflate', predictor=2)
-                with rasterio.open(out_tif, 'w', **prof) as outds:
-                    outds.write(ymap, 1)
+                stack = stack.select(want).scaled(stats)
+
+                with timer.stage("Classificação", 50, 85, npix) as fb:
+                    with open_proba(proba_tif, prof) as pds:
+                        ymap = classify_blockwise(stack, model, valid_mask, block=tile_size, workers=workers,
+                                                  proba_ds=pds, feedback=fb)
+                with timer.stage("Pós-processamento", 85, 95, npix) as fb:
+                    ymap = remove_small_patches(ymap, min_patch, exclude, mode_radius,
+                                                ignore_zero=ignore_nodata, connectivity=2, feedback=fb)
+                    # Salvar
+                    with cog_writer(out_tif, prof, block=prof['blockxsize']) as outds:
+                        outds.write(ymap, 1)
+                report["stages"] = timer.stages
+                save_json_report(out_tif, report, feedback)
                 prog(100, "Concluído.")
-                return {self.RASTER_OUT: out_tif}
+                return outputs
 
             #Caminho B: Treino + criação de modelo
             if samples is None:
                 raise QgsProcessingException("Amostras não fornecidas e nenhum MODEL_IN informado.")
-            feedback.pushInfo("[Amostragem] Gerando pontos estratificados (treino)…")
-            pts = stratified_points(samples, class_field, n_per, raster_crs)
-            prog(45, "Extraindo amostras (treino)…")
-
-            X, y_lbl = sample_stack_at_points(ds, stack, pts)
-            good = np.all(np.isfinite(X), axis=1)
-            X, y_lbl = X[good], y_lbl[good]
-            if X.size == 0: raise QgsProcessingException("Amostras inválidas após máscara/NaN.")
-            feedback.pushInfo(f"[Amostragem] Treino: {X.shape[0]} amostras; {X.shape[1]} features.")
-
-            # Validação com outras amostras opcional
-            Xv = yv = None
-            if v_src:
-                feedback.pushInfo("[Validação] Gerando pontos estratificados (validação)…")
-                v_pts = stratified_points(v_src, v_class_field or class_field, v_n, raster_crs)
-                Xv, yv = sample_stack_at_points(ds, stack, v_pts)
-                goodv = np.all(np.isfinite(Xv), axis=1)
-                Xv, yv = Xv[goodv], yv[goodv]
-                feedback.pushInfo(f"[Validação] {Xv.shape[0]} amostras de validação.")
+            with timer.stage("Amostragem", 45, 50) as fb:
+                fb.pushInfo("[Amostragem] Gerando pontos estratificados (treino)…")
+                pts = stratified_points(samples, class_field, n_per, raster_crs)
+                X, y_lbl = sample_stack_at_points(ds, stack, pts)
+                good = np.all(np.isfinite(X), axis=1)
+                X, y_lbl, rc = X[good], y_lbl[good], sample_rowcol(ds, pts)[good]
+                if X.size == 0: raise QgsProcessingException("Amostras inválidas após máscara/NaN.")
+                fb.pushInfo(f"[Amostragem] Treino: {X.shape[0]} amostras; {X.shape[1]} features.")
+
+                # Validação com outras amostras opcional
+                Xv = yv = None
+                if v_src:
+                    fb.pushInfo("[Validação] Gerando pontos estratificados (validação)…")
+                    v_pts = stratified_points(v_src, v_class_field or class_field, v_n, raster_crs)
+                    Xv, yv = sample_stack_at_points(ds, stack, v_pts)
+                    goodv = np.all(np.isfinite(Xv), axis=1)
+                    Xv, yv = Xv[goodv], yv[goodv]
+                    fb.pushInfo(f"[Validação] {Xv.shape[0]} amostras de validação.")
 
             # Escalonamento robusto (ajustar nos PREDITORES do raster)
-            stats = robust_fit_stats(stack)
-            robust_transform_inplace(stack, stats)
-            robust_transform_inplace(X, stats)
-            if Xv is not None: robust_transform_inplace(Xv, stats)
-            prog(55, "Treinando RF…")
+            with timer.stage("Escalonamento robusto", 50, 55, npix) as fb:
+                stats, stats_info = robust_fit_stats(stack, valid_mask, feedback=fb)
+                fb.pushInfo(f"[Escala] Mediana/IQR: {stats_info['method']}; erro de posto ≤ {stats_info['rank_error']:.4f}")
+                stack = stack.scaled(stats)
+                robust_transform_inplace(X, stats)
+                if Xv is not None: robust_transform_inplace(Xv, stats)
 
             y_enc, labmap = encode_labels(y_lbl)
             label_map_inv = invert_mapping(labmap)
 
-            model = train_rf(X, y_enc, n_trees=n_trees)
-            feedback.pushInfo(f"[Modelo] OOB accuracy: {getattr(model,'oob_score_', None)}")
-            prog(70, "Classificando raster…")
+            with timer.stage("Treino", 55, 70) as fb:
+                model, n_trees, cv = self._train_model(X, y_enc, rc, n_trees, tune, workers, fb,
+                                                       model_out or out_tif, kind)
+                if hasattr(model, 'oob_score_'): fb.pushInfo(f"[Modelo] OOB accuracy: {model.oob_score_}")
 
-            ymap = classify_blockwise(stack, model, valid_mask)  # 0=NoData; classes 1..K
-            prog(85, "Pós-processando…")
-            ymap = remove_small_patches(ymap, min_patch, exclude, mode_radius,
-                                        ignore_zero=ignore_nodata, connectivity=2)
+            with timer.stage("Classificação", 70, 85, npix) as fb:
+                with open_proba(proba_tif, prof) as pds:
+                    ymap = classify_blockwise(stack, model, valid_mask, block=tile_size, workers=workers,
+                                              proba_ds=pds, feedback=fb)  # 0=NoData; classes 1..K
+            with timer.stage("Pós-processamento", 85, 92, npix) as fb:
+                ymap = remove_small_patches(ymap, min_patch, exclude, mode_radius,
+                                            ignore_zero=ignore_nodata, connectivity=2, feedback=fb)
 
-            # Salvar raster
-            prof = ds.profile.copy()
-            prof.update(count=1, dtype=str(ymap.dtype), nodata=0, compress='deflate', predictor=2)
-            with rasterio.open(out_tif, 'w', **prof) as outds:
-                outds.write(ymap, 1)
+                # Salvar raster
+                with cog_writer(out_tif, prof, block=prof['blockxsize']) as outds:
+                    outds.write(ymap, 1)
 
             prog(92, "Relatórios…")
             
             # Métricas
-            report = {
+            report.update({
                 "labels": label_map_inv,  # code -> label
-            }
+                "model_kind": model_kind(model),
+            })
+            if cv: report["cv"] = cv
             try:
                 report.update(metrics_oob(model, y_enc, label_map_inv))
                 if Xv is not None:
@@ -788,12 +2182,272 @@ Fluxo de uso:
                 feedback.pushInfo(f"[VAL] acc={report['val_accuracy']:.4f}; kappa={report['val_kappa']:.4f}")
                 feedback.pushInfo("[VAL] Relatório por classe:\n" + report.get("val_classification_report",""))
 
+            report["stages"] = timer.stages
             save_json_report(out_tif, report, feedback)
 
             if model_out:
-                save_model_bundle(model, labmap, list(feat_names), stats, model_out, n_trees)
-                prog(100, "Concluído.")
-                return {self.MODEL_OUT: model_out, self.RASTER_OUT: out_tif}
-            else:
-                prog(100, "Concluído.")
-                return {self.RASTER_OUT: out_tif}
+                save_model(model, labmap, list(feat_names), stats, model_out, n_trees, stats_info, custom)
+                outputs[self.MODEL_OUT] = model_out
+            prog(100, "Concluído.")
+            return outputs
+
+    def _custom_indices(self, p, context, bandmap, model_in, feedback):
+        """Índices personalizados validados contra o BANDMAP; com modelo pré-treinado, os do _meta.json."""
+        text = self.parameterAsString(p, self.CUSTOM_INDICES, context) or ''
+        meta_path = os.path.splitext(model_in)[0] + "_meta.json" if model_in else None
+        if meta_path and os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f).get("custom_indices") or {}
+            try:
+                differs = bool(text.strip()) and parse_custom_indices(text) != saved
+            except ValueError:
+                differs = True     # parâmetro inválido, mas ignorado: valem os do modelo
+            if differs:
+                feedback.pushInfo("[Aviso] Índices personalizados do parâmetro ignorados: valem os do modelo.")
+            text = '; '.join(f"{k} = {v}" for k, v in saved.items())
+        try:
+            custom = parse_custom_indices(text, bandmap.keys())
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        for name, expr in custom.items():
+            feedback.pushInfo(f"[Índice] Personalizado: {name} = {expr}")
+        return custom
+
+    def _train_model(self, X, y_enc, rc, n_trees, tune, workers, feedback, base, kind='rf'):
+        """train_model com os parâmetros fixos, ou (tune, só RF) CV espacial sobre a grade e retreino da
+        melhor combinação com todas as amostras. Retorna (modelo, nº de árvores, resumo da CV ou None)."""
+        if tune and kind != 'rf':
+            feedback.pushInfo("[CV] Aviso: o ajuste de hiperparâmetros vale só para o RF; ignorado.")
+            tune = None
+        if not tune:
+            t0 = time.perf_counter()
+            model = train_model(X, y_enc, kind, n_trees)
+            feedback.pushInfo(f"[Modelo] {model_kind(model)} treinado em {time.perf_counter() - t0:.1f}s")
+            return model, n_trees, None
+        k, block, grid = tune
+        combos = parse_grid(grid)
+        folds = spatial_folds(rc, k, block)
+        feedback.pushInfo(f"[CV] {len(combos)} combinações × {k} dobras espaciais (bloco {block}px); threads={workers}")
+        results = cv_search(X, y_enc, folds, combos, workers, feedback)
+        for r in results[:5]:
+            feedback.pushInfo(f"[CV] #{r['rank']}: trees={r['n_trees']}, max_features={r['max_features']}, "
+                              f"min_samples_leaf={r['min_samples_leaf']} → kappa={r['kappa_mean']:.4f}±{r['kappa_std']:.4f}, "
+                              f"acc={r['acc_mean']:.4f}")
+        table = save_cv_table(base, results, feedback)
+        best = results[0]
+        feedback.pushInfo("[CV] Retreinando a melhor combinação com todas as amostras…")
+        model = train_rf(X, y_enc, n_trees=best['n_trees'], max_feats=best['max_features'],
+                         min_leaf=best['min_samples_leaf'])
+        return model, best['n_trees'], {"table": table, "folds": k, "block_px": block,
+                                        "best": best, "results": results}
+
+    def _process_batch(self, p, context, feedback, prog, timer, scenes):
+        """Modo em lote: um modelo carregado uma vez aplicado a várias cenas (classify_scene em pool)."""
+        if not scenes:
+            raise QgsProcessingException("Nenhum raster encontrado para o lote.")
+        model_in = self.parameterAsFile(p, self.MODEL_IN, context)
+        if not model_in or not os.path.exists(model_in):
+            raise QgsProcessingException("O modo em lote requer um modelo pré-treinado (.joblib); "
+                                         "use 'Apenas treinar' para gerá-lo.")
+        out_dir = self.parameterAsString(p, self.BATCH_OUT_DIR, context)
+        if not out_dir:
+            raise QgsProcessingException("Informe a pasta de saída do lote.")
+        os.makedirs(out_dir, exist_ok=True)
+
+        bandmap = parse_band_mapping(self.parameterAsString(p, self.BANDMAP, context))
+        ent_cfg = (self.parameterAsInt(p, self.ENT_RADIUS, context),
+                   self.parameterAsBool(p, self.ENT_ON_BANDS, context),
+                   self.parameterAsBool(p, self.ENT_ON_INDICES, context))
+        workers = resolve_workers(self.parameterAsInt(p, self.N_WORKERS, context))
+        custom = self._custom_indices(p, context, bandmap, model_in, feedback)
+
+        prog(3, "Carregando modelo…")
+        t0 = time.perf_counter()
+        model, meta = cached_model_bundle(
+            model_in, flat=self.parameterAsBool(p, self.FLAT_PREDICTOR, context),
+            mmap=self.parameterAsBool(p, self.MODEL_MMAP, context),
+            max_bytes=self.parameterAsDouble(p, self.MODEL_CACHE_GB, context) * 1024**3, feedback=feedback)
+        load_s = time.perf_counter() - t0
+        feedback.pushInfo(f"[Lote] {len(scenes)} cenas; modelo carregado em {load_s:.2f}s; threads={workers}")
+
+        out_paths = batch_output_paths(scenes, out_dir)
+        with timer.stage("Lote", 10, 95) as fb:
+            records = run_batch(
+                scenes, out_paths, model, meta['feature_names'], meta['scaler']['stats'], bandmap,
+                self.parameterAsInt(p, self.TILE_SIZE, context), ent_cfg,
+                self.parameterAsInt(p, self.MIN_PATCH, context),
+                parse_int_csv(self.parameterAsString(p, self.EXCLUDE_CLASSES, context)),
+                self.parameterAsInt(p, self.MODE_RADIUS, context),
+                ignore_zero=self.parameterAsBool(p, self.MODE_IGNORE_NODATA, context),
+                workers=workers, feedback=fb, custom=custom
+            )
+        ok = [r["output"] for r in records if r["status"] == "ok"]
+        if not ok:
+            raise QgsProcessingException("Nenhuma cena do lote foi classificada; veja o log.")
+
+        report = {"model": model_in, "model_load_s": round(load_s, 3),
+                  "total_s": round(time.perf_counter() - t0, 3), "workers": workers, "scenes": records,
+                  "stages": timer.stages}
+        outputs = {self.BATCH_OUT_DIR: out_dir}
+        if self.parameterAsBool(p, self.BATCH_VRT, context):
+            prog(96, "Mosaico VRT…")
+            try:
+                report["vrt"] = build_vrt(os.path.join(out_dir, "batch_mosaic.vrt"), ok)
+                feedback.pushInfo(f"[Lote] Mosaico: {report['vrt']}")
+            except Exception as e:
+                feedback.pushInfo(f"[Lote] Aviso: VRT não gerado: {e}")
+        save_json_report(os.path.join(out_dir, "batch"), report, feedback)
+        prog(100, "Concluído.")
+        return outputs
+
+    def _process_tiled(self, ds, bandmap, raster_crs, samples, class_field, n_per, n_trees,
+                       min_patch, mode_radius, exclude, ignore_nodata, model_in, model_out, out_tif,
+                       ent_cfg, v_src, v_class_field, v_n, tile_size, workers, feedback, prog, timer,
+                       train_only=False, load_model=load_model_bundle, cache=None, proba_tif=None, tune=None,
+                       kind='rf', update_aoi=None, custom=None, save_model=save_model_bundle):
+        """Mesmo fluxo de processAlgorithm, sem materializar o cubo de features da cena inteira.
+        train_only: treino a partir de janelas em volta das amostras, sem a passada de inferência.
+        update_aoi: só os blocos que tocam a AOI são reclassificados e gravados no lugar em out_tif."""
+        tile = aligned_tile_size(ds, tile_size)
+        feedback.pushInfo(f"[Blocos] Bloco={tile}px; halo entropia={ent_cfg[0] if (ent_cfg[1] or ent_cfg[2]) else 0}px; threads={workers}")
+        npix = ds.width * ds.height
+        region = None
+        if update_aoi is not None:
+            with rasterio.open(out_tif) as old:
+                if (old.width, old.height) != (ds.width, ds.height) or not old.transform.almost_equals(ds.transform):
+                    raise QgsProcessingException("O raster a atualizar deve ter a mesma grade "
+                                                 "(dimensões e transformação) do raster de entrada.")
+            region = aoi_windows(ds, update_aoi, raster_crs, tile)
+            if not region: raise QgsProcessingException("A área a atualizar não intersecta o raster.")
+            npix = sum(int(w.width) * int(w.height) for w in region)
+            feedback.pushInfo(f"[Atualização] {len(region)} retângulo(s); {npix} px "
+                              f"({100.0 * npix / (ds.width * ds.height):.1f}% da cena)")
+        with timer.stage("Escala da entropia", 5, 8):
+            u8_scaling = band_u8_scaling(ds, bandmap)
+            _, feat_names, _ = window_features(ds, bandmap, Window(0, 0, 1, 1), ent_cfg, u8_scaling, custom=custom)
+        entry = None
+        if cache is not None:
+            ckey = FeatureCache.key(ds.name, bandmap, ent_cfg, 'tiled', custom)
+            entry = cache.lookup(ckey)
+            if entry is not None:
+                feedback.pushInfo(f"[Cache] Features reaproveitadas: {entry.path}")
+            elif not train_only and region is None:
+                entry = cache.create(ckey, (ds.height, ds.width, len(feat_names)), feat_names)
+                if entry is not None: feedback.pushInfo(f"[Cache] Features serão gravadas em: {entry.path}")
+
+        prof = tiled_profile(ds, tile)
+        raw_tif = os.path.splitext(out_tif)[0] + "_raw.tif" if min_patch > 0 and region is None else out_tif
+
+        report = None
+        if train_only and model_in:
+            feedback.pushInfo("[Aviso] 'Apenas treinar' ignora o modelo pré-treinado informado.")
+        if model_in and os.path.exists(model_in) and not train_only:
+            feedback.pushInfo("[Modelo] Carregando modelo pré-treinado…")
+            model, meta = load_model(model_in)
+            order = feature_order(feat_names, meta['feature_names'])
+            stats = meta['scaler']['stats']
+        else:
+            if samples is None:
+                raise QgsProcessingException("Amostras não fornecidas e nenhum MODEL_IN informado.")
+            with timer.stage("Amostragem", 8, 25) as fb:
+                fb.pushInfo("[Amostragem] Gerando pontos estratificados (treino)…")
+                pts = stratified_points(samples, class_field, n_per, raster_crs)
+                X, y_lbl, _ = sample_features_windowed(ds, bandmap, pts, ent_cfg, u8_scaling, feedback=fb, cache=entry,
+                                                       custom=custom)
+                good = np.all(np.isfinite(X), axis=1)
+                X, y_lbl, rc = X[good], y_lbl[good], sample_rowcol(ds, pts)[good]
+                if X.size == 0: raise QgsProcessingException("Amostras inválidas após máscara/NaN.")
+                fb.pushInfo(f"[Amostragem] Treino: {X.shape[0]} amostras; {X.shape[1]} features.")
+
+                Xv = yv = None
+                if v_src:
+                    fb.pushInfo("[Validação] Gerando pontos estratificados (validação)…")
+                    v_pts = stratified_points(v_src, v_class_field or class_field, v_n, raster_crs)
+                    Xv, yv, _ = sample_features_windowed(ds, bandmap, v_pts, ent_cfg, u8_scaling, feedback=fb,
+                                                         cache=entry, custom=custom)
+                    goodv = np.all(np.isfinite(Xv), axis=1)
+                    Xv, yv = Xv[goodv], yv[goodv]
+                    fb.pushInfo(f"[Validação] {Xv.shape[0]} amostras de validação.")
+
+            with timer.stage("Escalonamento robusto", 25, 35) as fb:
+                stats, stats_info = fit_stats_tiled(ds, bandmap, ent_cfg, u8_scaling, tile, workers=workers,
+                                                    cache=entry, feedback=fb, custom=custom)
+                fb.pushInfo(f"[Escala] Mediana/IQR em {stats_info['tiles_used']}/{stats_info['tiles_total']} blocos; "
+                            f"erro de posto ≤ {stats_info['rank_error']:.4f}")
+                robust_transform_inplace(X, stats)
+                if Xv is not None: robust_transform_inplace(Xv, stats)
+
+            y_enc, labmap = encode_labels(y_lbl)
+            label_map_inv = invert_mapping(labmap)
+            with timer.stage("Treino", 35, 50) as fb:
+                model, n_trees, cv = self._train_model(X, y_enc, rc, n_trees, tune, workers, fb,
+                                                       model_out or out_tif, kind)
+                if hasattr(model, 'oob_score_'): fb.pushInfo(f"[Modelo] OOB accuracy: {model.oob_score_}")
+
+            report = {"labels": label_map_inv, "model_kind": model_kind(model)}
+            if cv: report["cv"] = cv
+            try:
+                report.update(metrics_oob(model, y_enc, label_map_inv))
+                if Xv is not None:
+                    report.update(metrics_validation(model, Xv, yv, labmap, label_map_inv))
+            except Exception as e:
+                feedback.pushInfo(f"[Métricas] Aviso: {e}")
+            if "oob_accuracy" in report:
+                feedback.pushInfo(f"[OOB] acc={report['oob_accuracy']:.4f}; kappa={report.get('oob_kappa', float('nan')):.4f}")
+            if "val_accuracy" in report:
+                feedback.pushInfo(f"[VAL] acc={report['val_accuracy']:.4f}; kappa={report['val_kappa']:.4f}")
+                feedback.pushInfo("[VAL] Relatório por classe:\n" + report.get("val_classification_report",""))
+            order = None
+
+        if train_only:
+            prog(92, "Relatórios…")
+            report["stages"] = timer.stages
+            save_json_report(model_out, report, feedback)
+            save_model(model, labmap, list(feat_names), stats, model_out, n_trees, stats_info, custom)
+            prog(100, "Concluído.")
+            return {self.MODEL_OUT: model_out}
+
+        # No modo atualização os blocos da AOI são gravados no próprio arquivo (r+), sem cópia
+        cls_tif = out_tif if region is not None else raw_tif
+        with timer.stage("Classificação (blocos)", 55, 85, npix) as fb:
+            classify_tiled(ds, bandmap, model, order, stats, cls_tif, prof, tile, ent_cfg, u8_scaling,
+                           fb, workers=workers, cache=entry, proba_path=proba_tif, region=region, custom=custom)
+        entry = None
+
+        if region is not None:
+            if min_patch > 0:
+                with timer.stage("Pós-processamento (AOI)", 85, 90, npix) as fb:
+                    remove_small_patches_region(cls_tif, region, min_patch, exclude, mode_radius,
+                                                ignore_zero=ignore_nodata, connectivity=2, feedback=fb)
+            with timer.stage("Overviews (AOI)", 90, 92, npix):
+                refresh_overviews(out_tif, region, 'nearest')
+        if min_patch > 0 and region is None:
+            with timer.stage("Pós-processamento (blocos)", 85, 90, npix) as fb:
+                try:
+                    remove_small_patches_tiled(raw_tif, out_tif, prof, min_patch, exclude, mode_radius, tile,
+                                               ignore_zero=ignore_nodata, connectivity=2, feedback=fb)
+                finally:
+                    try:
+                        os.remove(raw_tif)
+                    except OSError:
+                        pass
+        if region is None:
+            with timer.stage("COG + overviews", 90, 92, npix):
+                finalize_cog(out_tif)
+
+        outputs = {self.RASTER_OUT: out_tif}
+        if proba_tif: outputs[self.PROBA_OUT] = proba_tif
+        prog(92, "Relatórios…")
+        trained = report is not None
+        if not trained: report = {}
+        report["stages"] = timer.stages
+        if region is not None:
+            report["update"] = {"windows": [[int(w.col_off), int(w.row_off), int(w.width), int(w.height)] for w in region],
+                                "pixels": npix}
+        save_json_report(os.path.splitext(out_tif)[0] + ("_update" if region is not None else ""), report, feedback)
+
+        prog(100, "Concluído.")
+        if trained and model_out:
+            save_model(model, labmap, list(feat_names), stats, model_out, n_trees, stats_info, custom)
+            outputs[self.MODEL_OUT] = model_out
+        return outputs
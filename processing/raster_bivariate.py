@@ -31,6 +31,8 @@ from PIL import Image, ImageDraw
 import rasterio
 from rasterio.warp import reproject, Resampling
 
+from .raster_io import cog_writer
+
 
 class BivariateRaster(QgsProcessingAlgorithm):
     RASTER_A = 'RASTER_A'
@@ -113,8 +115,8 @@ class BivariateRaster(QgsProcessingAlgorithm):
         })
 
         #-----------------------------------
-        # write TIF
-        with rasterio.open(output_path, 'w', **meta) as dst:
+        # write TIF (COG, NEAREST overviews: classes 1..9)
+        with cog_writer(output_path, meta, 'nearest') as dst:
             dst.write(np.nan_to_num(band1, nan=-9999.0), 1)
             dst.update_tags(1, BANDNAME='Bivariate')
         #-----------------------------------
@@ -31,6 +31,8 @@ from PIL import Image, ImageDraw
 import rasterio
 from rasterio.warp import reproject, Resampling
 
+from .raster_io import cog_writer
+
 
 class BivariateRasterRGB(QgsProcessingAlgorithm):
     RASTER_A = 'RASTER_A'
@@ -164,8 +166,8 @@ class BivariateRasterRGB(QgsProcessingAlgorithm):
         })
 
         #-----------------------------------
-        # Escrever TIFF com 5 bandas em float32
-        with rasterio.open(output_path, 'w', **meta) as dst:
+        # Escrever TIFF com 5 bandas em float32 (COG, overviews NEAREST: cores por classe)
+        with cog_writer(output_path, meta, 'nearest') as dst:
             for b in range(3):
                 dst.write(np.nan_to_num(rgb_arr[:, :, b], nan=-9999.0), b + 1)
             dst.write(np.nan_to_num(band4, nan=-9999.0), 4)
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+/***********************************************
+ Arqueokit - QGIS Plugin
+ Motor de índices espectrais compartilhado (classificação e geração de índices)
+ Autor: Geraldo Pereira de Morais Júnior
+ Email: geraldo.pmj@gmail.com
+ ***********************************************/
+"""
+__author__ = 'Geraldo Pereira de Morais Júnior'
+__date__ = '2025-09-05'
+__copyright__ = '(C) 2025 by Geraldo Pereira de Morais Júnior'
+__revision__ = '$Format:%H$'
+
+import ast
+
+import numpy as np
+
+
+# -------------------- Catálogo -------------------- #
+
+BAND_KEYS = ('R', 'G', 'B', 'NIR', 'SWIR1', 'SWIR2')
+
+# Ordem = ordem das features na classificação e das opções em "Índices a calcular"
+INDEX_FORMULAS = {
+    'NDVI':   "(NIR - R) / (NIR + R)",
+    'EVI2':   "2.5 * ((NIR - R) / (NIR + 2.4*R + 1))",
+    'SAVI':   "1.7 * ((NIR - R) / (NIR + R + 0.7))",
+    'MSAVI2': "(2*NIR + 1 - sqrt((2*NIR + 1)**2 - 8*(NIR - R))) / 2",
+    'OSAVI':  "1.16 * ((NIR - R) / (NIR + R + 0.16))",
+    'CAI':    "SWIR2 / SWIR1",
+    'NBR2':   "(SWIR1 - SWIR2) / (SWIR1 + SWIR2)",
+    'NDWI':   "(NIR - SWIR1) / (NIR + SWIR1)",   # ≃ NDMI (Gao)
+    'NDMI':   "(NIR - SWIR1) / (NIR + SWIR1)",
+    'BSCI':   "(SWIR1 - NIR) / (SWIR1 + NIR)",
+    'GCVI':   "NIR / G - 1",
+    'GNDVI':  "(NIR - G) / (NIR + G)",
+    'HallCover': "-0.017*R + (-0.007*NIR) + (-0.079*SWIR2) + 5.22",
+    'PRI':    "(B - G) / (B + G)",
+    'VARI':   "(G - R) / (G + R - B)",
+    'EXG':    "2*G - R - B",
+    'GRVI':   "(G - R) / (G + R)",
+    'NDTI':   "(R - G) / (R + G)",
+    'BSI':    "((SWIR1 + R) - (NIR + B)) / ((SWIR1 + R) + (NIR + B))",
+    'ARVI':   "(NIR - (2*R - B)) / (NIR + (2*R - B))",
+    'SIPI':   "(NIR - B) / (NIR + R)",
+    'GVMI':   "((NIR + 0.1) - (SWIR2 + 0.02)) / ((NIR + 0.1) + (SWIR2 + 0.02))",
+    'NMDI':   "(NIR - (SWIR1 - SWIR2)) / (NIR + (SWIR1 - SWIR2))",
+    'NDWI_McFeeters': "(G - NIR) / (G + NIR)",
+    'NBR':    "(NIR - SWIR2) / (NIR + SWIR2)",
+    'NDSI':   "(G - SWIR1) / (G + SWIR1)",
+    'EVI':    "2.5 * ((NIR - R) / (NIR + 6*R - 7.5*B + 1))",
+}
+
+# Diferenças normalizadas: sempre em [-1, 1]
+ND_INDICES = {'NDVI', 'NBR2', 'NDWI', 'NDMI', 'BSCI', 'GNDVI', 'PRI', 'GRVI', 'NDTI', 'BSI',
+              'NDWI_McFeeters', 'NBR', 'NDSI'}
+
+# Intervalo nominal (bandas normalizadas em [0,1]) dos índices que saem de [-1, 1]
+INDEX_RANGES = {'EVI2': (-1.0, 1.5), 'CAI': (0.0, 2.0), 'GCVI': (-1.0, 9.0), 'HallCover': (5.1, 5.25),
+                'EXG': (-2.0, 2.0), 'SIPI': (-1.0, 2.0)}
+
+
+def index_range(name):
+    """Intervalo nominal do índice; (-1, 1) para os demais (inclusive os personalizados)."""
+    return INDEX_RANGES.get(name, (-1.0, 1.0))
+
+_BINOPS = {ast.Add: 'add', ast.Sub: 'sub', ast.Mult: 'mul', ast.Div: 'div', ast.Pow: 'pow'}
+_UFUNCS = {'add': np.add, 'sub': np.subtract, 'mul': np.multiply, 'div': np.divide, 'pow': np.power,
+           'neg': np.negative, 'sqrt': np.sqrt, 'abs': np.abs, 'log': np.log, 'exp': np.exp}
+_FUNCS = ('sqrt', 'abs', 'log', 'exp')
+_COMMUTATIVE = ('add', 'mul')
+
+
+def _fold(op, a, b=None):
+    with np.errstate(all='ignore'):
+        if b is None: return float(_UFUNCS[op](np.float64(a)))
+        return float(_UFUNCS[op](np.float64(a), np.float64(b)))
+
+
+def parse_formula(text):
+    """Árvore ast de uma expressão de índice; só números, nomes de banda, + - * / **, sqrt/abs/log/exp."""
+    try:
+        tree = ast.parse(str(text).strip(), mode='eval').body
+    except SyntaxError as e:
+        raise ValueError(f"Expressão inválida '{text}': {e.msg}")
+    for n in ast.walk(tree):
+        ok = isinstance(n, (ast.BinOp, ast.UnaryOp, ast.Name, ast.Load, ast.USub, ast.UAdd) + tuple(_BINOPS)) or \
+             (isinstance(n, ast.Constant) and isinstance(n.value, (int, float)) and not isinstance(n.value, bool)) or \
+             (isinstance(n, ast.Call) and isinstance(n.func, ast.Name) and n.func.id in _FUNCS
+              and len(n.args) == 1 and not n.keywords)
+        if not ok:
+            raise ValueError(f"Expressão inválida '{text}': elemento não permitido ({type(n).__name__}).")
+    return tree
+
+
+def formula_bands(text):
+    """Bandas (nomes) usadas pela expressão."""
+    tree = parse_formula(text)
+    calls = {id(n.func) for n in ast.walk(tree) if isinstance(n, ast.Call)}
+    return {n.id.upper() for n in ast.walk(tree) if isinstance(n, ast.Name) and id(n) not in calls}
+
+
+def available_index_names(keys, names=None):
+    """Índices do catálogo (ou de `names`) cujas bandas existem em `keys`, na ordem do catálogo."""
+    keys = {k.upper() for k in keys}
+    return [n for n in (names or INDEX_FORMULAS) if formula_bands(INDEX_FORMULAS[n]) <= keys]
+
+
+def parse_custom_indices(text, keys=None):
+    """'CM = (NIR-RE)/(NIR+RE); X = ...' (separados por ';' ou quebra de linha) → {nome: expressão}.
+    Nomes: identificadores únicos sem diferenciar maiúsculas (viram nomes de arquivo), fora do catálogo e
+    das bandas. keys: bandas do BANDMAP a exigir. Todo erro (inclusive divisão por zero constante) sai aqui."""
+    out, keys = {}, ({k.upper() for k in keys} if keys is not None else None)
+    reserved = set(BAND_KEYS) | (keys or set()) | {n.upper() for n in INDEX_FORMULAS}
+    for item in str(text or '').replace('\n', ';').split(';'):
+        if not item.strip(): continue
+        name, sep, expr = item.partition('=')
+        name = name.strip()
+        if not sep or not expr.strip():
+            raise ValueError(f"Índice personalizado inválido '{item.strip()}': use NOME = expressão.")
+        if not name.isidentifier():
+            raise ValueError(f"Nome de índice inválido: '{name}'.")
+        if name.upper() in reserved or name.upper() in {n.upper() for n in out} or name.upper().startswith('ENT_'):
+            raise ValueError(f"Nome de índice repetido ou reservado: '{name}'.")
+        used = formula_bands(expr)
+        if not used:
+            raise ValueError(f"Índice personalizado '{name}' não usa nenhuma banda.")
+        if keys is not None:
+            missing = used - keys
+            if missing:
+                raise ValueError(f"Índice personalizado '{name}' usa bandas ausentes do BANDMAP: {sorted(missing)}")
+        try:
+            IndexPlan({name: expr})   # constantes dobradas: acusa divisão por zero constante
+        except ValueError as e:
+            raise ValueError(f"Índice personalizado '{name}': {e}")
+        out[name] = expr.strip()
+    return out
+
+
+# -------------------- Plano (DAG) e avaliação -------------------- #
+
+class IndexPlan:
+    """Conjunto de índices compilado num único DAG de expressões: subtermos iguais (ex.: NIR+R em NDVI,
+    SAVI e OSAVI; NIR+SWIR1 e SWIR1+NIR) viram um só nó (hash-consing com operandos de + e * em ordem
+    canônica — sem reassociar, o resultado é idêntico ao da expressão original), constantes são dobradas.
+    division: 'nan' (divisão por zero → NaN) ou 'zero' (→ 0); vale para denominadores não constantes."""
+
+    def __init__(self, formulas, division='nan'):
+        if division not in ('nan', 'zero'):
+            raise ValueError("division deve ser 'nan' ou 'zero'.")
+        self.fill = np.nan if division == 'nan' else 0.0
+        self.nodes, self._ids = [], {}
+        self.outputs = [(name, self._build(parse_formula(text))) for name, text in formulas.items()]
+        self.n_ops_naive = sum(self._count_ops(parse_formula(t)) for t in formulas.values())
+
+    def _intern(self, key):
+        if key not in self._ids:
+            self._ids[key] = len(self.nodes)
+            self.nodes.append(key)
+        return self._ids[key]
+
+    def _const(self, i):
+        key = self.nodes[i]
+        return key[1] if key[0] == 'const' else None
+
+    def _build(self, n):
+        if isinstance(n, ast.Constant):
+            return self._intern(('const', float(n.value)))
+        if isinstance(n, ast.Name):
+            return self._intern(('band', n.id.upper()))
+        if isinstance(n, ast.UnaryOp):
+            a = self._build(n.operand)
+            if isinstance(n.op, ast.UAdd): return a
+            ca = self._const(a)
+            return self._intern(('const', -ca) if ca is not None else ('neg', a))
+        if isinstance(n, ast.Call):
+            a = self._build(n.args[0])
+            ca = self._const(a)
+            return self._intern(('const', _fold(n.func.id, ca)) if ca is not None else (n.func.id, a))
+        op = _BINOPS[type(n.op)]
+        a, b = self._build(n.left), self._build(n.right)
+        ca, cb = self._const(a), self._const(b)
+        if ca is not None and cb is not None:
+            if op == 'div' and cb == 0:
+                raise ValueError("Divisão por zero constante na expressão.")
+            return self._intern(('const', _fold(op, ca, cb)))
+        if op in _COMMUTATIVE and b < a: a, b = b, a
+        return self._intern((op, a, b))
+
+    def _count_ops(self, n):
+        return sum(isinstance(x, (ast.BinOp, ast.UnaryOp, ast.Call)) for x in ast.walk(n))
+
+    @property
+    def n_ops(self):
+        return sum(k[0] not in ('const', 'band') for k in self.nodes)
+
+    @property
+    def bands(self):
+        return {k[1] for k in self.nodes if k[0] == 'band'}
+
+    def run(self, bands, dtype=np.float32):
+        """Gera (nome, array) na ordem dos índices. Cada nó é avaliado uma vez, com ufuncs out= em buffers
+        reaproveitados (o operando em último uso recebe o resultado no lugar); um nó intermediário é
+        liberado assim que o último consumidor é avaliado. O array entregue pertence ao chamador."""
+        missing = self.bands - set(bands)
+        if missing:
+            raise ValueError(f"Bandas ausentes para os índices: {sorted(missing)}")
+        shape = next(iter(bands.values())).shape
+        refs = [0] * len(self.nodes)
+        for k in self.nodes:
+            if k[0] in ('const', 'band'): continue
+            for j in k[1:]: refs[j] += 1
+        for _, i in self.outputs: refs[i] += 1
+        cache, pool = {}, []
+
+        def release(j):
+            refs[j] -= 1
+            if refs[j] == 0 and j in cache: pool.append(cache.pop(j))
+
+        def value(i):
+            key = self.nodes[i]
+            if key[0] == 'const': return key[1]
+            if key[0] == 'band': return bands[key[1]]
+            if i in cache: return cache[i]
+            args = [value(j) for j in key[1:]]
+            # Operando intermediário no último uso: o resultado vai para o próprio buffer
+            reuse = next((j for j in key[1:] if j in cache and refs[j] == 1), None)
+            if reuse is not None:
+                out = cache.pop(reuse)
+            else:
+                out = pool.pop() if pool else np.empty(shape, dtype=dtype)
+            op = key[0]
+            if op == 'pow' and self._const(key[2]) == 2.0:
+                np.square(args[0], out=out)
+            elif op == 'div' and self._const(key[2]) is None:
+                np.divide(args[0], args[1], out=out)
+                np.copyto(out, self.fill, where=~np.isfinite(out))
+            else:
+                _UFUNCS[op](*args, out=out)
+            for j in key[1:]: release(j)
+            cache[i] = out
+            return out
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for name, i in self.outputs:
+                arr, kind = value(i), self.nodes[i][0]
+                if kind == 'const':
+                    arr = np.full(shape, arr, dtype=dtype)
+                elif kind == 'band':
+                    arr = arr.astype(dtype)    # cópia: a banda de entrada não é entregue
+                elif refs[i] > 1:
+                    arr = arr.copy()       # ainda usado adiante (outro índice ou nó)
+                else:
+                    cache.pop(i, None)     # entregue: sai do controle do plano
+                refs[i] -= 1
+                yield name, arr
@@ -16,14 +16,27 @@ from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm,
     QgsProcessingParameterRasterLayer, QgsProcessingParameterString,
-    QgsProcessingParameterEnum, QgsProcessingParameterBoolean,
+    QgsProcessingParameterEnum, QgsProcessingParameterBoolean, QgsProcessingParameterNumber,
     QgsProcessingParameterRasterDestination, QgsProcessingParameterFolderDestination,
+    QgsProcessingParameterFileDestination,
     QgsProcessingException, QgsRasterLayer, QgsProcessingContext
 )
 import os
+from contextlib import ExitStack
 import numpy as np
 import rasterio
 
+from .raster_io import (check_geotiff_path, cog_profile, cog_writer, block_for, iter_windows,
+                        check_canceled, resolve_workers, run_pipeline, thread_readers)
+from .raster_index_engine import (INDEX_FORMULAS, ND_INDICES, IndexPlan, available_index_names, formula_bands,
+                                  index_range, parse_custom_indices)
+
+# GDAL (stack VRT); present in any QGIS install
+try:
+    from osgeo import gdal
+except Exception:
+    gdal = None
+
 
 # -------------------- Utilities -------------------- #
 
@@ -42,119 +55,177 @@ def parse_band_mapping(mapping_text: str) -> dict:
     return band_mapping
 
 
-def safe_division(numerator_array: np.ndarray, denominator_array: np.ndarray) -> np.ndarray:
-    """Division that propagates NaN/Inf as NaN (no zeroing)."""
-    with np.errstate(divide='ignore', invalid='ignore'):
-        result = numerator_array / denominator_array
-    result[~np.isfinite(result)] = np.nan
-    return result
-
-
-def normalize_01(input_array: np.ndarray) -> np.ndarray:
-    """Min–max normalization to [0,1], ignoring NaNs. Constant bands → zeros."""
-    min_value = np.nanmin(input_array)
-    max_value = np.nanmax(input_array)
+def normalize_range(input_array: np.ndarray, min_value, max_value, clip: bool = False) -> np.ndarray:
+    """Normalization to [0,1] with a fixed (min, max). Non-finite range → NaN; constant → zeros.
+    clip=True clamps values outside the range (percentile normalization)."""
     if not np.isfinite(min_value) or not np.isfinite(max_value):
         return np.full_like(input_array, np.nan, dtype=np.float32)
     if max_value <= min_value:
         return np.zeros_like(input_array, dtype=np.float32)
-    return ((input_array - min_value) / (max_value - min_value)).astype(np.float32)
+    output_array = ((input_array - min_value) / (max_value - min_value)).astype(np.float32)
+    if clip:
+        np.clip(output_array, 0.0, 1.0, out=output_array)
+    return output_array
 
 
-def read_bands_and_mask(dataset: rasterio.io.DatasetReader, band_mapping: dict, feedback=None):
-    """
-    Read bands, apply valid mask, and inject NaN outside mask.
-    Returns: dict of bands (float32 with NaN) and global boolean mask (True = valid).
-    """
-    band_arrays, mask_list = {}, []
+def normalize_01(input_array: np.ndarray) -> np.ndarray:
+    """Min–max normalization to [0,1], ignoring NaNs. Constant bands → zeros."""
+    return normalize_range(input_array, np.nanmin(input_array), np.nanmax(input_array))
+
+
+def valid_band_mapping(dataset: rasterio.io.DatasetReader, band_mapping: dict, feedback=None) -> dict:
+    """Keep only BANDMAP entries that exist in the dataset (logging the choice)."""
+    valid_mapping = {}
     for band_name, band_index0 in band_mapping.items():
         if 0 <= band_index0 < dataset.count:
             if feedback:
                 feedback.pushInfo(f"[Band] {band_name} ← band {band_index0 + 1}")
-            band_array = dataset.read(band_index0 + 1).astype(np.float32)
+            valid_mapping[band_name] = band_index0
+        elif feedback:
+            feedback.pushInfo(f"[Aviso] '{band_name}={band_index0 + 1}' excede nº de bandas ({dataset.count}). Ignorado.")
+    return valid_mapping
 
-            valid_mask = dataset.read_masks(band_index0 + 1) > 0
-            if dataset.nodatavals and dataset.nodatavals[band_index0] is not None:
-                nodata_value = np.float32(dataset.nodatavals[band_index0])
-                valid_mask &= band_array != nodata_value
 
-            band_array[~valid_mask] = np.nan
-            band_arrays[band_name] = band_array
-            mask_list.append(valid_mask)
-        else:
-            if feedback:
-                feedback.pushInfo(f"[Aviso] '{band_name}={band_index0 + 1}' excede nº de bandas ({dataset.count}). Ignorado.")
+def read_bands_and_mask(dataset: rasterio.io.DatasetReader, band_mapping: dict, feedback=None, window=None):
+    """
+    Read bands (optionally a window), apply valid mask, and inject NaN outside mask.
+    Returns: dict of bands (float32 with NaN) and global boolean mask (True = valid).
+    """
+    band_arrays, mask_list = {}, []
+    for band_name, band_index0 in valid_band_mapping(dataset, band_mapping, feedback).items():
+        band_array = dataset.read(band_index0 + 1, window=window).astype(np.float32)
+
+        valid_mask = dataset.read_masks(band_index0 + 1, window=window) > 0
+        if dataset.nodatavals and dataset.nodatavals[band_index0] is not None:
+            nodata_value = np.float32(dataset.nodatavals[band_index0])
+            valid_mask &= band_array != nodata_value
+
+        band_array[~valid_mask] = np.nan
+        band_arrays[band_name] = band_array
+        mask_list.append(valid_mask)
     global_valid_mask = np.logical_and.reduce(mask_list) if mask_list else None
     return band_arrays, global_valid_mask
 
 
-def available_index_definitions(available_keys: set) -> dict:
+def streaming_band_ranges(dataset, band_mapping: dict, windows, low_pct=0.0, high_pct=100.0,
+                          sample_size=1_000_000, feedback=None) -> dict:
     """
-    Catalog {index_name: lambda(bands)}; only if required bands exist.
-    Input bands are normalized to [0,1] with NaNs at invalid pixels.
+    Pass 1 of the streaming mode: per-band (low, high) over block windows.
+    0/100 → exact min/max. Other percentiles come from a reproducible random sample
+    (≈ sample_size valid pixels per band, proportional to each window).
     """
-    has = {k: (k in available_keys) for k in ['R', 'G', 'B', 'NIR', 'SWIR1', 'SWIR2']}
-    index_functions = {}
-
-    # Vegetation
-    if has['NIR'] and has['R']:
-        index_functions['NDVI']   = lambda B: safe_division(B['NIR'] - B['R'], B['NIR'] + B['R'])
-        index_functions['EVI2']   = lambda B: 2.5 * safe_division(B['NIR'] - B['R'], B['NIR'] + 2.4*B['R'] + 1.0)
-        index_functions['SAVI']   = lambda B: 1.7 * safe_division(B['NIR'] - B['R'], B['NIR'] + B['R'] + 0.7)
-        index_functions['MSAVI2'] = lambda B: (2*B['NIR'] + 1.0 - np.sqrt((2*B['NIR'] + 1.0)**2 - 8.0*(B['NIR'] - B['R'])))/2.0
-        index_functions['OSAVI']  = lambda B: 1.16 * safe_division(B['NIR'] - B['R'], B['NIR'] + B['R'] + 0.16)
-        index_functions['EVI']    = lambda B: 2.5 * safe_division(B['NIR'] - B['R'], B['NIR'] + 6.0*B['R'] - 7.5*B['B'] + 1.0)
-    if has['NIR'] and has['G']:
-        index_functions['GCVI']   = lambda B: safe_division(B['NIR'], B['G']) - 1.0
-        index_functions['GNDVI']  = lambda B: safe_division(B['NIR'] - B['G'], B['NIR'] + B['G'])
-    if has['R'] and has['NIR'] and has['SWIR2']:
-        index_functions['HallCover'] = lambda B: (-0.017*B['R']) + (-0.007*B['NIR']) + (-0.079*B['SWIR2']) + 5.22
-
-    # Water / moisture
-    if has['NIR'] and has['SWIR1']:
-        index_functions['NDWI']  = lambda B: safe_division(B['NIR'] - B['SWIR1'], B['NIR'] + B['SWIR1'])  # ≃ NDMI
-        index_functions['NDMI']  = lambda B: safe_division(B['NIR'] - B['SWIR1'], B['NIR'] + B['SWIR1'])
-        index_functions['BSCI']  = lambda B: safe_division(B['SWIR1'] - B['NIR'], B['SWIR1'] + B['NIR'])
-    if has['G'] and has['NIR']:
-        index_functions['NDWI_McFeeters'] = lambda B: safe_division(B['G'] - B['NIR'], B['G'] + B['NIR'])
-
-    # Soil / burn
-    if has['SWIR2'] and has['SWIR1']:
-        index_functions['CAI']   = lambda B: safe_division(B['SWIR2'], B['SWIR1'])
-        index_functions['NBR2']  = lambda B: safe_division(B['SWIR1'] - B['SWIR2'], B['SWIR1'] + B['SWIR2'])
-    if has['NIR'] and has['SWIR2']:
-        index_functions['NBR']   = lambda B: safe_division(B['NIR'] - B['SWIR2'], B['NIR'] + B['SWIR2'])
-    if has['G'] and has['SWIR1']:
-        index_functions['NDSI']  = lambda B: safe_division(B['G'] - B['SWIR1'], B['G'] + B['SWIR1'])
-    if all(k in available_keys for k in ('SWIR1','R','NIR','B')):
-        index_functions['BSI']   = lambda B: safe_division((B['SWIR1'] + B['R']) - (B['NIR'] + B['B']),
-                                                           (B['SWIR1'] + B['R']) + (B['NIR'] + B['B']))
-
-    # Pigments / atmosphere
-    if all(k in available_keys for k in ('NIR','R','B')):
-        index_functions['ARVI']  = lambda B: safe_division(B['NIR'] - (2.0*B['R'] - B['B']),
-                                                           B['NIR'] + (2.0*B['R'] - B['B']))
-    if all(k in available_keys for k in ('NIR','B','R')):
-        index_functions['SIPI']  = lambda B: safe_division(B['NIR'] - B['B'], B['NIR'] + B['R'])
-    if has['B'] and has['G']:
-        index_functions['PRI']   = lambda B: safe_division(B['B'] - B['G'], B['B'] + B['G'])
-
-    # Visible color / veg
-    if has['G'] and has['R'] and has['B']:
-        index_functions['VARI']  = lambda B: safe_division(B['G'] - B['R'], B['G'] + B['R'] - B['B'])
-        index_functions['EXG']   = lambda B: 2.0*B['G'] - B['R'] - B['B']
-    if has['G'] and has['R']:
-        index_functions['GRVI']  = lambda B: safe_division(B['G'] - B['R'], B['G'] + B['R'])
-        index_functions['NDTI']  = lambda B: safe_division(B['R'] - B['G'], B['R'] + B['G'])
-
-    # Advanced moisture
-    if all(k in available_keys for k in ('NIR','SWIR2')):
-        index_functions['GVMI']  = lambda B: safe_division((B['NIR'] + 0.1) - (B['SWIR2'] + 0.02),
-                                                           (B['NIR'] + 0.1) + (B['SWIR2'] + 0.02))
-    if all(k in available_keys for k in ('NIR','SWIR1','SWIR2')):
-        index_functions['NMDI']  = lambda B: safe_division(B['NIR'] - (B['SWIR1'] - B['SWIR2']),
-                                                           B['NIR'] + (B['SWIR1'] - B['SWIR2']))
-    return index_functions
+    need_sample = low_pct > 0 or high_pct < 100
+    fraction = sample_size / float(max(1, dataset.width * dataset.height))
+    rng = np.random.default_rng(42)
+    mins, maxs, samples = {}, {}, {}
+    for window_index, window in enumerate(windows, start=1):
+        check_canceled(feedback)
+        band_arrays, _ = read_bands_and_mask(dataset, band_mapping, window=window)
+        for band_key, band_array in band_arrays.items():
+            values = band_array[np.isfinite(band_array)]
+            if values.size == 0:
+                continue
+            mins[band_key] = min(mins.get(band_key, np.float32(np.inf)), values.min())
+            maxs[band_key] = max(maxs.get(band_key, np.float32(-np.inf)), values.max())
+            if need_sample:
+                n_take = min(values.size, int(np.ceil(fraction * values.size)))
+                samples.setdefault(band_key, []).append(
+                    values if n_take == values.size else rng.choice(values, n_take, replace=False))
+        if feedback:
+            feedback.setProgress(int(20 * window_index / len(windows)))
+
+    ranges = {}
+    for band_key in band_mapping:
+        if band_key not in mins:
+            ranges[band_key] = (np.float32(np.nan), np.float32(np.nan))
+            continue
+        low, high = mins[band_key], maxs[band_key]
+        if need_sample:
+            band_sample = np.concatenate(samples[band_key])
+            if low_pct > 0: low = np.float32(np.percentile(band_sample, low_pct))
+            if high_pct < 100: high = np.float32(np.percentile(band_sample, high_pct))
+        ranges[band_key] = (low, high)
+    return ranges
+
+
+# -------------------- Output encodings -------------------- #
+
+OUTPUT_ENCODINGS = [('float32', 'float32 (padrão)'),
+                    ('int16', 'int16 com escala/offset (1e-4 nas diferenças normalizadas, 1e-3 nos demais)'),
+                    ('float16', 'float16 (meia precisão; predictor 3)'),
+                    ('uint8', 'uint8 quantizado na faixa nominal do índice')]
+
+
+class IndexEncoding:
+    """Storage of the index rasters: dtype/nodata of the output profile, per-index scale/offset
+    (value = stored × scale + offset) and the float32 → stored conversion."""
+    NODATA = {'float32': -9999.0, 'int16': -32768, 'float16': np.nan, 'uint8': 255}
+
+    def __init__(self, kind: str = 'float32'):
+        self.kind = kind
+        self.nodata = self.NODATA[kind]
+
+    def profile(self, profile: dict, **updates) -> dict:
+        """COG profile of a single-band output; float16 = Float32 with NBITS=16 (GDAL half floats)."""
+        dtype = 'float32' if self.kind == 'float16' else self.kind
+        output_profile = cog_profile(profile, count=1, dtype=dtype, nodata=self.nodata, **updates)
+        if self.kind == 'float16':
+            output_profile['NBITS'] = 16
+        return output_profile
+
+    def scale_offset(self, index_name: str) -> tuple:
+        if self.kind == 'int16':
+            return (1e-4 if index_name in ND_INDICES else 1e-3), 0.0
+        if self.kind == 'uint8':
+            low, high = index_range(index_name)
+            return (high - low) / 254.0, low
+        return 1.0, 0.0
+
+    def encode(self, index_name: str, output_array: np.ndarray) -> np.ndarray:
+        """float32 index (NaN/inf = invalid) → stored array. Works in place; out-of-range values are clipped."""
+        invalid = ~np.isfinite(output_array)
+        if self.kind in ('float32', 'float16'):
+            output_array[invalid] = self.nodata
+            return output_array
+        scale, offset = self.scale_offset(index_name)
+        output_array -= np.float32(offset)
+        output_array /= np.float32(scale)
+        np.rint(output_array, out=output_array)
+        low, high = (-32767, 32767) if self.kind == 'int16' else (0, 254)
+        np.clip(output_array, low, high, out=output_array)
+        output_array[invalid] = self.nodata
+        return output_array.astype(self.kind)
+
+    def set_band_metadata(self, outds, band_names: list):
+        """Band descriptions and, for the integer encodings, scale/offset tags."""
+        try:
+            for band_i, band_name in enumerate(band_names, start=1):
+                outds.set_band_description(band_i, band_name)
+        except Exception:
+            pass
+        if self.kind in ('int16', 'uint8'):
+            outds.scales = [self.scale_offset(name)[0] for name in band_names]
+            outds.offsets = [self.scale_offset(name)[1] for name in band_names]
+
+
+def build_stack_vrt(vrt_path: str, paths: list, band_names: list, encoding: IndexEncoding = None) -> str:
+    """Stack as a VRT: one band per source GeoTIFF (separate=True), with band descriptions."""
+    encoding = encoding or IndexEncoding()
+    nodata = encoding.nodata
+    if gdal is None:
+        raise QgsProcessingException("GDAL (osgeo) indisponível para gerar o VRT.")
+    opts = gdal.BuildVRTOptions(separate=True, srcNodata=nodata, VRTNodata=nodata)
+    vrt = gdal.BuildVRT(vrt_path, list(paths), options=opts)
+    if vrt is None:
+        raise QgsProcessingException(f"Falha ao gerar o VRT: {gdal.GetLastErrorMsg()}")
+    for band_i, band_name in enumerate(band_names, start=1):
+        vrt_band = vrt.GetRasterBand(band_i)
+        vrt_band.SetDescription(band_name)
+        scale, offset = encoding.scale_offset(band_name)
+        vrt_band.SetScale(scale)
+        vrt_band.SetOffset(offset)
+    vrt = None  # close and flush
+    return vrt_path
 
 
 # -------------------- Processing Algorithm -------------------- #
@@ -163,19 +234,19 @@ class Spectral_Indices_Generator(QgsProcessingAlgorithm):
     RASTER = 'RASTER'
     BANDMAP = 'BANDMAP'
     WHICH = 'WHICH'
+    CUSTOM_INDICES = 'CUSTOM_INDICES'
     WRITE_SEPARATE = 'WRITE_SEPARATE'
     OUT_DIR = 'OUT_DIR'
     STACK_OUT = 'STACK_OUT'
+    STACK_VRT = 'STACK_VRT'
+    ENCODING = 'ENCODING'
+    NORM_LOW = 'NORM_LOW'
+    NORM_HIGH = 'NORM_HIGH'
+    STREAMING = 'STREAMING'
+    TILE_SIZE = 'TILE_SIZE'
+    N_THREADS = 'N_THREADS'
 
-    INDEX_CATALOG = [
-        "NDVI","EVI2","SAVI","MSAVI2","OSAVI",
-        "CAI","NBR2",
-        "NDWI","NDMI","BSCI",
-        "GCVI","GNDVI",
-        "HallCover","PRI","VARI","EXG","GRVI","NDTI",
-        "BSI","ARVI","SIPI","GVMI","NMDI",
-        "NDWI_McFeeters","NBR","NDSI","EVI"
-    ]
+    INDEX_CATALOG = list(INDEX_FORMULAS)
 
     # QGIS metadata
     def tr(self, s): return tr(s)
@@ -188,7 +259,31 @@ class Spectral_Indices_Generator(QgsProcessingAlgorithm):
         return self.tr("""
 Calcula índices espectrais a partir de raster multibanda (conforme BANDMAP).
 As bandas são normalizadas para [0,1] antes dos cálculos. Operações propagam NaN.
+Normalização: percentis inferior/superior por banda (0 e 100 = mín–máx exato); fora do intervalo, valores são limitados a [0,1].
+Índices personalizados: "NOME = expressão" separados por ";" — bandas do BANDMAP (outras além das padrão podem ser mapeadas, ex.: RE=5),
+números, + - * / **, sqrt, abs, log, exp. São calculados após os selecionados, no mesmo plano (subtermos comuns avaliados uma vez).
 Permite gravar rasters separados e/ou um empilhado.
+Empilhado (opcional, um dos dois): "Raster Empilhado (GeoTIFF)", gravado banda a banda à medida que cada índice fica
+pronto (memória não cresce com o nº de índices), ou "Raster Empilhado (VRT)", arquivo .vrt que apenas referencia os
+rasters separados (exige "Gravar rasters separados").
+As saídas são COG (GeoTIFF tiled, deflate com predictor conforme o tipo e overviews AVERAGE).
+
+Codificação das saídas (valor = armazenado × escala + offset, gravados no arquivo e lidos pelo QGIS/GDAL):
+- float32: padrão, NoData -9999.
+- int16: escala 1e-4 nas diferenças normalizadas (NDVI, NDMI…) e 1e-3 nos demais (faixa ±32,767), NoData -32768; ~2× menor.
+- float16: meia precisão (NBITS=16, ~3 dígitos), predictor 3, NoData NaN.
+- uint8: 0–254 na faixa nominal do índice com bandas em [0,1] (ex.: [-1,1]; CAI [0,2]; GCVI [-1,9]; personalizados [-1,1]), NoData 255; ~4× menor.
+Nas codificações inteiras, valores fora da faixa são limitados a ela.
+
+Modo em blocos (streaming): duas passagens por janelas de "Tamanho do bloco" pixels.
+1ª passagem: mín/máx por banda (percentis a partir de amostra aleatória de ~1 milhão de pixels por banda).
+2ª passagem: calcula os índices por janela e grava ao mesmo tempo nos rasters separados e no empilhado.
+A memória fica constante, independente do tamanho da cena. Com 0/100 o resultado é idêntico ao modo em memória.
+
+Threads: com mais de uma, os blocos são calculados em paralelo (NumPy libera o GIL) e uma única thread grava
+todas as saídas. Vale nos dois modos (em memória, os blocos são recortes das bandas já carregadas).
+Memória extra ≈ 2 × threads × nº de índices × bloco² × 4 bytes (ex.: 8 threads, 27 índices, 1024 px ≈ 1,8 GB);
+reduza o bloco se necessário. O resultado é idêntico ao de uma thread.
 """)
 
     def initAlgorithm(self, config=None):
@@ -203,12 +298,80 @@ Permite gravar rasters separados e/ou um empilhado.
             self.WHICH, self.tr('Índices a calcular'),
             options=self.INDEX_CATALOG, allowMultiple=True, defaultValue=default_all
         ))
+        self.addParameter(QgsProcessingParameterString(
+            self.CUSTOM_INDICES, self.tr('Índices personalizados (ex.: CM = (NIR-RE)/(NIR+RE); separe com ;)'),
+            defaultValue='', optional=True
+        ))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.NORM_LOW, self.tr('Normalização: percentil inferior (0 = mínimo)'),
+            type=QgsProcessingParameterNumber.Double, defaultValue=0.0, minValue=0.0, maxValue=100.0))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.NORM_HIGH, self.tr('Normalização: percentil superior (100 = máximo)'),
+            type=QgsProcessingParameterNumber.Double, defaultValue=100.0, minValue=0.0, maxValue=100.0))
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.STREAMING, self.tr('Processar em blocos (streaming, memória constante)'), defaultValue=False))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.TILE_SIZE, self.tr('Tamanho do bloco (pixels, modo streaming / threads)'),
+            type=QgsProcessingParameterNumber.Integer, defaultValue=1024, minValue=256))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.N_THREADS, self.tr('Threads de cálculo (0 = todos os núcleos)'),
+            type=QgsProcessingParameterNumber.Integer, defaultValue=1, minValue=0, maxValue=256))
         self.addParameter(QgsProcessingParameterBoolean(
             self.WRITE_SEPARATE, self.tr('Gravar rasters separados (um por índice)'), defaultValue=True))
         self.addParameter(QgsProcessingParameterFolderDestination(
             self.OUT_DIR, self.tr('Pasta de saída (rasters separados)')))
         self.addParameter(QgsProcessingParameterRasterDestination(
-            self.STACK_OUT, self.tr('Raster Empilhado (GeoTIFF) [opcional]')))
+            self.STACK_OUT, self.tr('Raster Empilhado (GeoTIFF) [opcional]'), optional=True, createByDefault=False))
+        self.addParameter(QgsProcessingParameterFileDestination(
+            self.STACK_VRT, self.tr('Raster Empilhado (VRT dos rasters separados) [opcional]'),
+            fileFilter='VRT (*.vrt)', optional=True, createByDefault=False))
+        self.addParameter(QgsProcessingParameterEnum(
+            self.ENCODING, self.tr('Codificação das saídas'), options=[e[1] for e in OUTPUT_ENCODINGS], defaultValue=0))
+
+    # ---------- helpers ----------
+    def _index_plan(self, band_keys, selected_index_names, custom_indices, feedback):
+        """Filter available indices (catalog, then custom) and compile them into a single expression DAG
+        (division by zero → NaN)."""
+        formulas = {name: INDEX_FORMULAS[name] for name in available_index_names(band_keys, selected_index_names)}
+        band_keys = set(band_keys)
+        formulas.update((name, expr) for name, expr in custom_indices.items() if formula_bands(expr) <= band_keys)
+        for index_name in selected_index_names + list(custom_indices):
+            if index_name not in formulas:
+                feedback.pushInfo(f"[Aviso] Índice {index_name} indisponível (bandas insuficientes).")
+        if not formulas:
+            raise QgsProcessingException("Nenhum índice a calcular com as bandas fornecidas.")
+        index_jobs = list(formulas)
+
+        # Single expression DAG: shared subterms evaluated once
+        try:
+            index_plan = IndexPlan(formulas, division='nan')
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+        feedback.pushInfo(f"[Plano] {len(index_jobs)} índices: {index_plan.n_ops} operações "
+                          f"(sem reaproveitamento: {index_plan.n_ops_naive})")
+        return index_jobs, index_plan
+
+    @staticmethod
+    def _separate_path(output_directory, source_path, index_name):
+        return os.path.join(output_directory, f"{os.path.splitext(os.path.basename(source_path))[0]}_{index_name}.tif")
+
+    @staticmethod
+    def _load_on_completion(context, feedback, output_path, index_name):
+        """Schedule auto-load into QGIS project."""
+        raster_tmp_layer = QgsRasterLayer(output_path, index_name)
+        if raster_tmp_layer.isValid():
+            context.temporaryLayerStore().addMapLayer(raster_tmp_layer)
+            layer_details = QgsProcessingContext.LayerDetails(index_name, context.project())
+            context.addLayerToLoadOnCompletion(raster_tmp_layer.id(), layer_details)
+        else:
+            feedback.reportError(f"[Aviso] Raster inválido ao carregar: {output_path}")
+
+    def _write_stack_vrt(self, stack_output_path, separate_paths, index_jobs, encoding, context, feedback):
+        build_stack_vrt(stack_output_path, [separate_paths[name] for name in index_jobs], index_jobs, encoding)
+        feedback.pushInfo(f"[Empilhado] VRT com {len(index_jobs)} bandas → {stack_output_path}")
+        # Destino de arquivo: o QGIS não carrega sozinho, então o VRT é agendado como os rasters separados
+        self._load_on_completion(context, feedback, stack_output_path,
+                                 os.path.splitext(os.path.basename(stack_output_path))[0])
 
     def processAlgorithm(self, parameters, context, feedback):
         raster_layer = self.parameterAsRasterLayer(parameters, self.RASTER, context)
@@ -217,102 +380,218 @@ Permite gravar rasters separados e/ou um empilhado.
         source_path = raster_layer.dataProvider().dataSourceUri().split('|')[0]
 
         band_mapping = parse_band_mapping(self.parameterAsString(parameters, self.BANDMAP, context))
+        try:
+            custom_indices = parse_custom_indices(
+                self.parameterAsString(parameters, self.CUSTOM_INDICES, context), band_mapping.keys())
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
         selected_index_indices = self.parameterAsEnums(parameters, self.WHICH, context) or list(range(len(self.INDEX_CATALOG)))
         write_separate = self.parameterAsBool(parameters, self.WRITE_SEPARATE, context)
         output_directory = self.parameterAsString(parameters, self.OUT_DIR, context)
         stack_output_path = self.parameterAsOutputLayer(parameters, self.STACK_OUT, context)
+        low_pct = self.parameterAsDouble(parameters, self.NORM_LOW, context)
+        high_pct = self.parameterAsDouble(parameters, self.NORM_HIGH, context)
+        streaming = self.parameterAsBool(parameters, self.STREAMING, context)
+        tile_size = self.parameterAsInt(parameters, self.TILE_SIZE, context)
+        workers = resolve_workers(self.parameterAsInt(parameters, self.N_THREADS, context))
+        encoding = IndexEncoding(OUTPUT_ENCODINGS[self.parameterAsEnum(parameters, self.ENCODING, context)][0])
+        stack_vrt_path = self.parameterAsFileOutput(parameters, self.STACK_VRT, context)
+        stack_vrt = bool(stack_vrt_path)
 
         if write_separate and not output_directory:
             raise QgsProcessingException("Seleção de rasters separados requer pasta de saída.")
+        if not (0.0 <= low_pct < high_pct <= 100.0):
+            raise QgsProcessingException("Percentis de normalização inválidos: use 0 ≤ inferior < superior ≤ 100.")
+        if stack_vrt:
+            if stack_output_path:
+                raise QgsProcessingException("Informe só um empilhado: GeoTIFF ou VRT.")
+            if not write_separate:
+                raise QgsProcessingException("Empilhado em VRT requer \"Gravar rasters separados\".")
+            if os.path.splitext(stack_vrt_path)[1].lower() != '.vrt':
+                raise QgsProcessingException(f"Empilhado em VRT deve ter extensão .vrt: {stack_vrt_path}")
+            stack_output_path = stack_vrt_path
+        elif stack_output_path:
+            check_geotiff_path(stack_output_path)
 
         selected_index_names = [self.INDEX_CATALOG[i] for i in selected_index_indices]
 
         with rasterio.open(source_path) as dataset:
             feedback.pushInfo(f"[Open] {source_path}")
-            band_arrays, _global_mask = read_bands_and_mask(dataset, band_mapping, feedback)
-            if not band_arrays:
-                raise QgsProcessingException("BANDMAP não corresponde a bandas existentes.")
-
-            # Normalize each band to [0,1]
-            for band_key in list(band_arrays.keys()):
+            if streaming:
+                written_names = self._process_streaming(
+                    dataset, source_path, band_mapping, selected_index_names, custom_indices, low_pct, high_pct,
+                    tile_size, workers, write_separate, output_directory, stack_output_path, stack_vrt, encoding,
+                    context, feedback)
+            else:
+                written_names = self._process_in_memory(
+                    dataset, source_path, band_mapping, selected_index_names, custom_indices, low_pct, high_pct,
+                    tile_size, workers, write_separate, output_directory, stack_output_path, stack_vrt, encoding,
+                    context, feedback)
+
+        results = {}
+        if stack_output_path and written_names:
+            results[self.STACK_VRT if stack_vrt else self.STACK_OUT] = stack_output_path
+        if write_separate:
+            results[self.OUT_DIR] = output_directory
+
+        feedback.pushInfo(f"[Resumo] Selecionados: {len(selected_index_names) + len(custom_indices)}; gravados: {len(written_names)}.")
+        return results
+
+    # ---------- whole-scene (in memory) ----------
+    def _process_in_memory(self, dataset, source_path, band_mapping, selected_index_names, custom_indices,
+                           low_pct, high_pct, tile_size, workers, write_separate, output_directory,
+                           stack_output_path, stack_vrt, encoding, context, feedback):
+        band_arrays, _global_mask = read_bands_and_mask(dataset, band_mapping, feedback)
+        if not band_arrays:
+            raise QgsProcessingException("BANDMAP não corresponde a bandas existentes.")
+
+        # Normalize each band to [0,1] (min–max or percentiles, clipped)
+        for band_key in list(band_arrays.keys()):
+            if low_pct == 0 and high_pct == 100:
                 band_arrays[band_key] = normalize_01(band_arrays[band_key])
-
-            index_defs = available_index_definitions(set(band_arrays.keys()))
-
-            # Filter available indices
-            index_jobs = []
-            for index_name in selected_index_names:
-                if index_name in index_defs:
-                    index_jobs.append((index_name, index_defs[index_name]))
-                else:
-                    feedback.pushInfo(f"[Aviso] Índice {index_name} indisponível (bandas insuficientes).")
-            if not index_jobs:
-                raise QgsProcessingException("Nenhum índice a calcular com as bandas fornecidas.")
-
-            # Output profile
-            base_profile = dataset.profile.copy()
-            base_profile.update(count=1, dtype='float32', nodata=np.float32(-9999), compress='deflate', predictor=2)
-
-            stack_band_list, stack_band_names = [], []
-            total_jobs = len(index_jobs)
-
-            for job_index, (index_name, index_fn) in enumerate(index_jobs, start=1):
+            else:
+                with np.errstate(all='ignore'):
+                    low, high = np.nanpercentile(band_arrays[band_key], [low_pct, high_pct]).astype(np.float32)
+                band_arrays[band_key] = normalize_range(band_arrays[band_key], low, high, clip=True)
+
+        index_jobs, index_plan = self._index_plan(band_arrays.keys(), selected_index_names, custom_indices, feedback)
+
+        # Output profile (tiled COG, deflate + predictor of the encoded dtype, AVERAGE overviews)
+        base_profile = encoding.profile(dataset.profile)
+
+        if workers > 1:
+            # Tiles of the bands already in memory, computed in parallel (single writer)
+            windows = [core for core, _outer, _inner in iter_windows(dataset.height, dataset.width, tile_size)]
+            feedback.pushInfo(f"[Threads] {workers} threads; {len(windows)} blocos de {tile_size}×{tile_size} px")
+            separate_paths = self._write_windowed(
+                windows, lambda window: {k: a[window.toslices()] for k, a in band_arrays.items()},
+                index_jobs, index_plan, base_profile, encoding, block_for(tile_size), workers, source_path,
+                write_separate, output_directory, stack_output_path, stack_vrt, feedback, 0, 95)
+            self._finish_outputs(separate_paths, index_jobs, stack_output_path, stack_vrt, encoding, context, feedback)
+            return index_jobs
+
+        total_jobs = len(index_jobs)
+        separate_paths = {}
+
+        with ExitStack() as outputs:
+            # GeoTIFF stack written band by band as each index is ready (no [bands, rows, cols] cube)
+            stack_ds = None
+            if stack_output_path and not stack_vrt:
+                stack_profile = dict(base_profile, count=total_jobs)
+                stack_ds = outputs.enter_context(cog_writer(stack_output_path, stack_profile, 'average'))
+                encoding.set_band_metadata(stack_ds, index_jobs)
+
+            for job_index, (index_name, output_array) in enumerate(index_plan.run(band_arrays), start=1):
                 feedback.setProgressText(f"Índice {index_name} ({job_index}/{total_jobs})")
                 feedback.setProgress(int(100 * job_index / max(1, total_jobs)))
 
-                try:
-                    index_array = index_fn(band_arrays).astype(np.float32)
-                except Exception as exc:
-                    feedback.pushInfo(f"[Erro] {index_name}: {exc}")
-                    continue
+                output_array = encoding.encode(index_name, output_array)
 
-                output_array = index_array.copy()
-                output_array[~np.isfinite(output_array)] = -9999.0
-
-                stack_band_list.append(output_array)
-                stack_band_names.append(index_name)
+                if stack_ds is not None:
+                    stack_ds.write(output_array, job_index)
 
                 if write_separate:
                     os.makedirs(output_directory, exist_ok=True)
-                    output_path = os.path.join(
-                        output_directory,
-                        f"{os.path.splitext(os.path.basename(source_path))[0]}_{index_name}.tif"
-                    )
-                    with rasterio.open(output_path, 'w', **base_profile) as outds:
+                    output_path = self._separate_path(output_directory, source_path, index_name)
+                    with cog_writer(output_path, base_profile, 'average') as outds:
                         outds.write(output_array, 1)
+                        encoding.set_band_metadata(outds, [index_name])
+                    separate_paths[index_name] = output_path
                     feedback.pushInfo(f"[Saída] {index_name} → {output_path}")
-
-                    # Schedule auto-load into QGIS project
-                    raster_tmp_layer = QgsRasterLayer(output_path, index_name)
-                    if raster_tmp_layer.isValid():
-                        context.temporaryLayerStore().addMapLayer(raster_tmp_layer)
-                        layer_details = QgsProcessingContext.LayerDetails(index_name, context.project())
-                        context.addLayerToLoadOnCompletion(raster_tmp_layer.id(), layer_details)
-                    else:
-                        feedback.reportError(f"[Aviso] Raster inválido ao carregar: {output_path}")
-
-            results = {}
-
-            # Optional stacked output
-            if stack_output_path:
-                if stack_band_list:
-                    stack_cube = np.stack(stack_band_list, axis=0)  # [bands, rows, cols]
-                    stack_profile = base_profile.copy()
-                    stack_profile.update(count=stack_cube.shape[0])
-                    with rasterio.open(stack_output_path, 'w', **stack_profile) as outds:
-                        outds.write(stack_cube)
-                        try:
-                            for band_i, band_name in enumerate(stack_band_names, start=1):
-                                outds.set_band_description(band_i, band_name)
-                        except Exception:
-                            pass
-                    feedback.pushInfo(f"[Empilhado] {len(stack_band_names)} bandas → {stack_output_path}")
-                    results[self.STACK_OUT] = stack_output_path
-                else:
-                    feedback.pushInfo("[Empilhado] Nada a escrever.")
-
+                    self._load_on_completion(context, feedback, output_path, index_name)
+                del output_array
+
+        if stack_vrt:
+            self._write_stack_vrt(stack_output_path, separate_paths, index_jobs, encoding, context, feedback)
+        elif stack_output_path:
+            feedback.pushInfo(f"[Empilhado] {total_jobs} bandas → {stack_output_path}")
+        return index_jobs
+
+    # ---------- two-pass windowed (streaming) ----------
+    def _process_streaming(self, dataset, source_path, band_mapping, selected_index_names, custom_indices,
+                           low_pct, high_pct, tile_size, workers, write_separate, output_directory,
+                           stack_output_path, stack_vrt, encoding, context, feedback):
+        band_mapping = valid_band_mapping(dataset, band_mapping, feedback)
+        if not band_mapping:
+            raise QgsProcessingException("BANDMAP não corresponde a bandas existentes.")
+        index_jobs, index_plan = self._index_plan(band_mapping.keys(), selected_index_names, custom_indices, feedback)
+
+        # Only bands used by the selected indices are read
+        band_mapping = {k: v for k, v in band_mapping.items() if k in index_plan.bands}
+        windows = [core for core, _outer, _inner in iter_windows(dataset.height, dataset.width, tile_size)]
+        feedback.pushInfo(f"[Streaming] {len(windows)} janelas de {tile_size}×{tile_size} px; {workers} thread(s)")
+
+        # Pass 1: per-band normalization range
+        feedback.setProgressText("Passagem 1: intervalo de normalização por banda")
+        band_ranges = streaming_band_ranges(dataset, band_mapping, windows, low_pct, high_pct, feedback=feedback)
+        for band_key, (low, high) in band_ranges.items():
+            feedback.pushInfo(f"[Normalização] {band_key}: {low:.6g} – {high:.6g}")
+        clip = low_pct > 0 or high_pct < 100
+
+        # Pass 2: indices per window → every output at once
+        base_profile = encoding.profile(dataset.profile)
+        feedback.setProgressText("Passagem 2: índices por janela")
+        with thread_readers(dataset, workers) as reader:
+            def tile_bands(window):
+                band_arrays, _ = read_bands_and_mask(reader(), band_mapping, window=window)
+                for band_key, (low, high) in band_ranges.items():
+                    band_arrays[band_key] = normalize_range(band_arrays[band_key], low, high, clip=clip)
+                return band_arrays
+
+            separate_paths = self._write_windowed(
+                windows, tile_bands, index_jobs, index_plan, base_profile, encoding, block_for(tile_size), workers,
+                source_path, write_separate, output_directory, stack_output_path, stack_vrt, feedback, 20, 95)
+        self._finish_outputs(separate_paths, index_jobs, stack_output_path, stack_vrt, encoding, context, feedback)
+        return index_jobs
+
+    def _write_windowed(self, windows, tile_bands, index_jobs, index_plan, base_profile, encoding, block, workers,
+                        source_path, write_separate, output_directory, stack_output_path, stack_vrt,
+                        feedback, p0, p1):
+        """Indices per window in a thread pool (tile_bands(window) → normalized bands); the calling thread
+        is the single writer of every output (writes aligned to the COG blocks). Returns {index: path}."""
+        def work(window):
+            tile_outputs = []
+            for index_name, output_array in index_plan.run(tile_bands(window)):
+                tile_outputs.append(encoding.encode(index_name, output_array))
+            return tile_outputs
+
+        with ExitStack() as outputs:
+            separate = {}
             if write_separate:
-                results[self.OUT_DIR] = output_directory
-
-            feedback.pushInfo(f"[Resumo] Selecionados: {len(selected_index_names)}; gravados: {len(stack_band_names)}.")
-            return results
+                os.makedirs(output_directory, exist_ok=True)
+                for index_name in index_jobs:
+                    output_path = self._separate_path(output_directory, source_path, index_name)
+                    separate[index_name] = (output_path,
+                                            outputs.enter_context(cog_writer(output_path, base_profile, 'average', block)))
+                    encoding.set_band_metadata(separate[index_name][1], [index_name])
+            stack_ds = None
+            if stack_output_path and not stack_vrt:
+                stack_profile = dict(base_profile, count=len(index_jobs))
+                stack_ds = outputs.enter_context(cog_writer(stack_output_path, stack_profile, 'average', block))
+                encoding.set_band_metadata(stack_ds, index_jobs)
+
+            written = [0]
+            def sink(window, tile_outputs):
+                for band_i, (index_name, output_array) in enumerate(zip(index_jobs, tile_outputs), start=1):
+                    if index_name in separate:
+                        separate[index_name][1].write(output_array, 1, window=window)
+                    if stack_ds is not None:
+                        stack_ds.write(output_array, band_i, window=window)
+                written[0] += 1
+                feedback.setProgress(p0 + int((p1 - p0) * written[0] / len(windows)))
+                check_canceled(feedback)
+
+            run_pipeline(windows, work, sink, workers)
+            feedback.setProgressText("Overviews e COG")
+        # Leaving the ExitStack finalizes every COG (overviews + copy)
+        return {index_name: output_path for index_name, (output_path, _dst) in separate.items()}
+
+    def _finish_outputs(self, separate_paths, index_jobs, stack_output_path, stack_vrt, encoding, context, feedback):
+        for index_name, output_path in separate_paths.items():
+            feedback.pushInfo(f"[Saída] {index_name} → {output_path}")
+            self._load_on_completion(context, feedback, output_path, index_name)
+        if stack_vrt:
+            self._write_stack_vrt(stack_output_path, separate_paths, index_jobs, encoding, context, feedback)
+        elif stack_output_path:
+            feedback.pushInfo(f"[Empilhado] {len(index_jobs)} bandas → {stack_output_path}")
+        feedback.setProgress(100)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+/***********************************************
+ Arqueokit - QGIS Plugin
+ Gravação de rasters (COG), janelas e threads compartilhados entre os algoritmos
+ Autor: Geraldo Pereira de Morais Júnior
+ Email: geraldo.pmj@gmail.com
+ ***********************************************/
+"""
+__author__ = 'Geraldo Pereira de Morais Júnior'
+__date__ = '2025-09-02'
+__copyright__ = '(C) 2025 by Geraldo Pereira de Morais Júnior'
+__revision__ = '$Format:%H$'
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window
+from qgis.core import QgsProcessingException
+
+# GDAL (escrita direta nos blocos das overviews); presente em qualquer instalação do QGIS
+try:
+    from osgeo import gdal
+except Exception:
+    gdal = None
+
+
+# -------------------- COG (Cloud Optimized GeoTIFF) -------------------- #
+
+COG_BLOCK = 512
+GEOTIFF_EXTENSIONS = ('.tif', '.tiff')
+
+def predictor_for(dtype):
+    """Predictor do deflate: 3 (ponto flutuante) para float, 2 (diferença horizontal) para inteiros."""
+    return 3 if np.dtype(dtype).kind == 'f' else 2
+
+def block_for(tile):
+    """Maior bloco de saída (512 ou 256) que divide o passo de escrita `tile` (escritas alinhadas)."""
+    return COG_BLOCK if not tile or tile % COG_BLOCK == 0 else 256
+
+def check_geotiff_path(path):
+    """As saídas são sempre GeoTIFF/COG: recusa destinos com outra extensão (.img, .vrt, .nc…) em vez de
+    gravar um GeoTIFF com nome enganoso."""
+    if os.path.splitext(str(path))[1].lower() not in GEOTIFF_EXTENSIONS:
+        raise QgsProcessingException(f"Saída raster deve ser GeoTIFF (.tif/.tiff): {path}")
+    return path
+
+def cog_profile(profile, block=COG_BLOCK, **updates):
+    """Perfil do GeoTIFF de trabalho: tiled, deflate rápido (a compressão final é refeita na cópia COG)
+    e predictor conforme o dtype. `updates` sobrescreve count/dtype/nodata etc. O driver é sempre GTiff:
+    o caminho de destino passa por check_geotiff_path (cog_writer/finalize_cog)."""
+    prof = dict(profile)
+    prof.update(updates)
+    for k in ('blockxsize', 'blockysize', 'compress', 'predictor', 'zlevel', 'interleave', 'photometric'):
+        prof.pop(k, None)
+    prof.update(driver='GTiff', tiled=True, blockxsize=block, blockysize=block, compress='deflate',
+                zlevel=1, predictor=predictor_for(prof['dtype']), BIGTIFF='IF_SAFER')
+    return prof
+
+def overview_factors(width, height, block=COG_BLOCK):
+    """Fatores 2, 4, 8… até o maior nível caber num bloco."""
+    factors, f = [], 2
+    while max(width, height) / (f // 2) > block:
+        factors.append(f)
+        f *= 2
+    return factors
+
+@lru_cache(maxsize=1)
+def has_cog_driver():
+    with rasterio.Env() as env:
+        return 'COG' in env.drivers()
+
+def finalize_cog(path, resampling='nearest'):
+    """Converte no lugar o GeoTIFF em `path` num COG: blocos de COG_BLOCK, deflate com predictor do dtype
+    e overviews (nearest para classes, average para contínuos). Sem o driver COG (GDAL < 3.1), grava um
+    GeoTIFF tiled com as overviews copiadas para o início do arquivo (mesmo layout)."""
+    check_geotiff_path(path)
+    tmp = os.path.splitext(path)[0] + '_cog.tmp.tif'
+    with rasterio.open(path) as src:
+        pred = predictor_for(src.dtypes[0])
+        factors = overview_factors(src.width, src.height)
+    try:
+        if has_cog_driver():
+            rio_copy(path, tmp, driver='COG', COMPRESS='DEFLATE', PREDICTOR='YES', BLOCKSIZE=COG_BLOCK,
+                     RESAMPLING=resampling.upper(), OVERVIEWS='IGNORE_EXISTING', BIGTIFF='IF_SAFER',
+                     NUM_THREADS='ALL_CPUS')
+        else:
+            with rasterio.open(path, 'r+') as ds:
+                if factors: ds.build_overviews(factors, Resampling[resampling])
+            rio_copy(path, tmp, driver='GTiff', TILED='YES', BLOCKXSIZE=COG_BLOCK, BLOCKYSIZE=COG_BLOCK,
+                     COMPRESS='DEFLATE', PREDICTOR=pred, COPY_SRC_OVERVIEWS='YES', BIGTIFF='IF_SAFER')
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    return path
+
+@contextmanager
+def cog_writer(path, profile, resampling='nearest', block=COG_BLOCK):
+    """rasterio.open(path, 'w') com perfil COG; ao sair sem erro, gera as overviews e o COG final."""
+    check_geotiff_path(path)
+    with rasterio.open(path, 'w', **cog_profile(profile, block=block)) as dst:
+        yield dst
+    finalize_cog(path, resampling)
+
+def open_update(path):
+    """rasterio.open(path, 'r+') que aceita COG: o GDAL recusa editar um COG sem IGNORE_COG_LAYOUT_BREAK
+    (blocos regravados quebram o layout otimizado, mas o arquivo continua um GeoTIFF válido)."""
+    return rasterio.open(path, 'r+', IGNORE_COG_LAYOUT_BREAK='YES')
+
+def _reduce_block(a, f, resampling, nodata):
+    """Bloco em resolução total (lados múltiplos de f) → resolução da overview de fator f: pixel central
+    de cada célula f×f (nearest, mesma escolha do GDAL) ou média dos valores válidos (average)."""
+    h, w = a.shape[0] // f, a.shape[1] // f
+    cells = a.reshape(h, f, w, f)
+    if resampling == 'nearest':
+        return cells[:, f // 2, :, f // 2].copy()
+    v = cells.astype(np.float64)
+    ok = np.isfinite(v) if nodata is None or np.isnan(nodata) else (v != nodata) & np.isfinite(v)
+    n = ok.sum(axis=(1, 3))
+    mean = np.where(ok, v, 0.0).sum(axis=(1, 3)) / np.maximum(n, 1)
+    fill = np.nan if nodata is None else nodata
+    if np.dtype(a.dtype).kind != 'f': mean = np.rint(mean)
+    return np.where(n > 0, mean, fill).astype(a.dtype)
+
+def refresh_overviews(path, windows, resampling='nearest'):
+    """Depois de regravar `windows` em resolução total no próprio arquivo (open_update),
+    recalcula só os blocos das overviews internas que as cobrem: cada um é lido em resolução total e
+    reduzido aqui (ler já reduzido faria o GDAL usar a própria overview desatualizada). Exige osgeo para
+    gravar nas overviews; sem ele, refaz todas as overviews no lugar (lê a cena inteira).
+    O arquivo nunca é copiado nem substituído (funciona com a camada aberta no QGIS), mas blocos
+    regravados vão para o fim do arquivo: continua GeoTIFF tiled com overviews, não mais um COG estrito."""
+    check_geotiff_path(path)
+    if gdal is None:
+        with open_update(path) as ds:
+            factors = ds.overviews(1)
+            if factors: ds.build_overviews(factors, Resampling[resampling])
+        return path
+    ds = gdal.OpenEx(path, gdal.OF_RASTER | gdal.OF_UPDATE, open_options=['IGNORE_COG_LAYOUT_BREAK=YES'])
+    if ds is None:
+        raise QgsProcessingException(f"Falha ao abrir {path} para atualizar as overviews: {gdal.GetLastErrorMsg()}")
+    try:
+        width, height = ds.RasterXSize, ds.RasterYSize
+        for b in range(1, ds.RasterCount + 1):
+            band = ds.GetRasterBand(b)
+            nodata = band.GetNoDataValue()
+            for k in range(band.GetOverviewCount()):
+                ovr = band.GetOverview(k)
+                f = int(round(width / ovr.XSize))
+                for win in windows:
+                    ox0, oy0 = int(win.col_off) // f, int(win.row_off) // f
+                    ox1 = min(ovr.XSize, -(-int(win.col_off + win.width) // f))
+                    oy1 = min(ovr.YSize, -(-int(win.row_off + win.height) // f))
+                    sx0, sy0 = ox0 * f, oy0 * f
+                    sx1, sy1 = min(width, ox1 * f), min(height, oy1 * f)
+                    a = band.ReadAsArray(sx0, sy0, sx1 - sx0, sy1 - sy0)
+                    # borda direita/inferior da cena: completa a última célula repetindo a borda
+                    a = np.pad(a, ((0, (oy1 - oy0) * f - a.shape[0]), (0, (ox1 - ox0) * f - a.shape[1])), mode='edge')
+                    ovr.WriteArray(_reduce_block(a, f, resampling, nodata), ox0, oy0)
+        ds.FlushCache()
+    finally:
+        ds = None  # fecha e grava
+    return path
+
+
+# -------------------- Janelas -------------------- #
+
+def iter_windows(height, width, tile, halo=0):
+    """Gera (núcleo, janela com halo, fatias do núcleo dentro da janela com halo)."""
+    for r0 in range(0, height, tile):
+        for c0 in range(0, width, tile):
+            h, w = min(tile, height - r0), min(tile, width - c0)
+            hr0, hc0 = max(0, r0 - halo), max(0, c0 - halo)
+            hr1, hc1 = min(height, r0 + h + halo), min(width, c0 + w + halo)
+            core = Window(c0, r0, w, h)
+            outer = Window(hc0, hr0, hc1 - hc0, hr1 - hr0)
+            inner = (slice(r0 - hr0, r0 - hr0 + h), slice(c0 - hc0, c0 - hc0 + w))
+            yield core, outer, inner
+
+
+# -------------------- Threads e cancelamento -------------------- #
+
+def check_canceled(feedback):
+    if feedback is not None and feedback.isCanceled():
+        raise QgsProcessingException("Cancelado pelo usuário.")
+
+def resolve_workers(n):
+    """0/negativo = todos os núcleos."""
+    n = int(n or 0)
+    return max(1, os.cpu_count() or 1) if n <= 0 else n
+
+def run_pipeline(tasks, work, sink, workers=1, feedback=None):
+    """Executa work(task) num pool de threads e entrega sink(task, resultado) na thread chamadora.
+    No máximo 2×workers tarefas em voo: leitura/features/predição se sobrepõem sem acumular blocos.
+    feedback: progresso 0–100 por tarefa entregue e cancelamento checado a cada tarefa (as em voo
+    terminam, as pendentes são descartadas)."""
+    tasks = list(tasks)
+    n, done = len(tasks), [0]
+    def deliver(t, res):
+        sink(t, res)
+        done[0] += 1
+        if feedback: feedback.setProgress(100.0 * done[0] / max(n, 1))
+    if workers <= 1:
+        for t in tasks:
+            check_canceled(feedback)
+            deliver(t, work(t))
+        return
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending = {}
+        try:
+            for t in tasks:
+                check_canceled(feedback)
+                pending[ex.submit(work, t)] = t
+                if len(pending) >= 2 * workers:
+                    done_f, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done_f:
+                        deliver(pending.pop(f), f.result())
+            while pending:
+                check_canceled(feedback)
+                done_f, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done_f:
+                    deliver(pending.pop(f), f.result())
+        except BaseException:
+            for f in pending: f.cancel()
+            raise
+
+class thread_readers:
+    """Um handle rasterio por thread (datasets não são thread-safe); fechados na saída."""
+    def __init__(self, ds, workers):
+        self.ds, self.workers = ds, workers
+        self.local, self.handles, self.lock = threading.local(), [], threading.Lock()
+    def __call__(self):
+        if self.workers <= 1: return self.ds
+        if not hasattr(self.local, 'ds'):
+            self.local.ds = rasterio.open(self.ds.name)
+            with self.lock: self.handles.append(self.local.ds)
+        return self.local.ds
+    def __enter__(self): return self
+    def __exit__(self, *exc):
+        for h in self.handles: h.close()
+        return False